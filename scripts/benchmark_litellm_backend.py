@@ -0,0 +1,116 @@
+"""
+Compares throughput of `litellm.batch_completion` and the asynchronous LitellmGenerator
+against a local OpenAI-compatible stub server with mixed response latencies and
+occasional rate-limit errors. Reports successful requests per second.
+
+Usage: python scripts/benchmark_litellm_backend.py --n_requests 500
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import litellm
+
+from info_salience.llm import LitellmGenerator
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Most requests are fast, some are very slow (long-tail latency of hosted APIs).
+    latencies = [0.05] * 8 + [0.5, 3.0]
+    error_rate = 0.05
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        request = json.loads(self.rfile.read(length))
+        time.sleep(random.choice(self.latencies))
+        if random.random() < self.error_rate:
+            body = b'{"error": {"message": "Rate limit reached", "type": "rate_limit"}}'
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        content = request["messages"][-1]["content"][::-1]
+        body = json.dumps(
+            {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 10,
+                    "total_tokens": 20,
+                },
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+@click.command()
+@click.option("--n_requests", default=500, type=int)
+@click.option("--max_concurrency", default=128, type=int)
+def main(n_requests, max_concurrency):
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    server, api_base = start_stub_server()
+    model = "openai/stub"
+    messages = [[{"role": "user", "content": f"prompt {i}"}] for i in range(n_requests)]
+
+    start = time.perf_counter()
+    responses = litellm.batch_completion(
+        model=model, messages=messages, api_base=api_base
+    )
+    batch_time = time.perf_counter() - start
+    batch_ok = sum(not isinstance(r, Exception) for r in responses)
+
+    llm = LitellmGenerator(
+        model, max_concurrency=max_concurrency, api_base=api_base, backoff_base=0.1
+    )
+    start = time.perf_counter()
+    results = llm.generate(messages)
+    async_time = time.perf_counter() - start
+    async_ok = sum(len(r) > 0 for r in results)
+
+    # results must come back in input order
+    for message, result in zip(messages, results):
+        assert not result or result[0] == message[0]["content"][::-1]
+    server.shutdown()
+
+    print(
+        f"batch_completion: {batch_ok / batch_time:.1f} req/s "
+        f"({batch_ok}/{n_requests} ok, {batch_time:.2f}s)"
+    )
+    print(
+        f"async generator:  {async_ok / async_time:.1f} req/s "
+        f"({async_ok}/{n_requests} ok, {async_time:.2f}s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
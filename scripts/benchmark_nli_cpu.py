@@ -0,0 +1,126 @@
+"""
+Measures the throughput (pairs per second) of the CPU MiniCheck scorer per backend and
+thread count, and the agreement of its labels with a reference model (by default
+Bespoke-MiniCheck-7B, read from the NLI cache where available) and with the fp32 weights.
+
+Usage:
+python scripts/benchmark_nli_cpu.py \
+    --facts_path output/qmsum-generic/discord_facts.json \
+    --summaries_path output/qmsum-generic/lead_1/summaries/output.json \
+    --model roberta-large --threads 1 --threads 4 --threads 16
+"""
+
+import random
+import time
+
+import click
+import pandas as pd
+
+from info_salience.claim_entailment import (
+    DEFAULT_NLI_CACHE_PATH,
+    NLI_MODEL,
+    LazyMiniCheck,
+    NLICache,
+    agreement,
+    entailment_pairs,
+    score_pairs,
+)
+from info_salience.nli_cpu import CPU_BACKENDS, CPU_MODELS, CPUMiniCheck
+from info_salience.tables import read_table
+
+
+@click.command()
+@click.option("--facts_path", required=True)
+@click.option("--summaries_path", required=True)
+@click.option("--model", default="roberta-large", type=click.Choice(list(CPU_MODELS)))
+@click.option(
+    "--backend",
+    "backends",
+    multiple=True,
+    type=click.Choice(CPU_BACKENDS),
+    default=["fp32", "int8"],
+)
+@click.option("--threads", "threads_list", multiple=True, type=int, default=[1, 4])
+@click.option("--n_jobs", default=1, type=int, help="Processes of the CPU scorer.")
+@click.option("--batch_size", default=16, type=int)
+@click.option("--n_pairs", default=500, type=int, help="Random sample of pairs.")
+@click.option("--reference_model", default=NLI_MODEL)
+@click.option("--nli_cache_path", default=DEFAULT_NLI_CACHE_PATH)
+@click.option("--seed", default=0, type=int)
+def main(
+    facts_path,
+    summaries_path,
+    model,
+    backends,
+    threads_list,
+    n_jobs,
+    batch_size,
+    n_pairs,
+    reference_model,
+    nli_cache_path,
+    seed,
+):
+    df = pd.merge(
+        read_table(facts_path),
+        read_table(summaries_path),
+        on="doc_id",
+        how="left",
+        validate="m:1",
+    )
+    summary_cols = [
+        c
+        for c in df.columns
+        if c.startswith("summary_") and not c.startswith("summary_e")
+    ]
+    docs, claims, _ = entailment_pairs(df, summary_cols)
+    sample = random.Random(seed).sample(range(len(docs)), min(n_pairs, len(docs)))
+    # sorted by premise length, as in `score_pairs`
+    sample = sorted(sample, key=lambda i: len(docs[i]))
+    docs = [docs[i] for i in sample]
+    claims = [claims[i] for i in sample]
+    print(f"{len(docs)} pairs, reference: {reference_model}")
+
+    cache = NLICache(nli_cache_path) if nli_cache_path else None
+    reference, _, cached = score_pairs(
+        LazyMiniCheck(reference_model), docs, claims, cache=cache, model=reference_model
+    )
+    print(f"Reference labels: {sum(cached)}/{len(docs)} cached")
+
+    rows = []
+    fp32_labels = None
+    for backend in backends:
+        for threads in threads_list:
+            scorer = CPUMiniCheck(
+                model,
+                backend=backend,
+                n_jobs=n_jobs,
+                threads=threads,
+                batch_size=batch_size,
+            )
+            # load the model in all workers outside of the timing
+            warmup = n_jobs * batch_size
+            scorer.score(docs[:warmup], claims[:warmup])
+            start = time.perf_counter()
+            labels, _, _, _ = scorer.score(docs, claims)
+            wall_time = time.perf_counter() - start
+            if backend == "fp32" and fp32_labels is None:
+                fp32_labels = labels
+            rows.append(
+                {
+                    "backend": backend,
+                    "n_jobs": n_jobs,
+                    "threads": threads,
+                    "wall_time_s": round(wall_time, 2),
+                    "pairs_per_s": round(len(docs) / wall_time, 1),
+                    "agreement_reference": agreement(labels, reference),
+                    "agreement_fp32": (
+                        None if fp32_labels is None else agreement(labels, fp32_labels)
+                    ),
+                }
+            )
+
+    print(pd.DataFrame(rows).round(3).to_markdown(index=False))
+
+
+if __name__ == "__main__":
+    main()
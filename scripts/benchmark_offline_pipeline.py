@@ -0,0 +1,146 @@
+"""
+Runs summarization, claim extraction, QA and introspection end to end with the fake
+generator on synthetic documents. Without GPU or API calls, the wall time per stage is the
+overhead of prompt building, parsing, pandas and I/O (plus the simulated engine latency).
+
+Usage:
+python scripts/benchmark_offline_pipeline.py --n_documents 50 --n_questions 20
+python scripts/benchmark_offline_pipeline.py --profile  # top functions per stage
+python scripts/benchmark_offline_pipeline.py --engine fake:latency_s=0.05,decode_tokens_per_s=2000
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import pandas as pd
+
+from info_salience import claim_extraction, introspection, qa, summarization
+from info_salience.fake_llm import WORDS
+
+DATASETS = ["pubmed-sample", "astro-ph", "cs-cl", "qmsum-generic"]
+
+
+def synthetic_text(rng, n_sentences):
+    sentences = []
+    for _ in range(n_sentences):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 30))]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def write_inputs(root, n_documents, n_questions, seed=42):
+    rng = random.Random(seed)
+    documents = [
+        {"doc_id": f"doc{i}", "text": synthetic_text(rng, rng.randint(20, 80))}
+        for i in range(n_documents)
+    ]
+    questions = [
+        {"cluster_id": i, "centroid": synthetic_text(rng, 1)[:-1] + "?"}
+        for i in range(n_questions)
+    ]
+    for dataset in DATASETS:
+        (root / "data" / dataset).mkdir(parents=True)
+        (root / "output" / dataset).mkdir(parents=True)
+        with open(root / "data" / dataset / "documents.json", "w") as fout:
+            json.dump(documents, fout)
+        with open(root / "output" / dataset / "discord_questions.json", "w") as fout:
+            json.dump(questions, fout)
+
+
+def run_stage(name, command, args, profile):
+    print("=" * 40, name, "=" * 40)
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    command.main(args, standalone_mode=False)
+    if profiler:
+        profiler.disable()
+    wall_s = time.perf_counter() - start
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    return {"stage": name, "wall_s": round(wall_s, 2)}
+
+
+@click.command()
+@click.option("--n_documents", default=50, type=int)
+@click.option("--n_questions", default=20, type=int)
+@click.option("--profile", is_flag=True, default=False)
+@click.option(
+    "--engine",
+    default="fake",
+    help="Fake engine spec with simulated latency, e.g., fake:latency_s=0.05.",
+)
+def main(n_documents, n_questions, profile, engine):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        write_inputs(root, n_documents, n_questions)
+        # introspection reads and writes relative to the working directory
+        os.chdir(root)
+        data = root / "data" / "pubmed-sample"
+        output = root / "output" / "pubmed-sample"
+        common = ["--engine", engine, "--cache_path", ""]
+        try:
+            results = [
+                run_stage(
+                    "summarization",
+                    summarization.main,
+                    [
+                        "--input_json",
+                        str(data / "documents.json"),
+                        "--output_path",
+                        str(output / "summaries"),
+                        "--temperature",
+                        "0.3",
+                        "--n_samples",
+                        "5",
+                        *common,
+                    ],
+                    profile,
+                ),
+                run_stage(
+                    "claim_extraction",
+                    claim_extraction.main,
+                    [
+                        "--input_json",
+                        str(data / "documents.json"),
+                        "--output_json",
+                        str(output / "document_facts.json"),
+                        *common,
+                    ],
+                    profile,
+                ),
+                run_stage(
+                    "qa",
+                    qa.main,
+                    [
+                        "--documents_json",
+                        str(data / "documents.json"),
+                        "--questions_json",
+                        str(output / "discord_questions.json"),
+                        "--answers_json",
+                        str(output / "answers.json"),
+                        "--answer_facts_json",
+                        str(output / "answer_facts.json"),
+                        *common,
+                    ],
+                    profile,
+                ),
+                run_stage("introspection", introspection.main, common, profile),
+            ]
+        finally:
+            os.chdir(cwd)
+
+    print(pd.DataFrame(results).to_markdown(index=False))
+
+
+if __name__ == "__main__":
+    main()
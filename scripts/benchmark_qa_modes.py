@@ -0,0 +1,106 @@
+"""
+Compares per-question QA with joint QA (all questions of a document in one call) in terms
+of prompt tokens and wall time.
+
+Usage:
+python scripts/benchmark_qa_modes.py \
+    --documents_json data/processed/qmsum-generic/documents.json \
+    --questions_json output/qmsum-generic/discord_questions.json \
+    --n_documents 20
+"""
+
+import itertools
+import json
+import time
+
+import click
+import pandas as pd
+from transformers import AutoTokenizer
+
+from info_salience.llm import load_generator
+from info_salience.qa import (
+    is_non_answer,
+    qa_prompt,
+    qa_prompt_joint,
+    question_answering,
+    question_answering_joint,
+)
+
+MODEL = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+
+
+def count_tokens(tokenizer, contents):
+    return sum(
+        len(
+            tokenizer.apply_chat_template(
+                [{"role": "user", "content": content}], tokenize=True
+            )
+        )
+        for content in contents
+    )
+
+
+@click.command()
+@click.option("--documents_json", required=True)
+@click.option("--questions_json", required=True)
+@click.option("--n_documents", default=20, type=int)
+@click.option("--engine", default="vllm", help="Inference engine to use.")
+def main(documents_json, questions_json, n_documents, engine):
+    with open(documents_json) as fin:
+        documents = json.load(fin)[:n_documents]
+    with open(questions_json) as fin:
+        questions = json.load(fin)
+
+    pairs = list(itertools.product(documents, questions))
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    tokens_per_question = count_tokens(
+        tokenizer, [qa_prompt(doc["text"], q["centroid"]) for doc, q in pairs]
+    )
+    tokens_joint = count_tokens(
+        tokenizer, [qa_prompt_joint(doc["text"], questions) for doc in documents]
+    )
+
+    # No generation cache, so that both modes do the full work.
+    llm = load_generator(engine, MODEL, cache=None)
+    llm.fit_context(
+        [[{"role": "user", "content": qa_prompt(doc["text"], "")}] for doc in documents]
+        + [
+            [{"role": "user", "content": qa_prompt_joint(doc["text"], questions)}]
+            for doc in documents
+        ],
+        max_tokens=256 * len(questions),
+    )
+
+    start = time.perf_counter()
+    answers_per_question = question_answering(
+        llm,
+        texts=[doc["text"] for doc, _ in pairs],
+        questions=[q["centroid"] for _, q in pairs],
+    )
+    time_per_question = time.perf_counter() - start
+
+    start = time.perf_counter()
+    answers_joint = question_answering_joint(llm, documents, questions)
+    time_joint = time.perf_counter() - start
+
+    answerable_per_question = [not is_non_answer(a) for a in answers_per_question]
+    answerable_joint = [not is_non_answer(a) for a in answers_joint]
+    agreement = sum(
+        a == b for a, b in zip(answerable_per_question, answerable_joint)
+    ) / len(pairs)
+
+    df = pd.DataFrame(
+        {
+            "mode": ["per_question", "joint"],
+            "llm_calls": [len(pairs), len(documents)],
+            "prompt_tokens": [tokens_per_question, tokens_joint],
+            "wall_time_s": [round(time_per_question, 1), round(time_joint, 1)],
+            "answerable": [sum(answerable_per_question), sum(answerable_joint)],
+        }
+    )
+    print(df.to_markdown(index=False))
+    print(f"Answer/no-answer agreement: {agreement:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares serial sentence segmentation (as previously done in claim extraction) with the
+process pool and a warm segmentation cache, and checks that all produce the same sentences.
+
+Usage:
+python scripts/benchmark_segmentation.py \
+    --documents_json data/processed/qmsum-generic/documents.json \
+    --n_jobs 1 --n_jobs 4 --n_jobs 16
+"""
+
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import pandas as pd
+import pysbd
+
+from info_salience.segmentation import SegmentationCache, split_sentences
+
+
+@click.command()
+@click.option("--documents_json", required=True)
+@click.option("--n_jobs", "n_jobs_list", multiple=True, type=int, default=[1, 4, 16])
+@click.option("--chunksize", default=4, type=int)
+def main(documents_json, n_jobs_list, chunksize):
+    with open(documents_json) as fin:
+        texts = [doc["text"] for doc in json.load(fin)]
+    print(
+        f"{len(texts)} documents, {sum(map(len, texts)) / 1e6:.1f}M characters, "
+        f"{os.cpu_count()} CPUs"
+    )
+
+    rows = []
+    start = time.perf_counter()
+    seg = pysbd.Segmenter(language="en", clean=False)
+    reference = [seg.segment(text) for text in texts]
+    rows.append(("baseline (serial pysbd)", time.perf_counter() - start, True))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_jobs in n_jobs_list:
+            start = time.perf_counter()
+            sents = split_sentences(texts, n_jobs=n_jobs, chunksize=chunksize)
+            rows.append(
+                (
+                    f"pool, n_jobs={n_jobs}",
+                    time.perf_counter() - start,
+                    sents == reference,
+                )
+            )
+
+        cache = SegmentationCache(Path(tmp) / "segmentation.sqlite")
+        start = time.perf_counter()
+        sents = split_sentences(
+            texts, cache=cache, n_jobs=max(n_jobs_list), chunksize=chunksize
+        )
+        rows.append(("cold cache", time.perf_counter() - start, sents == reference))
+
+        start = time.perf_counter()
+        sents = split_sentences(
+            texts, cache=cache, n_jobs=max(n_jobs_list), chunksize=chunksize
+        )
+        rows.append(("warm cache", time.perf_counter() - start, sents == reference))
+
+    df = pd.DataFrame(rows, columns=["mode", "wall_time_s", "identical"])
+    df["speedup"] = (df["wall_time_s"].iloc[0] / df["wall_time_s"]).round(1)
+    df["wall_time_s"] = df["wall_time_s"].round(2)
+    print(df.to_markdown(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Compares per-length summarization (one call per target length) with joint summarization
+(all target lengths in one call) in terms of prefill tokens, wall time and summary length.
+Each mode runs in a fresh process with its own engine, so that the joint run does not
+reuse the prefix cache of the per-length run.
+
+Usage:
+python scripts/benchmark_summarization_modes.py \
+    --input_json data/processed/qmsum-generic/documents.json \
+    --prompt_name qmsum-generic \
+    --n_documents 20
+"""
+
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import pandas as pd
+from transformers import AutoTokenizer
+
+from info_salience.llm import load_generator
+from info_salience.summarization import (
+    JointSummarizationOutput,
+    SummarizationOutput,
+    build_messages,
+    build_messages_joint,
+    parse_response,
+)
+
+MODEL = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+LENGTHS = [10, 20, 50, 100, 200]
+
+
+def count_tokens(tokenizer, messages):
+    return sum(
+        len(tokenizer.apply_chat_template(message, tokenize=True))
+        for message in messages
+    )
+
+
+def mean_words(summaries):
+    return pd.Series([len((s or "").split()) for s in summaries]).mean().round(1)
+
+
+def run_mode(mode, input_json, prompt_name, n_documents, engine):
+    """Wall time and mean summary lengths of `mode`, with a new engine."""
+    df = pd.read_json(input_json).head(n_documents)
+    # No generation cache, so that both modes do the full work.
+    llm = load_generator(engine, MODEL, cache=None)
+
+    start = time.perf_counter()
+    if mode == "joint":
+        messages = build_messages_joint(df, prompt_name, LENGTHS)
+        llm.fit_context(messages, max_tokens=2048)
+        responses = llm.generate(
+            messages,
+            schema=JointSummarizationOutput,
+            temperature=0,
+            max_tokens=2048,
+        )
+        summaries = {
+            length: [
+                parse_response(r[0], key=f"summary_{length}w") if r else None
+                for r in responses
+            ]
+            for length in LENGTHS
+        }
+    else:
+        llm.fit_context(build_messages(df, prompt_name, max(LENGTHS)), max_tokens=1024)
+        summaries = {}
+        for length in LENGTHS:
+            responses = llm.generate(
+                build_messages(df, prompt_name, length),
+                schema=SummarizationOutput,
+                temperature=0,
+                max_tokens=1024,
+            )
+            summaries[length] = [
+                parse_response(r[0], key="summary") if r else None for r in responses
+            ]
+    wall_time = time.perf_counter() - start
+    return wall_time, {length: mean_words(summaries[length]) for length in LENGTHS}
+
+
+@click.command()
+@click.option("--input_json", required=True)
+@click.option("--prompt_name", default="generic")
+@click.option("--n_documents", default=20, type=int)
+@click.option("--engine", default="vllm", help="Inference engine to use.")
+def main(input_json, prompt_name, n_documents, engine):
+    df = pd.read_json(input_json).head(n_documents)
+    messages_per_length = {
+        length: build_messages(df, prompt_name, length) for length in LENGTHS
+    }
+    messages_joint = build_messages_joint(df, prompt_name, LENGTHS)
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    tokens_per_length = sum(
+        count_tokens(tokenizer, messages) for messages in messages_per_length.values()
+    )
+    tokens_joint = count_tokens(tokenizer, messages_joint)
+
+    results = {}
+    for mode in ["per_length", "joint"]:
+        # the engine (and its GPU memory) is released when the process exits
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results[mode] = executor.submit(
+                run_mode, mode, input_json, prompt_name, n_documents, engine
+            ).result()
+
+    df_report = pd.DataFrame(
+        {
+            "mode": ["per_length", "joint"],
+            "llm_calls": [len(df) * len(LENGTHS), len(df)],
+            "prefill_tokens": [tokens_per_length, tokens_joint],
+            "wall_time_s": [
+                round(results["per_length"][0], 1),
+                round(results["joint"][0], 1),
+            ],
+            **{
+                f"words_{length}w": [
+                    results["per_length"][1][length],
+                    results["joint"][1][length],
+                ]
+                for length in LENGTHS
+            },
+        }
+    )
+    print(df_report.to_markdown(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,14 +15,6 @@ export LC_ALL=C
 export OMP_NUM_THREADS=1
 export OUTLINES_CACHE_DIR=/tmp/outlines-$SLURM_JOB_ID
 
-FACTS_PATH=$1
-TASKS_PATH=$2
-
-# Read the file path corresponding to this array job
-task_file=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "$TASKS_PATH")
-
-echo "Run claim entailment on summaries: $task_file"
-
-python -m info_salience.claim_entailment \
-    --facts_path "$FACTS_PATH" \
-    --summaries_path "$task_file"
+# Each array task is a worker which claims shards until the queue is empty
+# (see scripts/claim_entailment_task_list.sh).
+python -m info_salience.work_queue worker --stages claim_entailment
@@ -0,0 +1,20 @@
+#!/bin/bash
+
+#SBATCH --time=02:00:00
+#SBATCH --cpus-per-task=16
+#SBATCH --nodes=1
+#SBATCH --partition=owner_fb12
+#SBATCH --mem-per-cpu=2G
+
+module purge
+module load miniconda
+source $CONDA_ROOT/bin/activate base
+conda activate info-salience
+export LC_ALL=C
+export OMP_NUM_THREADS=1
+
+# CPU workers for baseline summaries, enqueued in a separate queue with:
+# python -m info_salience.work_queue --queue_path .cache/work_queue_cpu.sqlite \
+#     add-entailment --dataset <dataset> --facts_path <facts> --baselines_only \
+#     -- --nli_model roberta-large --device cpu --n_jobs 0
+python -m info_salience.work_queue --queue_path .cache/work_queue_cpu.sqlite worker --stages claim_entailment
@@ -2,40 +2,11 @@
 
 DATASET=$1
 FACTS_PATH=$2
+FILES_PER_SHARD=${3:-10}
 
-filename=$(basename "$FACTS_PATH")
+# Enqueue the summary files without an output, scored in batches of FILES_PER_SHARD files
+python -m info_salience.work_queue add-entailment --dataset "$DATASET" --facts_path "$FACTS_PATH" --files_per_shard "$FILES_PER_SHARD"
+python -m info_salience.work_queue status
 
-if [ "$filename" == "facts.json" ]; then
-    out_dir="nli"
-elif [ "$filename" == "discord_facts.json" ]; then
-    out_dir="discord-qa-nli"
-else
-    echo "Unknown facts type."
-    exit 1
-fi
-
-# Generate a list of input files
-SUMMARIES_FILES=(output/$DATASET/*/summaries/{temperature*-*,output*}.json)
-# SUMMARIES_FILES=(output/$DATASET/*/summaries/{temperature0.3-,temperature0.7-,output}*.json)
-
-task_list="entailment_tasks_$DATASET.txt"
-> "$task_list"  # Clear the file list
-
-for file in "${SUMMARIES_FILES[@]}"; do
-    # Skip summary files for which we already have an output
-    # Below subsitutes "summaries" in the file path with $out_dir
-    output_file="${file/summaries/$out_dir}"
-    if [[ -e "$output_file" ]]; then
-        continue
-    fi
-    echo "$file" >> "$task_list"
-done
-
-# Count the number of valid input files
-FILE_COUNT=$(wc -l < "$task_list")
-
-# Submit the job array, where each job processes a different file
-echo "Tasks: $FILE_COUNT"
-echo "Task file: $task_list"
-echo "Use the following command to start the job array:"
-echo sbatch --array=0-$(($FILE_COUNT - 1))%20 scripts/claim_entailment_array.sh $FACTS_PATH $task_list
+echo "Use the following command to start 20 workers:"
+echo sbatch --array=0-19 scripts/claim_entailment_array.sh
@@ -17,7 +17,11 @@ export OUTLINES_CACHE_DIR=/tmp/outlines-$(date +%s | sha256sum | base64 | head -
 # Set this for tensor_parallel_size >= 2, See: https://github.com/vllm-project/vllm/issues/6152
 export VLLM_WORKER_MULTIPROC_METHOD=spawn
 
-if [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+if [ -n "$SLURM_ARRAY_TASK_ID" ] && [ -n "$WORK_QUEUE" ]; then
+    # Each array task is a worker of the queue. Enqueue the shards beforehand (see `make temperature_sweep`):
+    # python -m info_salience.work_queue add summarization --grid temperature=0,0.25,0.5,0.75,1 -- <args>
+    python -m info_salience.work_queue --queue_path "$WORK_QUEUE" worker --stages summarization
+elif [ -n "$SLURM_ARRAY_TASK_ID" ]; then
     # Calculate temperature in a slurm array job
     temperature=$(echo "(1/($SLURM_ARRAY_TASK_COUNT-1)) * $SLURM_ARRAY_TASK_ID" | bc -l)
     python -m info_salience.summarization --temperature $temperature "$@"
@@ -0,0 +1,475 @@
+"""
+Adaptive document sampling for LLM-observed salience.
+
+Instead of summarizing, answering and checking every document of a dataset, documents are
+processed in random mini-batches. After each batch, the salience of each question
+(cluster_id) is re-estimated as in `info_salience.salience`: the entailment of its answer
+claims in the summaries is averaged per document (and summary sample), then over documents.
+Sampling stops once the ranking of questions is stable: a lower quantile of the Spearman
+correlation between the previous estimate and bootstrap estimates over the processed
+documents is at least `1 - tolerance`.
+
+python -m info_salience.adaptive \
+    --documents_json data/processed/qmsum-generic/documents.json \
+    --questions_json output/qmsum-generic/discord_questions.json \
+    --answer_facts_json output/qmsum-generic/discord_facts.json \
+    --prompt_name qmsum-generic \
+    --output_path output/qmsum-generic/Meta-Llama-3.1-8B-Instruct/adaptive/
+"""
+
+import json
+from functools import partial
+from pathlib import Path
+from pprint import pprint
+
+import click
+import numpy as np
+import pandas as pd
+
+from info_salience.agreement import spearman_rank_correlation
+from info_salience.claim_entailment import (
+    DEFAULT_NLI_CACHE_PATH,
+    NLI_MODEL,
+    LazyMiniCheck,
+    NLICache,
+    score_entailment,
+)
+from info_salience.llm import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SERVER_URL,
+    GenerationCache,
+    load_generator,
+    parse_engine,
+)
+from info_salience.qa import (
+    answer_questions,
+    decompose_answers,
+    fit_decompose_context,
+    fit_qa_context,
+)
+from info_salience.summarization import (
+    JointSummarizationOutput,
+    SummarizationOutput,
+    build_messages,
+    build_messages_joint,
+    summarize,
+)
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    read_table,
+    table_exists,
+    write_table,
+)
+
+QA_MODEL = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+LENGTHS = [10, 20, 50, 100, 200]
+
+
+def salience_matrices(df_nli, doc_ids, cluster_ids, columns):
+    """
+    Per-document entailment of each question, as in `average_entailment_by_question`.
+
+    Labels are averaged per (summary sample, document, question). Returns the sums of
+    these means over samples and the number of samples with a mean, both with shape
+    (documents, questions, columns). Missing labels (e.g., no summary) are not counted.
+    """
+    doc_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+    cluster_index = {cluster_id: i for i, cluster_id in enumerate(cluster_ids)}
+    sums = np.zeros((len(doc_ids), len(cluster_ids), len(columns)))
+    counts = np.zeros_like(sums)
+    by = ["doc_id", "cluster_id"] + (["sample"] if "sample" in df_nli.columns else [])
+    df_means = df_nli.groupby(by)[columns].mean().reset_index()
+    for (doc_id, cluster_id), group in df_means.groupby(["doc_id", "cluster_id"]):
+        values = group[columns].to_numpy(dtype=float)
+        d, k = doc_index[doc_id], cluster_index[cluster_id]
+        sums[d, k] = np.nansum(values, axis=0)
+        counts[d, k] = (~np.isnan(values)).sum(axis=0)
+    return sums, counts
+
+
+def estimate_salience(sums, counts, weights=None):
+    """
+    Mean over documents of the per-document entailment, weighting documents by
+    `weights`, which has shape (documents,) or (bootstrap samples, documents).
+    Questions without any claim have salience NaN.
+    """
+    if weights is None:
+        weights = np.ones(sums.shape[0])
+    total = np.tensordot(weights, sums, axes=(-1, 0))
+    n = np.tensordot(weights, counts, axes=(-1, 0))
+    return np.divide(total, n, out=np.full_like(total, np.nan), where=n > 0)
+
+
+def rank_agreement(a, b):
+    """
+    Spearman correlation of two (questions, columns) estimates, averaged over columns.
+    Only questions with salience in both estimates are compared.
+    """
+    scores = []
+    for x, y in zip(a.T, b.T):
+        mask = ~np.isnan(x) & ~np.isnan(y)
+        x, y = x[mask], y[mask]
+        if len(x) > 0 and np.array_equal(x, y):
+            scores.append(1.0)
+            continue
+        if len(x) < 2:
+            scores.append(0.0)
+            continue
+        score = spearman_rank_correlation(x, y)
+        # undefined if one of the estimates is constant
+        scores.append(0.0 if np.isnan(score) else score)
+    return float(np.mean(scores))
+
+
+def bootstrap_stability(sums, counts, previous, n_bootstrap=200, rng=None):
+    """
+    Spearman correlations between `previous` and the salience estimated on bootstrap
+    resamples of the documents.
+    """
+    rng = rng or np.random.default_rng()
+    # documents are resampled, with all their claims and summary samples
+    n_docs = sums.shape[0]
+    weights = rng.multinomial(n_docs, [1 / n_docs] * n_docs, size=n_bootstrap)
+    estimates = estimate_salience(sums, counts, weights)
+    return np.array([rank_agreement(previous, estimate) for estimate in estimates])
+
+
+def entailment_for_batch(
+    scorer, df_facts, summaries_by_length, doc_ids, n_samples, cache=None
+):
+    """Checks the answer claims of the batch documents against each summary sample."""
+    summary_cols = [f"summary_{length}w" for length in summaries_by_length]
+    result_cols = ["doc_id", "cluster_id", "question", "sent_id", "sent", "fact"]
+    dfs = []
+    for i in range(n_samples):
+        df_summaries = pd.DataFrame(
+            {
+                "doc_id": doc_ids,
+                **{
+                    f"summary_{length}w": [s[i] for s in summaries]
+                    for length, summaries in summaries_by_length.items()
+                },
+            }
+        )
+        df = pd.merge(df_facts, df_summaries, on="doc_id", how="inner", validate="m:1")
+        if df.empty:
+            continue
+        df_out = score_entailment(scorer, df, summary_cols, result_cols, cache=cache)
+        df_out["sample"] = i
+        dfs.append(df_out)
+    if not dfs:
+        return pd.DataFrame(
+            columns=result_cols + [c + "_nli_pred" for c in summary_cols]
+        )
+    return pd.concat(dfs, ignore_index=True)
+
+
+@click.command()
+@click.option("--documents_json", required=True, help="Path to documents.")
+@click.option("--questions_json", required=True, help="Path to discord questions.")
+@click.option(
+    "--answer_facts_json",
+    default=None,
+    help="Precomputed answer claims (see info_salience.qa). If missing, the answers "
+    "of the sampled documents are generated along the way.",
+)
+@click.option("--output_path", required=True, help="Path to output directory.")
+@click.option(
+    "--model",
+    default="meta-llama/Meta-Llama-3.1-8B-Instruct",
+    help="Model name to be used for summarization.",
+)
+@click.option(
+    "--engine",
+    default="vllm",
+    help="Inference engine to use (vllm|litellm|server|fake|replay|record:<engine>).",
+)
+@click.option(
+    "--server_url",
+    default=DEFAULT_SERVER_URL,
+    help="URL of the generation server (--engine server).",
+)
+@click.option(
+    "--qa_model",
+    default=QA_MODEL,
+    help="Model which answers the questions if --answer_facts_json is not given.",
+)
+@click.option(
+    "--qa_server_url",
+    default=None,
+    help="URL of the generation server of --qa_model if it differs from --model "
+    "(--engine server). Defaults to --server_url.",
+)
+@click.option(
+    "--cache_path",
+    default=DEFAULT_CACHE_PATH,
+    help="Path to the generation cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--nli_cache_path",
+    default=DEFAULT_NLI_CACHE_PATH,
+    help="Path to the NLI cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--gpu_memory_utilization",
+    default=0.45,
+    type=float,
+    help=(
+        "GPU memory fraction of the vLLM generator. The NLI model gets the rest, up to "
+        "a total of 0.9."
+    ),
+)
+@click.option("--prompt_name", default="generic", help="Name of the prompt to use.")
+@click.option(
+    "--prompt_mode",
+    default="per_length",
+    type=click.Choice(["per_length", "joint"]),
+    help="One call per target length, or all target lengths in one structured call.",
+)
+@click.option("--temperature", default=0.3, type=float, help="Sampling temperature.")
+@click.option("--n_samples", default=1, type=int, help="Number of output samples.")
+@click.option("--batch_size", default=20, type=int, help="Documents per mini-batch.")
+@click.option(
+    "--min_documents",
+    default=40,
+    type=int,
+    help="Minimum number of documents before sampling may stop.",
+)
+@click.option(
+    "--tolerance",
+    default=0.05,
+    type=float,
+    help="Stop once the bootstrap Spearman quantile is at least 1 - tolerance.",
+)
+@click.option(
+    "--quantile",
+    default=0.05,
+    type=float,
+    help="Quantile of the bootstrap Spearman distribution used as stopping criterion.",
+)
+@click.option("--n_bootstrap", default=200, type=int, help="Bootstrap resamples.")
+@click.option(
+    "--seed", default=42, type=int, help="Seed of document order and bootstrap."
+)
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
+def main(
+    documents_json,
+    questions_json,
+    answer_facts_json,
+    output_path,
+    model,
+    engine,
+    server_url,
+    qa_model,
+    qa_server_url,
+    cache_path,
+    nli_cache_path,
+    gpu_memory_utilization,
+    prompt_name,
+    prompt_mode,
+    temperature,
+    n_samples,
+    batch_size,
+    min_documents,
+    tolerance,
+    quantile,
+    n_bootstrap,
+    seed,
+    output_format,
+):
+    pprint(locals())
+    output_path = Path(output_path)
+    output_path.mkdir(exist_ok=True, parents=True)
+    dataset = Path(documents_json).parent.name
+
+    df_docs = pd.read_json(documents_json)
+    with open(questions_json) as fin:
+        questions = json.load(fin)
+    cluster_ids = [question["cluster_id"] for question in questions]
+    columns = [f"summary_{length}w_nli_pred" for length in LENGTHS]
+
+    df_facts_all = None
+    if answer_facts_json and table_exists(answer_facts_json):
+        df_facts_all = read_table(answer_facts_json)
+    engine_name = parse_engine(engine.removeprefix("record:"))[0]
+    if df_facts_all is None and qa_model != model and engine_name == "vllm":
+        # a second engine does not fit next to the summarization engine and MiniCheck
+        raise click.UsageError(
+            f"Answering with {qa_model} next to {model} needs a second vLLM engine, "
+            "which does not fit into GPU memory. Pass --answer_facts_json, answer with "
+            f"the summarization engine (--qa_model {model}), or serve both models "
+            "(--engine server and --qa_server_url)."
+        )
+
+    cache = GenerationCache(cache_path) if cache_path else None
+    llm = load_generator(
+        engine,
+        model,
+        cache=cache,
+        server_url=server_url,
+        gpu_memory_utilization=gpu_memory_utilization,
+    )
+    llm.telemetry.tags["dataset"] = dataset
+    # The engine is sized by the first generation, so it is fitted to the prompts of all
+    # documents up front rather than to the first batch.
+    if prompt_mode == "joint":
+        schema = JointSummarizationOutput
+        max_tokens = 2048
+        llm.fit_context(
+            build_messages_joint(df_docs, prompt_name, LENGTHS), max_tokens=max_tokens
+        )
+    else:
+        schema = SummarizationOutput
+        max_tokens = 1024
+        llm.fit_context(
+            build_messages(df_docs, prompt_name, max(LENGTHS)), max_tokens=max_tokens
+        )
+    if llm.engine == "litellm":
+        llm_generate = llm.generate
+    else:
+        llm_generate = partial(llm.generate, schema=schema)
+    qa_llm = None
+    if df_facts_all is None:
+        if qa_model == model:
+            qa_llm = llm
+        else:
+            qa_llm = load_generator(
+                engine,
+                qa_model,
+                cache=cache,
+                server_url=qa_server_url or server_url,
+            )
+        qa_llm.telemetry.tags["dataset"] = dataset
+        fit_qa_context(qa_llm, df_docs["text"].tolist(), questions)
+        fit_decompose_context(qa_llm)
+    # MiniCheck runs on vLLM as well and gets the GPU memory left by the generator
+    nli_memory_utilization = 0.9
+    if engine_name == "vllm":
+        nli_memory_utilization -= gpu_memory_utilization
+    scorer = LazyMiniCheck(
+        NLI_MODEL,
+        enable_prefix_caching=True,
+        gpu_memory_utilization=round(nli_memory_utilization, 2),
+    )
+    nli_cache = NLICache(nli_cache_path) if nli_cache_path else None
+
+    # random document order, processed in mini-batches
+    df_docs = df_docs.sample(frac=1, random_state=seed).reset_index(drop=True)
+    rng = np.random.default_rng(seed)
+    nli_batches = []
+    summary_batches = []
+    convergence = []
+    previous = None
+    converged = False
+    n_processed = 0
+    for start in range(0, len(df_docs), batch_size):
+        batch = df_docs.iloc[start : start + batch_size]
+        doc_ids = batch["doc_id"].tolist()
+        n_processed += len(batch)
+        print(f"Batch: documents {n_processed}/{len(df_docs)}", flush=True)
+
+        llm.telemetry.tags["stage"] = "adaptive_summarization"
+        summaries_by_length = summarize(
+            llm_generate,
+            batch,
+            prompt_name,
+            LENGTHS,
+            prompt_mode=prompt_mode,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n_samples=n_samples,
+        )
+        summary_batches.append(
+            pd.DataFrame(
+                {
+                    "doc_id": doc_ids,
+                    **{
+                        f"summary_{length}w": summaries
+                        for length, summaries in summaries_by_length.items()
+                    },
+                }
+            )
+        )
+
+        if df_facts_all is not None:
+            df_facts = df_facts_all[df_facts_all["doc_id"].isin(doc_ids)]
+        else:
+            qa_llm.telemetry.tags["stage"] = "adaptive_qa"
+            df_answers = answer_questions(
+                qa_llm, batch.to_dict(orient="records"), questions
+            )
+            qa_llm.telemetry.tags["stage"] = "adaptive_qa_claim_extraction"
+            df_facts, _ = decompose_answers(qa_llm, df_answers)
+
+        nli_batches.append(
+            entailment_for_batch(
+                scorer,
+                df_facts,
+                summaries_by_length,
+                doc_ids,
+                n_samples,
+                cache=nli_cache,
+            )
+        )
+        df_nli = pd.concat(nli_batches, ignore_index=True)
+
+        processed_ids = df_docs["doc_id"].iloc[:n_processed].tolist()
+        sums, counts = salience_matrices(df_nli, processed_ids, cluster_ids, columns)
+        estimate = estimate_salience(sums, counts)
+        record = {"documents": n_processed}
+        if previous is not None:
+            scores = bootstrap_stability(
+                sums, counts, previous, n_bootstrap=n_bootstrap, rng=rng
+            )
+            record["spearman_mean"] = float(scores.mean())
+            record["spearman_quantile"] = float(np.quantile(scores, quantile))
+            converged = (
+                n_processed >= min_documents
+                and record["spearman_quantile"] >= 1 - tolerance
+            )
+            print(
+                f"Rank stability: mean={record['spearman_mean']:.3f}, "
+                f"q{quantile:g}={record['spearman_quantile']:.3f} "
+                f"(target: {1 - tolerance:.3f})",
+                flush=True,
+            )
+        convergence.append(record)
+        previous = estimate
+        llm.telemetry.flush(output_path / "telemetry.jsonl")
+        if qa_llm is not None and qa_llm is not llm:
+            qa_llm.telemetry.flush(output_path / "telemetry.jsonl")
+        if converged:
+            break
+
+    print(
+        f"{'Converged' if converged else 'Did not converge'} after {n_processed}/"
+        f"{len(df_docs)} documents ({n_processed / len(df_docs):.0%})."
+    )
+    df_salience = pd.DataFrame(estimate, columns=columns)
+    df_salience.insert(0, "cluster_id", cluster_ids)
+    write_table(df_salience, output_path / "salience.json", output_format)
+    write_table(
+        pd.concat(summary_batches, ignore_index=True),
+        output_path / "summaries.json",
+        output_format,
+    )
+    write_table(df_nli, output_path / "nli.json", output_format)
+    write_table(
+        pd.DataFrame(convergence), output_path / "convergence.json", output_format
+    )
+
+    if cache is not None:
+        print(f"Generation cache: {cache.stats()}")
+    if nli_cache is not None:
+        print(f"NLI cache: {nli_cache.stats()}")
+    llm.telemetry.print_summary(by=("stage", "dataset"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+def content_hash(*parts):
+    """Stable sha256 over JSON-serializable parts."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    Persistent key-value store backed by SQLite.
+
+    The rollback journal is used instead of WAL, as the caches live on the shared
+    filesystem of the cluster, where WAL does not work. Values are JSON-serialized.
+    When `max_size_bytes` is set, the least recently used entries are evicted once the
+    total payload exceeds that size. Reads do not write: access times of hits are
+    buffered and written with the next `put_many`, or at most every `touch_interval`
+    seconds.
+    """
+
+    def __init__(self, path, max_size_bytes=None, timeout=60, touch_interval=60):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.touch_interval = touch_interval
+        self._touched = {}
+        self._last_touch = time.time()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=timeout, check_same_thread=False
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        self._conn.commit()
+        # Running total of the payload size, so that puts need not sum over all entries
+        (self._size_bytes,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+
+    def _select(self, columns, keys):
+        # SQLite limits the number of host parameters per statement
+        rows = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows += self._conn.execute(
+                f"SELECT {columns} FROM entries WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+        return rows
+
+    def get_many(self, keys):
+        """Returns a dict with the values of all keys that are present."""
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            rows = self._select("key, value", unique)
+            found.update((key, json.loads(value)) for key, value in rows)
+
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            if self._touched and now - self._last_touch >= self.touch_interval:
+                self._flush_touched()
+                self._conn.commit()
+
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value, ensure_ascii=False)
+            rows.append((key, value, len(value.encode("utf-8")), now))
+
+        with self._lock:
+            replaced = self._select("size", list(items))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._flush_touched()
+            self._conn.commit()
+            self._size_bytes += sum(row[2] for row in rows)
+            self._size_bytes -= sum(size for (size,) in replaced)
+            if self.max_size_bytes and self._size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._touched.items()],
+            )
+            self._touched = {}
+        self._last_touch = time.time()
+
+    def _evict(self):
+        # Other processes may have written or evicted since the total was last synced
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        self._size_bytes = total
+        if total <= self.max_size_bytes:
+            return
+
+        excess = total - self.max_size_bytes
+        stale = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed ASC"
+        ):
+            stale.append((key,))
+            excess -= size
+            self._size_bytes -= size
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", stale)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        return count
+
+    def size_bytes(self):
+        with self._lock:
+            (total,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return total
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 4),
+            "entries": len(self),
+            "size_bytes": self.size_bytes(),
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
@@ -1,62 +1,318 @@
 import argparse
+import glob
+import json
+import random
 from pathlib import Path
 
 import pandas as pd
 from minicheck.minicheck import MiniCheck
 
+from info_salience.cache import DiskCache, content_hash
+from info_salience.nli_cpu import CPU_BACKENDS, CPU_MODELS, CPUMiniCheck, check_backend
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    read_table,
+    table_exists,
+    write_table,
+)
+
+# other minicheck models: ['roberta-large', 'deberta-v3-large', 'flan-t5-large', 'Bespoke-MiniCheck-7B']
+# https://github.com/Liyan06/MiniCheck/tree/main
+NLI_MODEL = "Bespoke-MiniCheck-7B"
+CASCADE_MODELS = ["roberta-large", "deberta-v3-large", "flan-t5-large"]
+DEFAULT_NLI_CACHE_PATH = ".cache/nli.sqlite"
+
+
+class NLICache(DiskCache):
+    """MiniCheck `[label, probability]` per (model, premise, claim)."""
+
+    def __init__(self, path=DEFAULT_NLI_CACHE_PATH):
+        super().__init__(path)
+
+    def key(self, model, premise, claim):
+        return nli_key(model, premise, claim)
+
+
+def nli_key(model, premise, claim):
+    return content_hash(model, premise, claim)
+
+
+class LazyMiniCheck:
+    """Loads MiniCheck on first use, such that fully cached inputs never load the model."""
+
+    def __init__(self, model_name=NLI_MODEL, **kwargs):
+        self.model_name = model_name
+        self.model_id = model_name
+        self.kwargs = kwargs
+        self._scorer = None
+
+    def score(self, docs, claims):
+        if self._scorer is None:
+            self._scorer = MiniCheck(model_name=self.model_name, **self.kwargs)
+        return self._scorer.score(docs=docs, claims=claims)
+
+
+def score_pairs(scorer, docs, claims, cache=None, model=NLI_MODEL):
+    """
+    Returns the labels and probabilities of (premise, claim) pairs, and whether each pair
+    was cached. Unique pairs which are not cached are scored in one call, sorted by
+    premise such that batches have similar lengths and share their prompt prefix.
+    """
+    keys = [nli_key(model, doc, claim) for doc, claim in zip(docs, claims)]
+    found = cache.get_many(keys) if cache is not None else {}
+    cached = [key in found for key in keys]
+    missing = {
+        key: (doc, claim)
+        for key, doc, claim in zip(keys, docs, claims)
+        if key not in found
+    }
+    if missing:
+        order = sorted(
+            missing, key=lambda k: (len(missing[k][0]), missing[k][0], missing[k][1])
+        )
+        labels, probas, _, _ = scorer.score(
+            docs=[missing[key][0] for key in order],
+            claims=[missing[key][1] for key in order],
+        )
+        scored = {
+            key: [int(label), float(proba)]
+            for key, label, proba in zip(order, labels, probas)
+        }
+        if cache is not None:
+            cache.put_many(scored)
+        found.update(scored)
+    labels = [found[key][0] for key in keys]
+    probas = [found[key][1] for key in keys]
+    return labels, probas, cached
+
+
+def load_scorer(model_name, args):
+    """MiniCheck on GPU, or the CPU scorer for smaller models with `--device cpu`."""
+    if args.device == "cpu" and model_name in CPU_MODELS:
+        return CPUMiniCheck(
+            model_name,
+            backend=args.cpu_backend,
+            n_jobs=args.n_jobs,
+            threads=args.threads,
+            batch_size=args.batch_size,
+        )
+    if model_name == NLI_MODEL:
+        return LazyMiniCheck(model_name, enable_prefix_caching=True)
+    return LazyMiniCheck(model_name)
+
+
+def entailment_pairs(df, summary_cols):
+    """(summary, fact) pairs of all summary columns, skipping facts without summary."""
+    docs = []
+    claims = []
+    masks = {}
+    for target_length in summary_cols:
+        mask = df[target_length].notna()
+        masks[target_length] = mask
+        docs += df.loc[mask, target_length].tolist()
+        claims += df.loc[mask, "fact"].tolist()
+    return docs, claims, masks
+
+
+def assign_labels(df_out, masks, labels, suffix="_nli_pred", default=0):
+    """Scatters the labels of `entailment_pairs` into `<summary_col><suffix>` columns."""
+    offset = 0
+    for target_length, mask in masks.items():
+        n = int(mask.sum())
+        df_out[target_length + suffix] = default
+        df_out.loc[mask, target_length + suffix] = labels[offset : offset + n]
+        offset += n
+
+        # when premise is nan, reset the NLI label to nan.
+        df_out.loc[~mask, target_length + suffix] = None
+    return df_out
+
+
+def agreement(a, b):
+    return sum(x == y for x, y in zip(a, b)) / len(a) if a else None
+
+
+def score_pairs_cascade(
+    small_scorer,
+    large_scorer,
+    docs,
+    claims,
+    small_model,
+    band=(0.2, 0.8),
+    cache=None,
+    calibration_size=500,
+    seed=0,
+):
+    """
+    Scores all pairs with a small checker, and escalates pairs whose probability lies
+    within `band` to the large checker (`NLI_MODEL`). A random calibration sample is
+    scored by both, to compare the cascade with large-only labels.
+
+    Returns the labels, the model which decided each label, whether the small checker's
+    result was cached, and an agreement report.
+    """
+    labels, probas, cached = score_pairs(
+        small_scorer, docs, claims, cache=cache, model=small_model
+    )
+    tiers = [small_model] * len(docs)
+    low, high = band
+    uncertain = [i for i, proba in enumerate(probas) if low <= proba <= high]
+    rng = random.Random(seed)
+    calibration = rng.sample(range(len(docs)), min(calibration_size, len(docs)))
+
+    escalate = sorted(set(uncertain) | set(calibration))
+    large_labels, _, _ = score_pairs(
+        large_scorer,
+        [docs[i] for i in escalate],
+        [claims[i] for i in escalate],
+        cache=cache,
+        model=NLI_MODEL,
+    )
+    large_labels = dict(zip(escalate, large_labels))
+    small_labels = list(labels)
+    for i in uncertain:
+        labels[i] = large_labels[i]
+        tiers[i] = NLI_MODEL
+
+    confident = [i for i in calibration if tiers[i] == small_model]
+    report = {
+        "small_model": small_model,
+        "large_model": NLI_MODEL,
+        "band": [low, high],
+        "pairs": len(docs),
+        "escalated": len(uncertain),
+        "escalated_rate": len(uncertain) / len(docs) if docs else None,
+        "calibration_pairs": len(calibration),
+        # agreement with large-only labels on the calibration sample
+        "agreement_cascade": agreement(
+            [labels[i] for i in calibration], [large_labels[i] for i in calibration]
+        ),
+        "agreement_small_only": agreement(
+            [small_labels[i] for i in calibration],
+            [large_labels[i] for i in calibration],
+        ),
+        "agreement_confident": agreement(
+            [labels[i] for i in confident], [large_labels[i] for i in confident]
+        ),
+    }
+    return labels, tiers, cached, report
+
+
+def score_entailment(scorer, df, summary_cols, result_cols, cache=None):
+    """
+    Checks every fact against the summaries in `summary_cols`.
+
+    `df` holds one row per fact with the summaries of its document. Returns `result_cols`
+    and one `<summary_col>_nli_pred` label column per summary column. The pairs of all
+    summary columns are scored in one call, and facts without summary get no label.
+    """
+    docs, claims, masks = entailment_pairs(df, summary_cols)
+    labels, _, _ = score_pairs(scorer, docs, claims, cache=cache)
+    return assign_labels(df[result_cols].copy(), masks, labels)
+
+
+def expand_paths(patterns):
+    """Expands glob patterns. Files stored in both formats are returned once."""
+    paths = []
+    for pattern in patterns:
+        matches = glob.glob(pattern) + glob.glob(
+            str(Path(pattern).with_suffix(".parquet"))
+        )
+        paths += sorted(matches) if glob.has_magic(pattern) else [pattern]
+    return list(dict.fromkeys(str(Path(p).with_suffix(".json")) for p in paths))
+
 
 def main(args):
-    facts_path = Path(args.facts_path)
+    # stage outputs are named by their JSON path, even when stored as Parquet
+    facts_path = Path(args.facts_path).with_suffix(".json")
     if facts_path.name == "facts.json":
         out_dir = "nli"
+        result_cols = ["doc_id", "sent_id", "fact"]
     elif facts_path.name == "discord_facts.json":
         out_dir = "discord-qa-nli"
+        result_cols = ["doc_id", "cluster_id", "question", "sent_id", "sent", "fact"]
     else:
         raise ValueError("Unknown facts type.")
 
-    summaries_path = Path(args.summaries_path)
-    out_file = summaries_path.parent.parent / out_dir / summaries_path.name
-    out_file.parent.mkdir(exist_ok=True, parents=True)
-    if out_file.exists():
-        print(f"Already exist: {out_file}. Skip.")
-        return
-
     # df_facts:     | doc_id | sent_id | fact |
     # df_summaries: | doc_id | summary_10w | summary_20w | ... |
-    df_facts = pd.read_json(args.facts_path)
-    df_summaries = pd.read_json(args.summaries_path)
-
-    df = pd.merge(df_facts, df_summaries, on="doc_id", how="left", validate="m:1")
-    assert len(df_facts) == len(df)
+    df_facts = None
+    jobs = []
+    for summaries_path in map(Path, expand_paths(args.summaries_path)):
+        out_file = summaries_path.parent.parent / out_dir / summaries_path.name
+        if table_exists(out_file):
+            print(f"Already exist: {out_file}. Skip.")
+            continue
 
-    # other minicheck models: ['roberta-large', 'deberta-v3-large', 'flan-t5-large', 'Bespoke-MiniCheck-7B']
-    # https://github.com/Liyan06/MiniCheck/tree/main
-    scorer = MiniCheck(model_name="Bespoke-MiniCheck-7B", enable_prefix_caching=True)
+        if df_facts is None:
+            df_facts = read_table(args.facts_path)
+        df_summaries = read_table(summaries_path)
+        df = pd.merge(df_facts, df_summaries, on="doc_id", how="left", validate="m:1")
+        assert len(df_facts) == len(df)
 
-    # get the summary columns (summary_10w, summary_20w, ...)
-    summary_cols = [c for c in df.columns if c.startswith("summary_") and not c.startswith('summary_e')]
-    print(summary_cols)
+        # get the summary columns (summary_10w, summary_20w, ...)
+        summary_cols = [
+            c
+            for c in df.columns
+            if c.startswith("summary_") and not c.startswith("summary_e")
+        ]
+        print(summaries_path, summary_cols)
+        docs, claims, masks = entailment_pairs(df, summary_cols)
+        # new frame for storing only the classification labels
+        df_out = df[result_cols].copy()
+        jobs.append((out_file, df_out, masks, docs, claims))
 
-    # new frame for storing only the classification labels
-    if out_dir == "nli":
-        result_cols = ["doc_id", "sent_id", "fact"]
-    elif out_dir == "discord-qa-nli":
-        result_cols = ["doc_id", "cluster_id", "question", "sent_id", "sent", "fact"]
-    df_out = df[result_cols].copy()
-
-    for target_length in summary_cols:
-        docs = df[target_length].fillna("").tolist()
-        claims = df["fact"].tolist()
-        labels, probas, _, _ = scorer.score(docs=docs, claims=claims)
-        df_out[target_length + "_nli_pred"] = labels
-        # df_out[target_length + "_nli_proba"] = probas
+    if not jobs:
+        return
 
-        # when premise is nan, reset the NLI label to nan.
-        na_mask = df[target_length].isna()
-        df_out.loc[na_mask, target_length + "_nli_pred"] = None
-        # df_out.loc[na_mask, target_length + "_nli_proba"] = None
+    # All (file, column, fact) pairs are scored as one stream by a single scorer.
+    scorer = load_scorer(args.nli_model, args)
+    cache = NLICache(args.nli_cache_path) if args.nli_cache_path else None
+    all_docs = [doc for _, _, _, docs, _ in jobs for doc in docs]
+    all_claims = [claim for _, _, _, _, claims in jobs for claim in claims]
+    if args.cascade_model:
+        small_scorer = load_scorer(args.cascade_model, args)
+        labels, tiers, cached, report = score_pairs_cascade(
+            small_scorer,
+            scorer,
+            all_docs,
+            all_claims,
+            small_model=small_scorer.model_id,
+            band=args.uncertainty_band,
+            cache=cache,
+            calibration_size=args.calibration_size,
+            seed=args.seed,
+        )
+        print(f"Cascade: {json.dumps(report, indent=2)}")
+    else:
+        labels, _, cached = score_pairs(
+            scorer, all_docs, all_claims, cache=cache, model=scorer.model_id
+        )
 
-    df_out.to_json(out_file, orient="records")
+    offset = 0
+    for out_file, df_out, masks, docs, _ in jobs:
+        n = len(docs)
+        df_out = assign_labels(df_out, masks, labels[offset : offset + n])
+        if args.cascade_model:
+            file_tiers = tiers[offset : offset + n]
+            df_out = assign_labels(
+                df_out, masks, file_tiers, suffix="_nli_tier", default=None
+            )
+            report_file = out_file.parent / "cascade" / out_file.name
+            report_file.parent.mkdir(exist_ok=True, parents=True)
+            with open(report_file, "w") as fout:
+                json.dump(
+                    {**report, "file_escalated": file_tiers.count(NLI_MODEL)}, fout
+                )
+        if cache is not None:
+            hits = sum(cached[offset : offset + n])
+            print(
+                f"NLI cache ({out_file}): {hits}/{n} pairs cached "
+                f"({hits / max(n, 1):.1%})"
+            )
+        offset += n
+        write_table(df_out, out_file, args.output_format)
 
 
 def arg_parser():
@@ -70,10 +326,89 @@ def arg_parser():
     parser.add_argument(
         "--summaries_path",
         type=str,
+        nargs="+",
         required=True,
-        help="JSON with generated summaries.",
+        help="JSON with generated summaries. Multiple paths or glob patterns are scored "
+        "in one batch, with the model loaded once.",
+    )
+    parser.add_argument(
+        "--output_format",
+        default=DEFAULT_OUTPUT_FORMAT,
+        choices=OUTPUT_FORMATS,
+        help="Store outputs as Parquet, JSON records, or both.",
+    )
+    parser.add_argument(
+        "--nli_cache_path",
+        default=DEFAULT_NLI_CACHE_PATH,
+        help="Path to the NLI cache. Pass an empty string to disable caching.",
+    )
+    parser.add_argument(
+        "--nli_model",
+        default=NLI_MODEL,
+        choices=[NLI_MODEL, *CASCADE_MODELS],
+        help="MiniCheck model which scores the pairs.",
+    )
+    parser.add_argument(
+        "--device",
+        default="gpu",
+        choices=["gpu", "cpu"],
+        help=f"Run {', '.join(CPU_MODELS)} (as --nli_model or --cascade_model) on CPU. "
+        f"{NLI_MODEL} always runs on GPU.",
+    )
+    parser.add_argument(
+        "--cpu_backend",
+        default="int8",
+        choices=CPU_BACKENDS,
+        help="Dynamic int8 quantization, ONNX export, or unchanged fp32 weights.",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Processes of the CPU scorer (all CPUs if 0).",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Threads per CPU scorer process."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16, help="Pairs per batch of the CPU scorer."
+    )
+    parser.add_argument(
+        "--cascade_model",
+        default=None,
+        choices=CASCADE_MODELS,
+        help=f"Score all pairs with this checker first, and only escalate uncertain "
+        f"pairs to {NLI_MODEL}. The deciding model is stored in *_nli_tier columns.",
+    )
+    parser.add_argument(
+        "--uncertainty_band",
+        nargs=2,
+        type=float,
+        default=[0.2, 0.8],
+        metavar=("LOW", "HIGH"),
+        help="Pairs with a cascade checker probability in [LOW, HIGH] are escalated.",
+    )
+    parser.add_argument(
+        "--calibration_size",
+        type=int,
+        default=500,
+        help="Random pairs scored by both checkers for the cascade agreement report.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the calibration sample."
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.cascade_model and args.nli_model != NLI_MODEL:
+        parser.error(f"--cascade_model escalates to {NLI_MODEL}, not {args.nli_model}.")
+    if args.device == "cpu" and args.cascade_model not in CPU_MODELS:
+        if args.nli_model not in CPU_MODELS:
+            parser.error(f"--device cpu requires one of {list(CPU_MODELS)}.")
+    if args.device == "cpu":
+        try:
+            check_backend(args.cpu_backend)
+        except ImportError as e:
+            parser.error(str(e))
+    return args
 
 
 if __name__ == "__main__":
@@ -1,14 +1,25 @@
-import ast
 import json
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 import click
 import pandas as pd
-import pysbd
 from json_repair import repair_json
 
-from info_salience.llm import VLLMGenerator
+from info_salience.cache import DiskCache, content_hash
+from info_salience.llm import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SERVER_URL,
+    GenerationCache,
+    load_generator,
+    parse_engine,
+)
+from info_salience.segmentation import (
+    DEFAULT_SEGMENTATION_CACHE_PATH,
+    SegmentationCache,
+    split_sentences,
+)
+from info_salience.tables import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, write_table
 
 
 USER_PROMPT = """
@@ -141,6 +152,33 @@ Output:
 """.strip()
 
 
+FACTS_SCHEMA = {"type": "array", "items": {"type": "string"}}
+# Changes to the prompt or schema invalidate the fact cache.
+PROMPT_VERSION = content_hash(USER_PROMPT, FACTS_SCHEMA)[:16]
+MAX_TOKENS = 1024
+DEFAULT_FACT_CACHE_PATH = ".cache/facts.sqlite"
+
+
+class FactCache(DiskCache):
+    """
+    Parsed fact lists per sentence, shared by all datasets and stages.
+
+    Entries are keyed by model, prompt version and the whitespace-normalized sentence,
+    such that sentences that repeat across documents, answers and runs are decomposed
+    only once.
+    """
+
+    def __init__(self, path=DEFAULT_FACT_CACHE_PATH):
+        super().__init__(path)
+
+    def key(self, model, sent):
+        return content_hash(model, PROMPT_VERSION, normalize_sentence(sent))
+
+
+def normalize_sentence(sent: str):
+    return " ".join(sent.split())
+
+
 def get_messages(sent: str):
     user_prompt = USER_PROMPT.format(sent=sent)
     return [
@@ -148,47 +186,135 @@ def get_messages(sent: str):
     ]
 
 
+def fit_fact_context(llm, sents):
+    """Sizes the context window of `llm` for the fact extraction prompts of `sents`."""
+    llm.fit_context([get_messages(sent) for sent in sents], max_tokens=MAX_TOKENS)
+
+
+def load_fact_cache(path, engine):
+    """The fact cache is not used for fake or replayed outputs."""
+    engine = engine.removeprefix("record:")
+    if not path or parse_engine(engine)[0] in ["fake", "replay"]:
+        return None
+    return FactCache(path)
+
+
 def parse_response(response):
+    """Returns the list of facts, or None if the response is not a list of strings."""
     try:
-        response_fixed = repair_json(response)
-        items = ast.literal_eval(response_fixed)
-        assert isinstance(items, list)
-        assert all(isinstance(item, str) for item in items)
-    except (SyntaxError, AssertionError):
+        items = repair_json(response, return_objects=True)
+    except (IndexError, RecursionError, ValueError):
+        items = None
+    if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
         print("=" * 10, "failed to parse:", "=" * 10, "\n", response)
-        items = response
-
+        return None
     return items
 
 
-def extract_facts(sents: List[str], llm):
-    messages = [get_messages(sent) for sent in sents]
-    responses = llm.generate(messages, temperature=0, max_tokens=1024)
-    outputs = [parse_response(r[0]) for r in responses]
-    return outputs
-
-
-def extract_facts_from_texts(texts: List[str], llm):
+def generate_facts(sents: Dict[str, str], llm, max_retries=1):
+    """
+    Generates the facts of each sentence (given by key). Responses which cannot be parsed
+    are re-asked with sampling, in one batch per retry round. Sentences which still fail
+    after `max_retries` rounds are missing from the returned facts.
+    """
+    params = {"temperature": 0, "max_tokens": MAX_TOKENS}
+    if llm.engine != "litellm":
+        # the OpenAI API only supports objects at the root of a schema
+        params["schema"] = FACTS_SCHEMA
+
+    facts = {}
+    pending = dict(sents)
+    report = {"sentences": len(sents), "parse_failures": 0, "retried": 0}
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            if not pending:
+                break
+            print(f"Retry {attempt}/{max_retries}: re-ask {len(pending)} sentence(s)")
+            params.update(temperature=0.7, seed=attempt)
+            report["retried"] += len(pending)
+
+        messages = [get_messages(sent) for sent in pending.values()]
+        responses = llm.generate(messages, **params) if messages else []
+        failed = {}
+        for (key, sent), response in zip(pending.items(), responses):
+            # empty outputs (prompt too long, or request failed) count as failures
+            parsed = parse_response(response[0]) if response else None
+            if parsed is None:
+                failed[key] = sent
+            else:
+                facts[key] = parsed
+        if attempt == 0:
+            report["parse_failures"] = len(failed)
+        pending = failed
+
+    report["unresolved"] = len(pending)
+    n = max(report["sentences"], 1)
+    report["failure_rate"] = round(report["parse_failures"] / n, 4)
+    report["unresolved_rate"] = round(report["unresolved"] / n, 4)
+    print(
+        f"Parse failures: {report['parse_failures']}/{report['sentences']} sentences "
+        f"({report['failure_rate']:.1%}), unresolved after {max_retries} retry "
+        f"round(s): {report['unresolved']} ({report['unresolved_rate']:.1%})"
+    )
+    return facts, report
+
+
+def extract_facts(sents: List[str], llm, fact_cache=None, max_retries=1):
+    """Returns the facts of each sentence, and a report of parse failures."""
+    if fact_cache is None:
+        keys = [str(i) for i in range(len(sents))]
+        found = {}
+    else:
+        keys = [fact_cache.key(llm.model, sent) for sent in sents]
+        found = fact_cache.get_many(keys)
+
+    # generate each missing sentence once, no matter how often it repeats
+    missing = {key: sent for key, sent in zip(keys, sents) if key not in found}
+    n_cached = sum(key in found for key in keys)
+    generated, report = generate_facts(missing, llm, max_retries=max_retries)
+    report["cached"] = n_cached
+    found.update(generated)
+
+    if fact_cache is not None:
+        # sentences whose responses could not be parsed are not cached
+        fact_cache.put_many(generated)
+        print(
+            f"Fact cache: {n_cached}/{len(sents)} sentences cached, "
+            f"{len(missing)} unique sentences generated"
+        )
+    # unparsable responses would otherwise be split into single-character facts
+    return [found.get(key, []) for key in keys], report
+
+
+def extract_facts_from_texts(
+    texts: List[str],
+    llm,
+    fact_cache=None,
+    segmentation_cache=None,
+    n_jobs=1,
+    max_retries=1,
+):
     text_ids = []
     sent_ids = []
     all_sents = []
 
-    seg = pysbd.Segmenter(language="en", clean=False)
-    for i, text in enumerate(texts):
-        sents = seg.segment(text)
+    segmented = split_sentences(texts, cache=segmentation_cache, n_jobs=n_jobs)
+    for i, sents in enumerate(segmented):
         for sent_id, sent in enumerate(sents):
             text_ids.append(i)
             sent_ids.append(sent_id)
             all_sents.append(sent)
 
-    facts = extract_facts(all_sents, llm)
+    facts, report = extract_facts(
+        all_sents, llm, fact_cache=fact_cache, max_retries=max_retries
+    )
 
     data = []
     for i in range(len(all_sents)):
         for fact in facts[i]:
             data.append((text_ids[i], sent_ids[i], all_sents[i], fact))
 
-    return data
+    return data, report
 
 
 @click.command()
@@ -201,15 +327,96 @@ def extract_facts_from_texts(texts: List[str], llm):
 @click.option(
     "--output_json", required=True, type=str, help="Path for storing outputs."
 )
-def main(input_json, output_json):
+@click.option(
+    "--engine",
+    default="vllm",
+    help="Inference engine to use (vllm|litellm|server|fake|replay|record:<engine>).",
+)
+@click.option(
+    "--server_url",
+    default=DEFAULT_SERVER_URL,
+    help="URL of the generation server (--engine server).",
+)
+@click.option(
+    "--cache_path",
+    default=DEFAULT_CACHE_PATH,
+    help="Path to the generation cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--recording_path",
+    default=None,
+    help="Path to the recording of --engine record:<engine> and --engine replay.",
+)
+@click.option(
+    "--fact_cache_path",
+    default=DEFAULT_FACT_CACHE_PATH,
+    help="Path to the sentence-level fact cache. Pass an empty string to disable it.",
+)
+@click.option(
+    "--segmentation_cache_path",
+    default=DEFAULT_SEGMENTATION_CACHE_PATH,
+    help="Path to the sentence segmentation cache. Pass an empty string to disable it.",
+)
+@click.option(
+    "--n_jobs",
+    default=None,
+    type=int,
+    help="Number of processes for sentence segmentation (default: all CPUs).",
+)
+@click.option(
+    "--max_retries",
+    default=1,
+    type=int,
+    help="Number of batched retry rounds for responses which cannot be parsed.",
+)
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
+def main(
+    input_json,
+    output_json,
+    engine,
+    server_url,
+    cache_path,
+    recording_path,
+    fact_cache_path,
+    segmentation_cache_path,
+    n_jobs,
+    max_retries,
+    output_format,
+):
     with open(input_json) as fin:
         docs = json.load(fin)
 
     doc_ids = [doc["doc_id"] for doc in docs]
     texts = [doc["text"] for doc in docs]
 
-    llm = VLLMGenerator("meta-llama/Meta-Llama-3.1-8B-Instruct")
-    fact_data = extract_facts_from_texts(texts, llm)
+    cache = GenerationCache(cache_path) if cache_path else None
+    llm = load_generator(
+        engine,
+        "meta-llama/Meta-Llama-3.1-8B-Instruct",
+        cache=cache,
+        server_url=server_url,
+        recording_path=recording_path,
+    )
+    llm.telemetry.tags.update(
+        stage="claim_extraction", dataset=Path(input_json).parent.name
+    )
+    fact_cache = load_fact_cache(fact_cache_path, engine)
+    segmentation_cache = (
+        SegmentationCache(segmentation_cache_path) if segmentation_cache_path else None
+    )
+    fact_data, report = extract_facts_from_texts(
+        texts,
+        llm,
+        fact_cache=fact_cache,
+        segmentation_cache=segmentation_cache,
+        n_jobs=n_jobs,
+        max_retries=max_retries,
+    )
     text_ids, sent_ids, sents, facts = zip(*fact_data)
     df = pd.DataFrame(
         {
@@ -220,8 +427,16 @@ def main(input_json, output_json):
         }
     )
 
-    Path(output_json).parent.mkdir(exist_ok=True, parents=True)
-    df.to_json(output_json, orient="records")
+    write_table(df, output_json, output_format)
+    with open(Path(output_json).with_suffix(".meta.json"), "w") as fout:
+        json.dump(report, fout)
+    llm.telemetry.flush(Path(output_json).with_suffix(".telemetry.jsonl"))
+
+    if cache is not None:
+        print(f"Generation cache: {cache.stats()}")
+    if fact_cache is not None:
+        print(f"Fact cache: {fact_cache.stats()}")
+    llm.telemetry.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+"""
+GPU-free generator backends for benchmarking and regression tests.
+
+- `FakeGenerator` returns deterministic outputs which follow the requested schema (or the
+  output format asked for by the stage prompts), and simulates engine latency.
+- `RecordingGenerator` wraps a real generator and stores its outputs in a JSONL file.
+- `ReplayGenerator` serves the recorded outputs without any model.
+
+Select them with `--engine fake`, `--engine record:<engine>` (e.g., `record:vllm`) or
+`--engine replay` in the pipeline CLIs.
+"""
+
+import json
+import random
+import re
+import time
+from pathlib import Path
+
+from info_salience.cache import content_hash
+from info_salience.llm import Generator, generation_key, json_schema
+
+DEFAULT_RECORDING_PATH = ".cache/recordings.jsonl"
+
+WORDS = (
+    "the model results study meeting team data method analysis patients trial "
+    "proposal design evaluation baseline improvement effect group budget remote "
+    "control users experiment performance significant observed reported discussed"
+).split()
+
+
+def count_tokens(text):
+    # rough estimate for English text, avoids loading a tokenizer
+    return max(1, len(text) // 4)
+
+
+def fake_text(rng, n_words):
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def fake_json(schema, rng, defs=None):
+    """Returns a random instance of a JSON schema (objects, arrays, enums and scalars)."""
+    defs = schema.get("$defs", defs or {})
+    if "$ref" in schema:
+        return fake_json(defs[schema["$ref"].split("/")[-1]], rng, defs)
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    for key in ["anyOf", "oneOf"]:
+        if key in schema:
+            return fake_json(schema[key][0], rng, defs)
+    if "allOf" in schema:
+        return fake_json(schema["allOf"][0], rng, defs)
+
+    kind = schema.get("type", "string")
+    if isinstance(kind, list):
+        kind = kind[0]
+    if kind == "object":
+        return {
+            name: fake_json(prop, rng, defs)
+            for name, prop in schema.get("properties", {}).items()
+        }
+    elif kind == "array":
+        n = max(schema.get("minItems", 1), 1)
+        n = min(n + rng.randint(0, 2), schema.get("maxItems", n + 2))
+        return [fake_json(schema.get("items", {}), rng, defs) for _ in range(n)]
+    elif kind == "integer":
+        return rng.randint(schema.get("minimum", 1), schema.get("maximum", 5))
+    elif kind == "number":
+        return rng.uniform(schema.get("minimum", 0), schema.get("maximum", 1))
+    elif kind == "boolean":
+        return rng.random() < 0.5
+    elif kind == "null":
+        return None
+    return fake_text(rng, rng.randint(5, 30))
+
+
+def fake_response(prompt, rng):
+    """Returns a free-form response in the output format the stage prompt asks for."""
+    if "split it into a list of facts" in prompt:
+        sentence = prompt.rsplit("Sentence:", 1)[-1].split("Output:")[0].strip()
+        parts = [p.strip(" .") for p in re.split(r",| and ", sentence) if p.strip(" .")]
+        return json.dumps([p[:1].upper() + p[1:] + "." for p in parts] or [sentence])
+    elif "Answer: [the answer" in prompt:
+        question = prompt.split("## Question")[-1].split("First, carefully")[0].strip()
+        answer = "no answer" if rng.random() < 0.3 else fake_text(rng, 25)
+        return f"Question: {question}\nAnswer: {answer}"
+    elif "rate the relative importance" in prompt:
+        questions = prompt.split("## Questions")[1].split("## Rating")[0]
+        questions = re.findall(r"^\s*(\d+)\. (.*)$", questions, flags=re.MULTILINE)
+        ratings = [
+            {
+                "id": i,
+                "question": question,
+                "rationale": fake_text(rng, 15),
+                "rating": str(rng.randint(1, 5)),
+            }
+            for i, question in questions
+        ]
+        return json.dumps(ratings, indent=4)
+    elif "questions_10_words" in prompt:
+        return json.dumps(
+            {
+                f"questions_{n}_words": [
+                    {"question": fake_text(rng, 8), "example_answer": fake_text(rng, 8)}
+                ]
+                for n in [10, 20, 50, 100, 200]
+            }
+        )
+    return fake_text(rng, rng.randint(20, 100))
+
+
+class FakeGenerator(Generator):
+    """
+    Deterministic stand-in for an inference engine.
+
+    Outputs depend only on prompt, schema and sample index. Schema-constrained requests
+    yield a random instance of the schema, free-form requests a response in the format
+    the prompt asks for. Each batch takes `latency_s` plus the time to prefill all prompt
+    tokens at `prefill_tokens_per_s` and to decode the longest output at
+    `decode_tokens_per_s`, which resembles a batched engine. Without rates, outputs
+    are returned immediately.
+    """
+
+    engine = "fake"
+
+    def __init__(
+        self,
+        model,
+        cache=None,
+        latency_s=0.0,
+        prefill_tokens_per_s=None,
+        decode_tokens_per_s=None,
+    ):
+        super().__init__(model, cache=cache)
+        self.latency_s = latency_s
+        self.prefill_tokens_per_s = prefill_tokens_per_s
+        self.decode_tokens_per_s = decode_tokens_per_s
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        schema = json_schema(schema)
+        n = kwargs.get("n", 1)
+        results = []
+        for prompt in prompts:
+            text = "\n\n".join(message["content"] for message in prompt)
+            outputs = []
+            for i in range(n):
+                rng = random.Random(content_hash(self.model, text, schema, i))
+                if schema:
+                    outputs.append(json.dumps(fake_json(schema, rng)))
+                else:
+                    outputs.append(fake_response(text, rng))
+            results.append((count_tokens(text), outputs))
+
+        prompt_tokens = sum(tokens for tokens, _ in results)
+        completion_tokens = [
+            sum(count_tokens(output) for output in outputs) for _, outputs in results
+        ]
+        generation_s = self.latency_s
+        if self.prefill_tokens_per_s:
+            generation_s += prompt_tokens / self.prefill_tokens_per_s
+        if self.decode_tokens_per_s:
+            generation_s += max(completion_tokens, default=0) / self.decode_tokens_per_s
+        if generation_s:
+            time.sleep(generation_s)
+
+        # the batch time is split across its requests, such that the per-request times
+        # add up to the simulated engine time
+        request_s = generation_s / len(results) if results else 0.0
+        for i, ((tokens, outputs), completion) in enumerate(
+            zip(results, completion_tokens)
+        ):
+            self.telemetry.record(
+                engine=self.engine,
+                model=self.model,
+                index=i,
+                prompt_tokens=tokens,
+                completion_tokens=completion,
+                queue_s=0.0,
+                generation_s=request_s,
+                finish_reasons=["stop"] * len(outputs),
+            )
+        return [outputs for _, outputs in results]
+
+
+class RecordingGenerator(Generator):
+    """
+    Passes requests on to `generator` and appends its outputs to a JSONL recording.
+
+    Recordings are keyed by model, messages, schema and sampling parameters, so they can
+    be replayed independently of the chat template of the recorded engine. The recorder
+    reports the engine of `generator`, such that stages issue the same requests as they
+    would without recording.
+    """
+
+    def __init__(self, generator, path=DEFAULT_RECORDING_PATH):
+        super().__init__(generator.model)
+        self.generator = generator
+        self.engine = generator.engine
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        # the wrapped generator records the requests
+        self.telemetry = generator.telemetry
+
+    def fit_context(self, messages, max_tokens):
+        self.generator.fit_context(messages, max_tokens)
+
+    def _timed_generate(self, prompts, schema=None, **kwargs):
+        return self._generate(prompts, schema=schema, **kwargs)
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        outputs = self.generator.generate(prompts, schema=schema, **kwargs)
+        schema_json = json_schema(schema)
+        with open(self.path, "a") as fout:
+            for messages, output in zip(prompts, outputs):
+                key = generation_key(self.model, messages, schema_json, kwargs)
+                record = {"key": key, "engine": self.engine, "outputs": output}
+                fout.write(json.dumps(record) + "\n")
+        return outputs
+
+
+class ReplayGenerator(Generator):
+    """
+    Serves outputs from a recording of `RecordingGenerator`. Unrecorded requests fail.
+
+    The generator reports the engine of the recording, as stages adapt their requests to
+    the engine (e.g., no guided decoding with litellm).
+    """
+
+    engine = "replay"
+
+    def __init__(self, model, path=DEFAULT_RECORDING_PATH):
+        super().__init__(model)
+        self.path = Path(path)
+        self.recording = {}
+        with open(self.path) as fin:
+            for line in fin:
+                record = json.loads(line)
+                self.recording[record["key"]] = record["outputs"]
+                self.engine = record["engine"]
+        print(f"Loaded {len(self.recording)} recorded generations from {self.path}")
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        schema_json = json_schema(schema)
+        results = []
+        for messages in prompts:
+            key = generation_key(self.model, messages, schema_json, kwargs)
+            if key not in self.recording:
+                raise KeyError(
+                    f"No recorded generation for {self.model} in {self.path}. Record it "
+                    f"with --engine record:<engine>. Prompt:\n{messages}"
+                )
+            results.append(self.recording[key])
+            self.telemetry.record(
+                engine=self.engine,
+                model=self.model,
+                index=len(results) - 1,
+                cached=True,
+            )
+        return results
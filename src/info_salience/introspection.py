@@ -9,7 +9,18 @@ import pandas as pd
 import outlines
 from json_repair import repair_json
 
-from info_salience.llm import LitellmGenerator, VLLMGenerator
+from info_salience.llm import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SERVER_URL,
+    GenerationCache,
+    load_generator,
+)
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    table_exists,
+    write_table,
+)
 
 
 @outlines.prompt
@@ -182,31 +193,53 @@ def rate_questions(llm, df_questions, task, length_constraint, n=5, max_retries=
     help="Model name to be used.",
 )
 @click.option(
-    "--engine", default="vllm", help="Inference engine to use (vllm|litellm)."
+    "--engine",
+    default="vllm",
+    help="Inference engine to use (vllm|litellm|server|fake|replay|record:<engine>).",
+)
+@click.option(
+    "--server_url",
+    default=DEFAULT_SERVER_URL,
+    help="URL of the generation server (--engine server).",
 )
-def main(model, engine):
+@click.option(
+    "--cache_path",
+    default=DEFAULT_CACHE_PATH,
+    help="Path to the generation cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--recording_path",
+    default=None,
+    help="Path to the recording of --engine record:<engine> and --engine replay.",
+)
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
+def main(model, engine, server_url, cache_path, recording_path, output_format):
     print(f"Running introspection\nModel: {model}\nEngine: {engine}")
 
-    if engine == "vllm":
-        import torch
-
-        if model == "meta-llama/Meta-Llama-3.1-70B-Instruct":
-            # To fix the following Llama 3.1 70B (128k context window). ValueError: The model's max seq len (131072) is larger than the maximum number of tokens that can be stored in KV cache (24480). Try increasing `gpu_memory_utilization` or decreasing `max_model_len` when initializing the engine.
-            max_model_len = 14000
-        else:
-            max_model_len = None
-
-        llm = VLLMGenerator(
-            model,
-            tensor_parallel_size=torch.cuda.device_count(),
-            max_model_len=max_model_len,
-        )
-    else:
-        llm = LitellmGenerator(
-            model,
-            caching=False,
-            report_costs=True,
-        )
+    cache = GenerationCache(cache_path) if cache_path else None
+
+    llm = load_generator(
+        engine,
+        model,
+        cache=cache,
+        server_url=server_url,
+        recording_path=recording_path,
+    )
+    llm.telemetry.tags["stage"] = "introspection"
+    context_messages = []
+    for dataset in TASKS:
+        if not Path(f"output/{dataset}/discord_questions.json").exists():
+            continue
+        questions = load_questions(dataset)["question"].values
+        for length_constraint in LENGTH_CONSTRAINTS.values():
+            prompt = ranking_prompt(TASKS[dataset], questions, length_constraint)
+            context_messages.append([{"role": "user", "content": prompt}])
+    llm.fit_context(context_messages, max_tokens=2048)
 
     for dataset in ["pubmed-sample", "astro-ph", "cs-cl", "qmsum-generic"]:
         for length_key, length_constraint in LENGTH_CONSTRAINTS.items():
@@ -216,12 +249,13 @@ def main(model, engine):
             meta_file = Path(f"output/{dataset}/{m}/introspection-rationale/{length_key}.meta.json")
             out_file.parent.mkdir(exist_ok=True, parents=True)
 
-            if out_file.exists():
+            if table_exists(out_file):
                 print(f"Exists (skip): {str(out_file)}")
                 continue
             else:
                 print(f"Processing: {dataset} | {length_key}")
 
+            llm.telemetry.tags.update(dataset=dataset, length=length_key)
             df_questions = load_questions(dataset)
             df_ratings, retries = rate_questions(
                 llm,
@@ -233,10 +267,15 @@ def main(model, engine):
             with pd.option_context('display.max_columns', None):
                 print(df_ratings)
             df_ratings = df_ratings.reset_index()
-            df_ratings.to_json(out_file, orient="records")
+            write_table(df_ratings, out_file, output_format)
 
             with open(meta_file, 'w') as fout:
                 json.dump({'retries': retries}, fout)
+            llm.telemetry.flush(out_file.parent / "telemetry.jsonl")
+
+    if cache is not None:
+        print(f"Generation cache: {cache.stats()}")
+    llm.telemetry.print_summary()
 
 
 if __name__ == "__main__":
@@ -1,62 +1,688 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import urllib.request
+import warnings
 from pathlib import Path
 
 import litellm
-import vllm
-from vllm.sampling_params import GuidedDecodingParams
 from pydantic import BaseModel
+from transformers import AutoConfig
 
+from info_salience.cache import DiskCache, content_hash
+from info_salience.scheduling import (
+    choose_max_model_len,
+    estimate_kv_cache_tokens,
+    kv_cache_bytes_per_token,
+    plan_batches,
+    plan_prefix_order,
+)
+from info_salience.telemetry import Telemetry
 
-class VLLMGenerator:
-    def __init__(self, model, **kwargs):
+DEFAULT_CACHE_PATH = ".cache/generations.sqlite"
+DEFAULT_CACHE_SIZE = 20 * 1024**3
+DEFAULT_SERVER_URL = "http://127.0.0.1:8765"
+
+# Request options which do not influence the generated text.
+UNCACHED_PARAMS = {"timeout"}
+
+
+class GenerationCache(DiskCache):
+    """
+    Content-addressed cache of LLM generations, shared by all generator backends.
+
+    Entries are keyed by model, rendered prompt, sampling parameters (including `seed`
+    and `n`) and guided decoding schema, so that a changed prompt only invalidates its
+    own entry.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_bytes=DEFAULT_CACHE_SIZE):
+        super().__init__(path, max_size_bytes=max_size_bytes)
+
+    def key(self, model, prompt, schema, params):
+        return generation_key(model, prompt, schema, params)
+
+
+def generation_key(model, prompt, schema, params, occurrence=0):
+    params = {k: v for k, v in params.items() if k not in UNCACHED_PARAMS}
+    if occurrence:
+        return content_hash(model, prompt, schema, params, occurrence)
+    return content_hash(model, prompt, schema, params)
+
+
+def json_schema(schema):
+    if schema is None or isinstance(schema, dict):
+        return schema
+    return schema.model_json_schema()
+
+
+class Generator:
+    """
+    Base class of all generators. Subclasses implement `render` and `_generate`.
+
+    `generate(messages, schema=None, **kwargs)` returns one list of `n` outputs per
+    conversation. Identical prompts within a call are sent to the backend once and the
+    outputs are fanned out; `deduplicated` counts the saved prompts. If a cache is given,
+    only prompts without a cached result are sent to the backend. Backends record
+    per-request statistics in `telemetry`, with the `index` of the prompt within the
+    backend call, and `last_records` holds the record of each conversation of the last
+    call (shared by conversations which were served by the same request).
+    """
+
+    engine = None
+
+    def __init__(self, model, cache=None):
         self.model = model
-        self.engine = 'vllm'
-        self.llm = vllm.LLM(model, **kwargs)
-        self.tokenizer = self.llm.get_tokenizer()
+        self.cache = cache
+        self.telemetry = Telemetry()
+        self.deduplicated = 0
+        self.last_records = []
+
+    def render(self, messages):
+        return messages
+
+    def fit_context(self, messages, max_tokens):
+        """Hint about upcoming prompts, used by backends which size their context window."""
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        raise NotImplementedError
+
+    def _timed_generate(self, prompts, schema=None, **kwargs):
+        start = time.perf_counter()
+        outputs = self._generate(prompts, schema=schema, **kwargs)
+        self.telemetry.record(
+            "batch",
+            engine=self.engine,
+            model=self.model,
+            prompts=len(prompts),
+            wall_s=time.perf_counter() - start,
+        )
+        return outputs
 
     def generate(self, messages, schema: BaseModel = None, **kwargs):
+        prompts = [self.render(m) for m in messages]
+        schema_json = json_schema(schema)
+        n = kwargs.get("n", 1)
+        # Greedy duplicates are served by a single output. Sampled duplicates each get
+        # their own `n` samples, so the k-th occurrence of a prompt has its own key.
+        sampled = kwargs.get("temperature", 1.0) > 0
+
+        prompt_keys = []
+        keys = []
+        occurrences = {}
+        for prompt in prompts:
+            prompt_key = generation_key(self.model, prompt, schema_json, kwargs)
+            occurrence = occurrences.get(prompt_key, 0) if sampled else 0
+            occurrences[prompt_key] = occurrences.get(prompt_key, 0) + 1
+            prompt_keys.append(prompt_key)
+            keys.append(
+                generation_key(self.model, prompt, schema_json, kwargs, occurrence)
+            )
+
+        results = self.cache.get_many(keys) if self.cache is not None else {}
+        records = {}
+        for i, key in enumerate(keys):
+            if key in results:
+                records[i] = self.telemetry.record(
+                    engine=self.engine, model=self.model, cached=True
+                )
+
+        # distinct missing keys, grouped by prompt
+        missing = {}
+        seen = set()
+        n_missing = 0
+        for i, key in enumerate(keys):
+            if key in results:
+                continue
+            n_missing += 1
+            if key in seen:
+                continue
+            seen.add(key)
+            missing.setdefault(prompt_keys[i], (i, []))[1].append(key)
+
+        # One request per prompt, sampling n outputs for each distinct key. Requests
+        # with the same number of keys share the sampling parameters and one batch.
+        by_count = {}
+        for i, group_keys in missing.values():
+            by_count.setdefault(len(group_keys), []).append((i, group_keys))
+        new = {}
+        request_records = {}
+        for count, requests in by_count.items():
+            params = dict(kwargs, n=n * count) if count > 1 else kwargs
+            start = len(self.telemetry.pending)
+            outputs = self._timed_generate(
+                [prompts[i] for i, _ in requests], schema=schema, **params
+            )
+            by_index = {
+                record.pop("index"): record
+                for record in self.telemetry.pending[start:]
+                if "index" in record
+            }
+            for j, ((_, group_keys), output) in enumerate(zip(requests, outputs)):
+                for k, key in enumerate(group_keys):
+                    new[key] = output[k * n : (k + 1) * n]
+                    request_records[key] = by_index.get(j)
+
+        self.deduplicated += n_missing - len(missing)
+        if n_missing > len(missing):
+            print(f"Deduplicated {n_missing - len(missing)}/{n_missing} prompts")
+        if self.cache is not None:
+            # Incomplete outputs (e.g., prompt exceeded the context window) are not cached.
+            self.cache.put_many({k: v for k, v in new.items() if len(v) == n})
+        results.update(new)
+        self.last_records = [
+            records[i] if i in records else request_records.get(key)
+            for i, key in enumerate(keys)
+        ]
+        return [results[key] for key in keys]
+
+
+class VLLMGenerator(Generator):
+    """
+    Local generation with vLLM.
+
+    The engine is loaded lazily. With `max_model_len="auto"`, the context window is sized
+    to the longest prompt seen so far (see `fit_context`) plus `max_tokens`, bounded by
+    the model's maximum length and the estimated KV cache capacity. Prompts are
+    tokenized up front and dispatched in batches whose KV footprint fits the cache.
+    Prompts which exceed the context window are reported and yield no outputs.
+
+    Automatic prefix caching is enabled by default. Prompts are then reordered such that
+    prompts sharing a prefix (e.g., the same document or few-shot examples) run next to
+    each other; otherwise they are dispatched longest-first.
+    """
+
+    engine = "vllm"
+
+    def __init__(self, model, cache=None, max_model_len="auto", **kwargs):
+        from vllm.transformers_utils.tokenizer import get_tokenizer
+
+        super().__init__(model, cache=cache)
+        kwargs.setdefault("enable_prefix_caching", True)
+        self.max_model_len = max_model_len
+        self.engine_kwargs = kwargs
+        self.tokenizer = get_tokenizer(
+            model, trust_remote_code=kwargs.get("trust_remote_code", False)
+        )
+        self.required_len = 0
+        self.overlong_prompts = 0
+        self.prefill_tokens_saved = 0
+        self._llm = None
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            import vllm
+
+            max_model_len = self.max_model_len
+            if max_model_len == "auto":
+                max_model_len = self._auto_max_model_len()
+            self._llm = vllm.LLM(
+                self.model, max_model_len=max_model_len, **self.engine_kwargs
+            )
+        return self._llm
+
+    def render(self, messages):
+        return self.tokenizer.apply_chat_template(messages, tokenize=False)
+
+    def fit_context(self, messages, max_tokens):
+        """Sizes the context window of the engine (if not yet loaded) to fit the given prompts."""
+        lengths = [len(self.tokenizer.encode(self.render(m))) for m in messages]
+        self._reserve(lengths, max_tokens)
+
+    def _reserve(self, lengths, max_tokens):
+        if self._llm is not None:
+            return
+        self.required_len = max(self.required_len, max(lengths, default=0) + max_tokens)
+
+    def _auto_max_model_len(self):
+        config = AutoConfig.from_pretrained(
+            self.model,
+            trust_remote_code=self.engine_kwargs.get("trust_remote_code", False),
+        )
+        model_max_len = config.max_position_embeddings
+        kv_cache_tokens = self._estimate_kv_cache_tokens(config)
+        if self.required_len:
+            max_model_len = choose_max_model_len(
+                [self.required_len], 0, model_max_len, kv_cache_tokens
+            )
+        elif kv_cache_tokens is not None:
+            max_model_len = min(model_max_len, kv_cache_tokens)
+        else:
+            max_model_len = model_max_len
+        print(
+            f"max_model_len={max_model_len} (required: {self.required_len}, "
+            f"model: {model_max_len}, estimated KV cache: {kv_cache_tokens})"
+        )
+        return max_model_len
+
+    def _estimate_kv_cache_tokens(self, config):
+        import torch
+        from huggingface_hub import snapshot_download
+
+        if not torch.cuda.is_available():
+            return None
+
+        tensor_parallel_size = self.engine_kwargs.get("tensor_parallel_size") or 1
+        gpu_memory = sum(
+            torch.cuda.get_device_properties(i).total_memory
+            for i in range(tensor_parallel_size)
+        )
+        if Path(self.model).is_dir():
+            model_path = Path(self.model)
+        else:
+            model_path = Path(
+                snapshot_download(self.model, allow_patterns=["*.safetensors"])
+            )
+        weight_bytes = sum(f.stat().st_size for f in model_path.glob("*.safetensors"))
+
+        num_heads = config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        bytes_per_token = kv_cache_bytes_per_token(
+            config.num_hidden_layers,
+            getattr(config, "num_key_value_heads", None) or num_heads,
+            head_dim,
+        )
+        return estimate_kv_cache_tokens(
+            gpu_memory,
+            weight_bytes,
+            bytes_per_token,
+            gpu_memory_utilization=self.engine_kwargs.get(
+                "gpu_memory_utilization", 0.9
+            ),
+        )
+
+    def kv_cache_tokens(self):
+        cache_config = self.llm.llm_engine.cache_config
+        return cache_config.num_gpu_blocks * cache_config.block_size
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        import vllm
+        from vllm.inputs import TokensPrompt
+        from vllm.sampling_params import GuidedDecodingParams
+
+        schema = json_schema(schema)
         if schema:
-            guided_decoding = GuidedDecodingParams(json=schema.model_json_schema())
+            guided_decoding = GuidedDecodingParams(json=schema)
         else:
             guided_decoding = None
 
         params = vllm.SamplingParams(guided_decoding=guided_decoding, **kwargs)
-        prompts = self.tokenizer.apply_chat_template(messages, tokenize=False)
-        responses = self.llm.generate(prompts, params)
+        token_ids = [self.tokenizer.encode(prompt) for prompt in prompts]
+        lengths = [len(ids) for ids in token_ids]
+        self._reserve(lengths, params.max_tokens)
+
+        order = None
+        if self.engine_kwargs["enable_prefix_caching"]:
+            order, saved = plan_prefix_order(token_ids)
+            self.prefill_tokens_saved += saved
+            print(
+                f"Prefix cache: ~{saved}/{sum(lengths)} prefill tokens saved "
+                f"({saved / max(1, sum(lengths)):.1%})"
+            )
+
+        max_model_len = self.llm.llm_engine.model_config.max_model_len
+        plan = plan_batches(
+            lengths,
+            params.max_tokens,
+            max_model_len,
+            token_budget=self.kv_cache_tokens(),
+            n=params.n,
+            order=order,
+        )
+        for i in plan.overlong:
+            self.telemetry.record(
+                engine=self.engine,
+                model=self.model,
+                index=i,
+                prompt_tokens=lengths[i],
+                completion_tokens=0,
+                finish_reasons=["overlong"],
+            )
+        if plan.overlong:
+            self.overlong_prompts += len(plan.overlong)
+            warnings.warn(
+                f"{len(plan.overlong)}/{len(prompts)} prompts exceed the context window "
+                f"of {max_model_len} tokens (longest: {max(lengths)} tokens) and are "
+                f"skipped. Prompt indices: {plan.overlong}"
+            )
+
         # results shape: (prompts, n) where n is number of generations
-        results = [
-            [output.text for output in response.outputs] for response in responses
-        ]
+        results = [[] for _ in prompts]
+        for batch in plan.batches:
+            responses = self.llm.generate(
+                [TokensPrompt(prompt_token_ids=token_ids[i]) for i in batch], params
+            )
+            for i, response in zip(batch, responses):
+                results[i] = [output.text for output in response.outputs]
+                self._record(response, i)
         return results
 
+    def _record(self, response, index):
+        queue_s = generation_s = None
+        metrics = response.metrics
+        if metrics is not None and metrics.finished_time is not None:
+            scheduled = metrics.first_scheduled_time or metrics.arrival_time
+            queue_s = scheduled - metrics.arrival_time
+            generation_s = metrics.finished_time - scheduled
+        self.telemetry.record(
+            engine=self.engine,
+            model=self.model,
+            index=index,
+            prompt_tokens=len(response.prompt_token_ids),
+            completion_tokens=sum(len(o.token_ids) for o in response.outputs),
+            queue_s=queue_s,
+            generation_s=generation_s,
+            finish_reasons=[o.finish_reason for o in response.outputs],
+        )
 
-class LitellmGenerator:
-    def __init__(self, model, caching=False, report_costs=False, disk_cache_dir=None):
-        self.model = model
-        self.engine = 'litellm'
-        self.caching = caching
-        if caching:
-            from litellm.caching import Cache
-
-            if disk_cache_dir:
-                Path(disk_cache_dir).mkdir(exist_ok=True, parents=True)
-            litellm.cache = Cache("disk", disk_cache_dir=disk_cache_dir)
+
+class TokenBucket:
+    """Token bucket which refills `rate_per_minute` units per minute."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def run_sync(coro):
+    """Runs a coroutine to completion, also from within a running event loop (e.g., Jupyter)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result = {}
+
+    def target():
+        try:
+            result["value"] = asyncio.run(coro)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+class LitellmGenerator(Generator):
+    """
+    API-based generation via litellm.
+
+    Requests are issued asynchronously with at most `max_concurrency` in flight, so that a
+    single slow request does not stall the batch. Optional token buckets enforce
+    `requests_per_minute` and `tokens_per_minute`, and failed requests are retried with
+    exponential backoff. Results are returned in input order. Requests which still fail
+    after `max_retries`, or fail with a non-transient error, yield an empty list of
+    outputs.
+    """
+
+    engine = "litellm"
+
+    RETRY_ERRORS = (
+        litellm.exceptions.RateLimitError,
+        litellm.exceptions.Timeout,
+        litellm.exceptions.APIConnectionError,
+        litellm.exceptions.InternalServerError,
+        litellm.exceptions.ServiceUnavailableError,
+    )
+
+    def __init__(
+        self,
+        model,
+        cache=None,
+        report_costs=False,
+        max_concurrency=32,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_retries=5,
+        backoff_base=1.0,
+        backoff_max=60.0,
+        api_base=None,
+    ):
+        super().__init__(model, cache=cache)
         self.report_costs = report_costs
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.api_base = api_base
 
-    def generate(self, messages, **kwargs):
-        responses = litellm.batch_completion(
-            model=self.model,
-            messages=messages,
-            caching=self.caching,
-            **kwargs,
+    async def _complete(self, messages, semaphore, rpm, tpm, **kwargs):
+        """Returns the response (or None on failure), queue time and generation time."""
+        submitted = time.perf_counter()
+        if tpm is not None:
+            n_tokens = litellm.token_counter(model=self.model, messages=messages)
+            n_tokens += kwargs.get("max_tokens") or 0
+        for attempt in range(self.max_retries + 1):
+            if rpm is not None:
+                await rpm.acquire()
+            if tpm is not None:
+                await tpm.acquire(n_tokens)
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await litellm.acompletion(
+                        model=self.model,
+                        messages=messages,
+                        api_base=self.api_base,
+                        **kwargs,
+                    )
+                    finished = time.perf_counter()
+                    return response, started - submitted, finished - started
+                except self.RETRY_ERRORS as e:
+                    if attempt == self.max_retries:
+                        print(f"Request failed after {attempt + 1} attempts: {e!r}")
+                        return None, started - submitted, None
+                    error = e
+                except Exception as e:
+                    # e.g., BadRequestError: retrying does not help, but the other
+                    # requests of the batch should not be lost
+                    print(f"Request failed: {e!r}")
+                    return None, started - submitted, None
+            delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+            delay = delay * random.uniform(0.5, 1.0)
+            print(
+                f"Retry in {delay:.1f}s ({attempt + 1}/{self.max_retries}): {error!r}"
+            )
+            await asyncio.sleep(delay)
+
+    async def _agenerate(self, prompts, **kwargs):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        rpm = (
+            TokenBucket(self.requests_per_minute) if self.requests_per_minute else None
+        )
+        tpm = TokenBucket(self.tokens_per_minute) if self.tokens_per_minute else None
+        return await asyncio.gather(
+            *[self._complete(p, semaphore, rpm, tpm, **kwargs) for p in prompts]
         )
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        if isinstance(schema, dict):
+            kwargs["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": schema, "strict": True},
+            }
+        elif schema is not None:
+            kwargs["response_format"] = schema
+        outcomes = run_sync(self._agenerate(prompts, **kwargs))
+
+        responses = []
+        total = 0
+        for i, (response, queue_s, generation_s) in enumerate(outcomes):
+            responses.append(response)
+            if response is None:
+                self.telemetry.record(
+                    engine=self.engine,
+                    model=self.model,
+                    index=i,
+                    queue_s=queue_s,
+                    finish_reasons=["failed"],
+                )
+                continue
+            try:
+                cost = litellm.completion_cost(response)
+            except Exception:
+                cost = None
+            total += cost or 0
+            self.telemetry.record(
+                engine=self.engine,
+                model=self.model,
+                index=i,
+                prompt_tokens=response["usage"]["prompt_tokens"],
+                completion_tokens=response["usage"]["completion_tokens"],
+                queue_s=queue_s,
+                generation_s=generation_s,
+                finish_reasons=[c["finish_reason"] for c in response["choices"]],
+                cost=cost,
+            )
+
         if self.report_costs:
-            total = 0
-            for response in responses:
-                total += litellm.completion_cost(response)
             print(f"Batch cost: ${total:.4f}")
 
         results = [
-            [choice["message"]["content"] for choice in response["choices"]]
+            (
+                [choice["message"]["content"] for choice in response["choices"]]
+                if response is not None
+                else []
+            )
             for response in responses
         ]
         return results
+
+
+class ServerGenerator(Generator):
+    """
+    Client of a generation server (see `info_salience.llm_server`). The server returns
+    the statistics of each request, which are recorded as if the requests had run locally.
+    """
+
+    engine = "server"
+
+    def __init__(self, url=DEFAULT_SERVER_URL, cache=None, timeout=None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        with urllib.request.urlopen(f"{self.url}/health", timeout=30) as response:
+            model = json.load(response)["model"]
+        super().__init__(model, cache=cache)
+
+    def _generate(self, prompts, schema=None, **kwargs):
+        payload = {"messages": prompts, "schema": json_schema(schema), "params": kwargs}
+        request = urllib.request.Request(
+            f"{self.url}/generate",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                payload = json.load(response)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Generation server failed:\n{json.load(e)['error']}")
+
+        for i, stats in enumerate(payload.get("stats") or [None] * len(prompts)):
+            stats = stats or {}
+            # served by the same request as an earlier prompt, which holds its stats
+            if stats.pop("deduplicated", False):
+                continue
+            self.telemetry.record(
+                engine=self.engine, model=self.model, index=i, **stats
+            )
+        return payload["results"]
+
+
+def parse_engine(engine):
+    """
+    Splits an engine spec `<engine>[:<option>=<value>,...]` into the engine name and its
+    options, e.g., `litellm:max_concurrency=8,requests_per_minute=500`. Values are parsed
+    as JSON where possible and kept as strings otherwise.
+    """
+    name, _, spec = engine.partition(":")
+    options = {}
+    for item in filter(None, spec.split(",")):
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid option {item!r} in engine spec {engine!r}.")
+        try:
+            options[key.strip()] = json.loads(value)
+        except json.JSONDecodeError:
+            options[key.strip()] = value.strip()
+    return name, options
+
+
+def load_generator(
+    engine,
+    model,
+    cache=None,
+    server_url=DEFAULT_SERVER_URL,
+    recording_path=None,
+    **kwargs,
+):
+    """
+    Creates the generator for `engine`. Keyword arguments are passed to the vLLM engine.
+
+    `record:<engine>` records the outputs of `<engine>` to `recording_path`, and `replay`
+    serves them from there. The fake and replay backends do not use the generation cache.
+
+    Options of the litellm backend (`max_concurrency`, `requests_per_minute`,
+    `tokens_per_minute`, `max_retries`, `backoff_base`, `backoff_max`, `api_base`) are
+    given in the engine spec (see `parse_engine`), e.g.,
+    `litellm:max_concurrency=8,tokens_per_minute=200000`, as are the simulated latency and
+    throughput of the fake backend (`latency_s`, `prefill_tokens_per_s`,
+    `decode_tokens_per_s`), e.g., `fake:latency_s=0.05,decode_tokens_per_s=2000`.
+    """
+    if engine.startswith("record:"):
+        from info_salience.fake_llm import DEFAULT_RECORDING_PATH, RecordingGenerator
+
+        inner = load_generator(
+            engine.split(":", 1)[1], model, cache=cache, server_url=server_url, **kwargs
+        )
+        return RecordingGenerator(inner, recording_path or DEFAULT_RECORDING_PATH)
+    engine, options = parse_engine(engine)
+    if options and engine not in ["litellm", "fake"]:
+        raise ValueError(f"Engine {engine} takes no options.")
+    if engine == "vllm":
+        import torch
+
+        kwargs.setdefault("tensor_parallel_size", torch.cuda.device_count())
+        return VLLMGenerator(model, cache=cache, **kwargs)
+    elif engine == "litellm":
+        return LitellmGenerator(model, cache=cache, report_costs=True, **options)
+    elif engine == "fake":
+        from info_salience.fake_llm import FakeGenerator
+
+        return FakeGenerator(model, **options)
+    elif engine == "replay":
+        from info_salience.fake_llm import DEFAULT_RECORDING_PATH, ReplayGenerator
+
+        return ReplayGenerator(model, recording_path or DEFAULT_RECORDING_PATH)
+    elif engine == "server":
+        llm = ServerGenerator(server_url, cache=cache)
+        if llm.model != model:
+            raise ValueError(f"Server runs {llm.model}, but {model} was requested.")
+        return llm
+    else:
+        raise ValueError(f"Invalid engine {engine}.")
@@ -0,0 +1,251 @@
+"""
+Long-lived generation server which keeps one engine loaded across pipeline stages.
+
+Start the server once, then run the stages with `--engine server`:
+
+    python -m info_salience.llm_server --model meta-llama/Meta-Llama-3.1-8B-Instruct
+    python -m info_salience.claim_extraction --engine server ...
+
+Requests of concurrently connected clients which share schema and sampling parameters
+are merged into a single batch for the engine. Responses include the statistics of each
+request, which clients record in their own telemetry.
+"""
+
+import json
+import queue
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import click
+
+from info_salience.cache import content_hash
+from info_salience.llm import DEFAULT_CACHE_PATH, DEFAULT_SERVER_URL, GenerationCache
+
+# Fields of the telemetry records which are returned to clients.
+STATS_FIELDS = [
+    "cached",
+    "prompt_tokens",
+    "completion_tokens",
+    "queue_s",
+    "generation_s",
+    "finish_reasons",
+    "cost",
+]
+
+
+class PendingRequest:
+    def __init__(self, messages, schema, params):
+        self.messages = messages
+        self.schema = schema
+        self.params = params
+        self.submitted = time.perf_counter()
+        self.result = None
+        self.stats = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GenerationServer(ThreadingHTTPServer):
+    """
+    HTTP server in front of a generator.
+
+    Handler threads enqueue requests, and a single worker thread drains the queue: it
+    waits up to `batch_window` seconds for further requests, groups them by schema and
+    sampling parameters, and calls `generator.generate` once per group. Any object with a
+    `model` attribute and a `generate(messages, schema=None, **kwargs)` method can serve
+    as generator. Generators with `telemetry` and `last_records` (see
+    `info_salience.llm.Generator`) also return per-request statistics. Their records are
+    flushed to `telemetry_path` after each batch and not kept in memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        generator,
+        host="127.0.0.1",
+        port=8765,
+        batch_window=0.05,
+        telemetry_path=None,
+    ):
+        super().__init__((host, port), GenerationHandler)
+        self.generator = generator
+        self.batch_window = batch_window
+        self.telemetry_path = telemetry_path
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def submit(self, messages, schema, params):
+        request = PendingRequest(messages, schema, params)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error:
+            raise RuntimeError(request.error)
+        return request.result, request.stats
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        while True:
+            try:
+                batch.append(self.requests.get(timeout=self.batch_window))
+            except queue.Empty:
+                return batch
+
+    def _work(self):
+        while True:
+            batch = self._collect()
+            groups = {}
+            for request in batch:
+                key = content_hash(request.schema, request.params)
+                groups.setdefault(key, []).append(request)
+
+            for requests in groups.values():
+                messages = [m for request in requests for m in request.messages]
+                print(
+                    f"Batch of {len(messages)} prompts from {len(requests)} request(s)",
+                    flush=True,
+                )
+                dispatched = time.perf_counter()
+                try:
+                    results = self.generator.generate(
+                        messages, schema=requests[0].schema, **requests[0].params
+                    )
+                except Exception:
+                    error = traceback.format_exc()
+                    print(error, flush=True)
+                    for request in requests:
+                        request.error = error
+                        request.done.set()
+                    continue
+                finally:
+                    if hasattr(self.generator, "telemetry"):
+                        self.generator.telemetry.flush(self.telemetry_path, keep=False)
+
+                records = getattr(self.generator, "last_records", None)
+                stats = self._stats(records or [None] * len(messages))
+                offset = 0
+                for request in requests:
+                    end = offset + len(request.messages)
+                    request.result = results[offset:end]
+                    request.stats = stats[offset:end]
+                    waited = dispatched - request.submitted
+                    for request_stats in request.stats:
+                        if "queue_s" in request_stats:
+                            request_stats["queue_s"] = waited + (
+                                request_stats["queue_s"] or 0.0
+                            )
+                    offset = end
+                    request.done.set()
+
+    @staticmethod
+    def _stats(records):
+        """Statistics of each prompt. Prompts served by the same request share them."""
+        stats = []
+        seen = set()
+        for record in records:
+            if record is None:
+                stats.append({})
+            elif id(record) in seen:
+                stats.append({"deduplicated": True})
+            else:
+                seen.add(id(record))
+                stats.append({k: record.get(k) for k in STATS_FIELDS if k in record})
+        return stats
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    def _respond(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, {"model": self.server.generator.model})
+        else:
+            self._respond(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self._respond(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        length = int(self.headers["Content-Length"])
+        request = json.loads(self.rfile.read(length))
+        try:
+            results, stats = self.server.submit(
+                request["messages"], request.get("schema"), request.get("params", {})
+            )
+        except RuntimeError as e:
+            self._respond(500, {"error": str(e)})
+            return
+        self._respond(200, {"results": results, "stats": stats})
+
+    def log_message(self, *args):
+        pass
+
+
+@click.command()
+@click.option(
+    "--model",
+    default="meta-llama/Meta-Llama-3.1-8B-Instruct",
+    help="Model name to be served.",
+)
+@click.option(
+    "--url",
+    default=DEFAULT_SERVER_URL,
+    help="Address to listen on.",
+)
+@click.option(
+    "--batch_window",
+    default=0.05,
+    type=float,
+    help="Seconds to wait for concurrent requests before dispatching a batch.",
+)
+@click.option(
+    "--cache_path",
+    default=DEFAULT_CACHE_PATH,
+    help="Path to the generation cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--telemetry_path",
+    default=None,
+    help="JSONL file for the telemetry of the server. By default, it is not stored.",
+)
+def main(model, url, batch_window, cache_path, telemetry_path):
+    import torch
+
+    from info_salience.llm import VLLMGenerator
+
+    cache = GenerationCache(cache_path) if cache_path else None
+    llm = VLLMGenerator(
+        model, cache=cache, tensor_parallel_size=torch.cuda.device_count()
+    )
+    # Load the engine now. Without prompts to size for, the context window is bounded
+    # only by the model and KV cache capacity.
+    llm.llm
+
+    url = urlparse(url)
+    server = GenerationServer(
+        llm,
+        host=url.hostname,
+        port=url.port,
+        batch_window=batch_window,
+        telemetry_path=telemetry_path,
+    )
+    print(f"Serving {model} on {url.geturl()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+CPU scorer for the smaller MiniCheck models, for runs which do not need a GPU (e.g.,
+baseline summaries). The checkpoints are run with dynamic int8 quantization of the linear
+layers, exported to ONNX (requires `optimum[onnxruntime]`), or unchanged (fp32). Batches
+of pairs are scored in a process pool, with `threads` torch/ONNX threads per process.
+
+Labels follow MiniCheck: premises longer than `chunk_size` words are split into chunks,
+and a claim is supported if the maximum support probability over all chunks exceeds 0.5.
+Chunks are split on words rather than on sentences, so labels of long premises can
+differ slightly from the `minicheck` package (see `scripts/benchmark_nli_cpu.py`).
+"""
+
+import importlib.util
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# flan-t5-large is a seq2seq checkpoint and not supported by this scorer.
+CPU_MODELS = {
+    "roberta-large": "lytang/MiniCheck-RoBERTa-Large",
+    "deberta-v3-large": "lytang/MiniCheck-DeBERTa-v3-Large",
+}
+CPU_BACKENDS = ["int8", "onnx", "fp32"]
+
+_worker_model = None
+
+
+def check_backend(backend):
+    """Fails early if the dependencies of `backend` are not installed."""
+    if backend not in CPU_BACKENDS:
+        raise ValueError(f"Invalid CPU backend {backend}.")
+    if backend == "onnx" and (
+        importlib.util.find_spec("onnxruntime") is None
+        or importlib.util.find_spec("optimum") is None
+    ):
+        raise ImportError(
+            "The onnx backend requires onnxruntime and optimum, which are not part of "
+            "the environment. Install them with: pip install 'optimum[onnxruntime]'"
+        )
+
+
+def load_model(checkpoint, backend="int8", threads=1):
+    """Tokenizer and sequence classification model of `checkpoint` for CPU inference."""
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    check_backend(backend)
+    torch.set_num_threads(threads)
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+
+    if backend == "onnx":
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+        model = ORTModelForSequenceClassification.from_pretrained(
+            checkpoint, export=True, session_options=session_options
+        )
+        return tokenizer, model
+
+    model = AutoModelForSequenceClassification.from_pretrained(checkpoint).eval()
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return tokenizer, model
+
+
+def chunk_words(doc, chunk_size):
+    words = doc.split()
+    if not words:
+        return [doc]
+    return [
+        " ".join(words[i : i + chunk_size]) for i in range(0, len(words), chunk_size)
+    ]
+
+
+def support_probas(tokenizer, model, docs, claims, max_length=512):
+    """Probability of the supported class for each (chunk, claim) pair."""
+    import torch
+
+    inputs = tokenizer(
+        docs,
+        claims,
+        padding=True,
+        truncation="only_first",
+        max_length=max_length,
+        return_tensors="pt",
+    )
+    with torch.inference_mode():
+        logits = model(**inputs).logits
+    return torch.softmax(logits.float(), dim=-1)[:, 1].numpy()
+
+
+def _init_worker(checkpoint, backend, threads):
+    global _worker_model
+    _worker_model = load_model(checkpoint, backend, threads)
+
+
+def _score_batch(batch):
+    docs, claims = batch
+    return support_probas(*_worker_model, docs, claims)
+
+
+class CPUMiniCheck:
+    """
+    MiniCheck-compatible scorer (`score(docs, claims)`) which runs on CPU. The model is
+    loaded on first use, in each of the `n_jobs` worker processes, which are kept for
+    later calls.
+    """
+
+    def __init__(
+        self,
+        model_name="roberta-large",
+        backend="int8",
+        n_jobs=1,
+        threads=1,
+        batch_size=16,
+        chunk_size=400,
+        checkpoint=None,
+    ):
+        if model_name not in CPU_MODELS:
+            raise ValueError(
+                f"{model_name} is not supported on CPU. Choose from {list(CPU_MODELS)}."
+            )
+        check_backend(backend)
+        self.model_name = model_name
+        self.model_id = f"{model_name}-{backend}"
+        self.backend = backend
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.threads = threads
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint or CPU_MODELS[model_name]
+        self._model = None
+        self._executor = None
+
+    def score(self, docs, claims):
+        chunk_docs = []
+        chunk_claims = []
+        pair_ids = []
+        for i, (doc, claim) in enumerate(zip(docs, claims)):
+            for chunk in chunk_words(doc, self.chunk_size):
+                chunk_docs.append(chunk)
+                chunk_claims.append(claim)
+                pair_ids.append(i)
+
+        batches = [
+            (chunk_docs[i : i + self.batch_size], chunk_claims[i : i + self.batch_size])
+            for i in range(0, len(chunk_docs), self.batch_size)
+        ]
+        if self.n_jobs > 1:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.n_jobs,
+                    initializer=_init_worker,
+                    initargs=(self.checkpoint, self.backend, self.threads),
+                )
+            chunk_probas = list(self._executor.map(_score_batch, batches))
+        else:
+            if self._model is None:
+                self._model = load_model(self.checkpoint, self.backend, self.threads)
+            chunk_probas = [
+                support_probas(*self._model, batch_docs, batch_claims)
+                for batch_docs, batch_claims in batches
+            ]
+
+        probas = np.zeros(len(docs))
+        if chunk_probas:
+            np.maximum.at(probas, pair_ids, np.concatenate(chunk_probas))
+        labels = (probas > 0.5).astype(int)
+        return labels.tolist(), probas.tolist(), None, None
@@ -0,0 +1,560 @@
+"""
+Incremental pipeline runner.
+
+The stages (preprocessing, summaries, facts, QA answers, NLI and salience scores) form a
+DAG of nodes. Each node is keyed by a hash of its parameters, the source code of its stage
+(including the package modules it imports) and the content of its input files. A node
+runs again only if its key changed or an output is missing; keys of completed nodes are
+stored in a state file. Nodes whose dependencies are done run in parallel.
+
+Outputs which were computed before the state file existed (or outside of the pipeline)
+are adopted with `--adopt`, which records the current keys of nodes whose outputs exist
+instead of recomputing them. If the raw data of a dataset is not available, its processed
+documents are used as they are.
+
+python -m info_salience.pipeline --dataset qmsum-generic --prompt_name qmsum-generic \
+    --model meta-llama/Meta-Llama-3.1-8B-Instruct --dry_run
+"""
+
+import ast
+import concurrent.futures
+import dataclasses
+import hashlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import List
+
+import click
+
+from info_salience.cache import content_hash
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    resolve_table,
+    table_exists,
+    table_paths,
+)
+
+DEFAULT_STATE_PATH = ".cache/pipeline_state.json"
+
+PREPROCESSING = {
+    "qmsum-generic": (
+        "info_salience.preprocessing.qmsum",
+        [],
+        ["data/raw/qmsum"],
+        [
+            "data/processed/qmsum-generic/documents.json",
+            "data/processed/qmsum-generic/metadata.json",
+        ],
+    ),
+    "pubmed-sample": (
+        "info_salience.preprocessing.pubmed_sample",
+        [],
+        ["data/raw/pubmed/articles.json"],
+        [
+            "data/processed/pubmed-sample/documents.json",
+            "data/processed/dummy/documents.json",
+        ],
+    ),
+    "astro-ph": (
+        "info_salience.preprocessing.arxiv",
+        [
+            "--raw_path",
+            "data/raw/astro-ph",
+            "--output_json",
+            "data/processed/astro-ph/documents.json",
+        ],
+        ["data/raw/astro-ph"],
+        ["data/processed/astro-ph/documents.json"],
+    ),
+    "cs-cl": (
+        "info_salience.preprocessing.arxiv",
+        [
+            "--raw_path",
+            "data/raw/cs-cl",
+            "--output_json",
+            "data/processed/cs-cl/documents.json",
+        ],
+        ["data/raw/cs-cl"],
+        ["data/processed/cs-cl/documents.json"],
+    ),
+}
+
+
+@dataclasses.dataclass
+class Node:
+    name: str
+    module: str
+    args: List[str]
+    inputs: List[str]
+    outputs: List[str]
+    # files which are removed before a rerun, such that the stage does not skip work
+    clean: List[str] = dataclasses.field(default_factory=list)
+    gpu: bool = False
+
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    """Hash of a file's content, or of all files in a directory. None if missing."""
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+        return content_hash([(str(p.relative_to(path)), file_hash(p)) for p in files])
+    if not path.exists():
+        return None
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(1 << 20), b""):
+                digest.update(block)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def artifact_hash(path):
+    """Hash of an input, which may be a stage output stored as Parquet, JSON or both."""
+    return file_hash(resolve_table(path) or path)
+
+
+def module_sources(module, seen=None):
+    """Source files of `module` and of all `info_salience` modules it imports."""
+    seen = set() if seen is None else seen
+    if module in seen:
+        return []
+    seen.add(module)
+    spec = importlib.util.find_spec(module)
+    if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+        return []
+
+    files = [spec.origin]
+    tree = ast.parse(Path(spec.origin).read_text())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module:
+            names = [node.module]
+        elif isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        else:
+            continue
+        for name in names:
+            if name.startswith("info_salience"):
+                files += module_sources(name, seen)
+    return files
+
+
+def code_version(module):
+    return content_hash(sorted(file_hash(f) for f in module_sources(module)))
+
+
+def node_key(node):
+    return content_hash(
+        node.module,
+        node.args,
+        code_version(node.module),
+        {path: artifact_hash(path) for path in node.inputs},
+    )
+
+
+def build_pipeline(
+    dataset,
+    models,
+    temperatures=(0.3,),
+    n_samples=5,
+    prompt_name="generic",
+    engine="vllm",
+    output_format=DEFAULT_OUTPUT_FORMAT,
+):
+    """Builds the nodes for one dataset and any number of summarization models."""
+    documents = f"data/processed/{dataset}/documents.json"
+    output = Path("output") / dataset
+    questions = str(output / "discord_questions.json")
+    answers = str(output / "discord_answers.json")
+    answer_facts = str(output / "discord_facts.json")
+    facts = str(output / "facts.json")
+    format_args = ["--output_format", output_format]
+    engine_args = ["--engine", engine] + format_args
+
+    nodes = []
+    if dataset in PREPROCESSING:
+        module, args, inputs, outputs = PREPROCESSING[dataset]
+        # without the raw data, existing processed documents are source inputs
+        raw_missing = any(file_hash(p) is None for p in inputs)
+        if not (raw_missing and all(Path(p).exists() for p in outputs)):
+            nodes.append(Node(f"preprocess:{dataset}", module, args, inputs, outputs))
+
+    nodes.append(
+        Node(
+            f"facts:{dataset}",
+            "info_salience.claim_extraction",
+            ["--input_json", documents, "--output_json", facts] + engine_args,
+            inputs=[documents],
+            outputs=[facts],
+            gpu=True,
+        )
+    )
+    # discord_questions.json is created in notebooks/20-qgen.ipynb
+    nodes.append(
+        Node(
+            f"qa:{dataset}",
+            "info_salience.qa",
+            [
+                "--documents_json",
+                documents,
+                "--questions_json",
+                questions,
+                "--answers_json",
+                answers,
+                "--answer_facts_json",
+                answer_facts,
+            ]
+            + engine_args,
+            inputs=[documents, questions],
+            outputs=[answers, answer_facts],
+            gpu=True,
+        )
+    )
+
+    for model in models:
+        model_path = output / Path(model).name
+        for temperature in temperatures:
+            temperature = float(temperature)
+            n = 1 if temperature == 0 else n_samples
+            summaries = [
+                str(model_path / "summaries" / f"temperature{temperature}-{i}.json")
+                for i in range(n)
+            ]
+            nodes.append(
+                Node(
+                    f"summaries:{model_path.name}:{temperature}",
+                    "info_salience.summarization",
+                    [
+                        "--input_json",
+                        documents,
+                        "--output_path",
+                        str(model_path / "summaries"),
+                        "--model",
+                        model,
+                        "--temperature",
+                        str(temperature),
+                        "--n_samples",
+                        str(n),
+                        "--prompt_name",
+                        prompt_name,
+                    ]
+                    + engine_args,
+                    inputs=[documents],
+                    outputs=summaries,
+                    clean=[
+                        str(
+                            model_path
+                            / "summaries"
+                            / f"temperature{temperature}.checkpoint.jsonl"
+                        )
+                    ],
+                    gpu=True,
+                )
+            )
+
+            nli_files = []
+            for i, summary in enumerate(summaries):
+                nli_file = str(Path(summary.replace("/summaries/", "/discord-qa-nli/")))
+                nli_files.append(nli_file)
+                nodes.append(
+                    Node(
+                        f"nli:{model_path.name}:{temperature}:{i}",
+                        "info_salience.claim_entailment",
+                        ["--facts_path", answer_facts, "--summaries_path", summary]
+                        + format_args,
+                        inputs=[answer_facts, summary],
+                        outputs=[nli_file],
+                        gpu=True,
+                    )
+                )
+                # entailment of the document facts in the summary (used in
+                # notebooks/60-incremental-consistency.ipynb)
+                nodes.append(
+                    Node(
+                        f"nli-facts:{model_path.name}:{temperature}:{i}",
+                        "info_salience.claim_entailment",
+                        ["--facts_path", facts, "--summaries_path", summary]
+                        + format_args,
+                        inputs=[facts, summary],
+                        outputs=[str(Path(summary.replace("/summaries/", "/nli/")))],
+                        gpu=True,
+                    )
+                )
+
+            salience = str(model_path / f"salience-temperature{temperature}.json")
+            nodes.append(
+                Node(
+                    f"salience:{model_path.name}:{temperature}",
+                    "info_salience.salience",
+                    [arg for f in nli_files for arg in ["--nli_json", f]]
+                    + ["--questions_json", questions, "--output_json", salience]
+                    + format_args,
+                    inputs=nli_files + [questions],
+                    outputs=[salience],
+                )
+            )
+    return nodes
+
+
+class Pipeline:
+    """Plans and runs a DAG of nodes. Dependencies are derived from inputs and outputs."""
+
+    def __init__(self, nodes, state_path=DEFAULT_STATE_PATH):
+        self.nodes = {node.name: node for node in nodes}
+        producers = {path: node.name for node in nodes for path in node.outputs}
+        self.deps = {
+            node.name: sorted({producers[p] for p in node.inputs if p in producers})
+            for node in nodes
+        }
+        self.state_path = Path(state_path)
+        self.state = {}
+        if self.state_path.exists():
+            self.state = json.loads(self.state_path.read_text())
+        self._lock = threading.Lock()
+
+    def order(self):
+        """Nodes in topological order."""
+        order = []
+        visited = set()
+
+        def visit(name, path=()):
+            if name in path:
+                raise ValueError(f"Cycle in pipeline: {' -> '.join(path + (name,))}")
+            if name in visited:
+                return
+            for dep in self.deps[name]:
+                visit(dep, path + (name,))
+            visited.add(name)
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name)
+        return order
+
+    def reason(self, name, stale):
+        """Why a node must run, or None if it is up to date."""
+        node = self.nodes[name]
+        stale_deps = [dep for dep in self.deps[name] if dep in stale]
+        if stale_deps:
+            return f"upstream: {', '.join(stale_deps)}"
+        missing = [p for p in node.inputs if artifact_hash(p) is None]
+        if missing:
+            return f"missing inputs: {', '.join(missing)}"
+        if name not in self.state:
+            return "never run"
+        if self.state[name]["key"] != node_key(node):
+            return "inputs, code or parameters changed"
+        if any(not table_exists(p) for p in node.outputs):
+            return "missing outputs"
+        return None
+
+    def plan(self):
+        """Returns (node name, reason) in run order. Reason is None for fresh nodes."""
+        stale = {}
+        for name in self.order():
+            reason = self.reason(name, stale)
+            if reason is not None:
+                stale[name] = reason
+        return [(name, stale.get(name)) for name in self.order()]
+
+    def adopt(self, dry_run=False):
+        """
+        Records the keys of nodes which were never run, but whose inputs and outputs
+        exist, such that existing outputs are not recomputed. Returns their names. With
+        `dry_run`, the keys are only kept in memory (for the plan) and not written.
+        """
+        adopted = []
+        for name in self.order():
+            node = self.nodes[name]
+            if name in self.state:
+                continue
+            if any(artifact_hash(p) is None for p in node.inputs):
+                continue
+            if not all(table_exists(p) for p in node.outputs):
+                continue
+            if dry_run:
+                self.state[name] = {"key": node_key(node)}
+            else:
+                self._save(name, node_key(node))
+            adopted.append(name)
+        return adopted
+
+    def _save(self, name, key):
+        with self._lock:
+            self.state[name] = {"key": key}
+            self.state_path.parent.mkdir(exist_ok=True, parents=True)
+            tmp = self.state_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.state, indent=2, sort_keys=True))
+            os.replace(tmp, self.state_path)
+
+    def _run_node(self, name, gpu_slots):
+        node = self.nodes[name]
+        missing = [p for p in node.inputs if artifact_hash(p) is None]
+        if missing:
+            print(f"[{name}] Missing inputs: {', '.join(missing)}", flush=True)
+            return False
+        key = node_key(node)
+        # the node may be fresh after all, if upstream reruns reproduced its inputs
+        if self.state.get(name, {}).get("key") == key and all(
+            table_exists(p) for p in node.outputs
+        ):
+            print(f"[{name}] Up to date.", flush=True)
+            return True
+
+        for path in node.outputs:
+            for table_path in table_paths(path, "both"):
+                table_path.unlink(missing_ok=True)
+        for path in node.clean:
+            Path(path).unlink(missing_ok=True)
+        command = [sys.executable, "-m", node.module, *node.args]
+        print(f"[{name}] Run: {' '.join(command)}", flush=True)
+        if node.gpu:
+            gpu_slots.acquire()
+        try:
+            returncode = subprocess.call(command)
+        finally:
+            if node.gpu:
+                gpu_slots.release()
+
+        missing = [p for p in node.outputs if not table_exists(p)]
+        if returncode != 0 or missing:
+            print(
+                f"[{name}] Failed (exit code {returncode}, missing: {missing})",
+                flush=True,
+            )
+            return False
+        self._save(name, key)
+        print(f"[{name}] Done.", flush=True)
+        return True
+
+    def run(self, jobs=1, gpu_jobs=1):
+        """Runs stale nodes, at most `jobs` at a time and `gpu_jobs` of them on GPU."""
+        plan = dict(self.plan())
+        done = {name for name, reason in plan.items() if reason is None}
+        failed = set()
+        running = {}
+        gpu_slots = threading.Semaphore(gpu_jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while True:
+                for name in self.order():
+                    if name in done or name in failed or name in running.values():
+                        continue
+                    if any(dep in failed for dep in self.deps[name]):
+                        print(f"[{name}] Skipped, upstream failed.", flush=True)
+                        failed.add(name)
+                    elif all(dep in done for dep in self.deps[name]):
+                        future = executor.submit(self._run_node, name, gpu_slots)
+                        running[future] = name
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    name = running.pop(future)
+                    (done if future.result() else failed).add(name)
+        return done, failed
+
+
+@click.command()
+@click.option("--dataset", required=True, help="Dataset name, e.g., qmsum-generic.")
+@click.option(
+    "--model",
+    "models",
+    multiple=True,
+    default=["meta-llama/Meta-Llama-3.1-8B-Instruct"],
+    help="Summarization model. Can be given multiple times.",
+)
+@click.option(
+    "--temperature",
+    "temperatures",
+    multiple=True,
+    default=[0.3],
+    type=float,
+    help="Sampling temperature. Can be given multiple times.",
+)
+@click.option("--n_samples", default=5, type=int, help="Number of output samples.")
+@click.option("--prompt_name", default="generic", help="Name of the prompt to use.")
+@click.option("--engine", default="vllm", help="Inference engine of the LLM stages.")
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store stage outputs as Parquet, JSON records, or both.",
+)
+@click.option(
+    "--state_path", default=DEFAULT_STATE_PATH, help="Path to the state file."
+)
+@click.option("--jobs", default=1, type=int, help="Number of nodes to run in parallel.")
+@click.option("--gpu_jobs", default=1, type=int, help="Number of parallel GPU nodes.")
+@click.option(
+    "--adopt",
+    is_flag=True,
+    default=False,
+    help="Record existing outputs of nodes without state as up to date. With --dry_run, "
+    "only print which nodes would be adopted.",
+)
+@click.option(
+    "--dry_run", is_flag=True, default=False, help="Print the plan without running."
+)
+def main(
+    dataset,
+    models,
+    temperatures,
+    n_samples,
+    prompt_name,
+    engine,
+    output_format,
+    state_path,
+    jobs,
+    gpu_jobs,
+    adopt,
+    dry_run,
+):
+    nodes = build_pipeline(
+        dataset,
+        models,
+        temperatures=temperatures,
+        n_samples=n_samples,
+        prompt_name=prompt_name,
+        engine=engine,
+        output_format=output_format,
+    )
+    pipeline = Pipeline(nodes, state_path=state_path)
+    if adopt:
+        adopted = pipeline.adopt(dry_run=dry_run)
+        print(
+            f"{'Would adopt' if dry_run else 'Adopted'} {len(adopted)} node(s) with "
+            "existing outputs."
+        )
+        for name in adopted:
+            print(f"  {name}")
+    plan = pipeline.plan()
+    for name, reason in plan:
+        print(
+            f"{'RUN ' if reason else 'SKIP'} {name}"
+            + (f" ({reason})" if reason else "")
+        )
+    print(f"{sum(r is not None for _, r in plan)}/{len(plan)} nodes to run.")
+    if dry_run:
+        return
+
+    done, failed = pipeline.run(jobs=jobs, gpu_jobs=gpu_jobs)
+    print(f"Done: {len(done)}, failed: {len(failed)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,39 @@
 import itertools
 import json
 import logging
+from pathlib import Path
 
 import click
 import outlines
 import pandas as pd
+from json_repair import repair_json
 
-from info_salience.claim_extraction import extract_facts_from_texts
-from info_salience.llm import VLLMGenerator
+from info_salience.claim_extraction import (
+    DEFAULT_FACT_CACHE_PATH,
+    extract_facts_from_texts,
+    fit_fact_context,
+    load_fact_cache,
+)
+from info_salience.llm import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SERVER_URL,
+    GenerationCache,
+    load_generator,
+)
+from info_salience.retrieval import CHUNK_MODES, Retriever, chunk_mode, decision_changes
+from info_salience.segmentation import (
+    DEFAULT_SEGMENTATION_CACHE_PATH,
+    SegmentationCache,
+)
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    read_table,
+    write_table,
+)
+
+MAX_TOKENS = 512
+JOINT_MAX_TOKENS_PER_QUESTION = 256
 
 
 @outlines.prompt
@@ -33,6 +59,32 @@ def qa_prompt(text, question):
     """
 
 
+@outlines.prompt
+def qa_prompt_joint(text, questions):
+    """
+    Answer each of the following questions given the text. If a question cannot be answered with the text, reply "no answer" for that question.
+
+    ## Text
+    {{ text }}
+
+    ## Questions
+    {% for question in questions %}
+    {{ question.cluster_id }}: {{ question.centroid }}
+    {% endfor %}
+
+    First, carefully read and analyze both the text and the questions. Then provide the answers. Please follow these guidelines:
+    - If a question cannot be answered, reply with "no answer"
+    - Use only information explicitly stated in or directly implied by the text
+    - Do not include any external knowledge or personal opinions
+    - Aim for concise answers that include all important points relevant to the question
+
+    Respond with a JSON object which maps each question ID to its answer:
+    {
+        "[question ID]": "[the answer based on the text or \"no answer\"]"
+    }
+    """
+
+
 def parse_response(response):
     response = response.strip()
     try:
@@ -46,18 +98,35 @@ def parse_response(response):
     return answer
 
 
+def build_messages(texts, questions):
+    return [
+        [{"role": "user", "content": qa_prompt(text, question)}]
+        for text, question in zip(texts, questions)
+    ]
+
+
+def build_messages_joint(documents, questions):
+    return [
+        [{"role": "user", "content": qa_prompt_joint(doc["text"], questions)}]
+        for doc in documents
+    ]
+
+
 def question_answering(llm, texts, questions):
-    prompts = []
-    for text, question in zip(texts, questions):
-        prompt = [{"role": "user", "content": qa_prompt(text, question)}]
-        prompts.append(prompt)
+    prompts = build_messages(texts, questions)
     print("=" * 40, "Example QA Prompt", "=" * 40)
     print(prompts[0][0]["content"])
 
-    responses = llm.generate(prompts, temperature=0.7, min_tokens=2, max_tokens=512)
+    responses = llm.generate(
+        prompts, temperature=0.7, min_tokens=2, max_tokens=MAX_TOKENS
+    )
 
     answers = []
     for prompt, response in zip(prompts, responses):
+        if not response:
+            # no output, e.g., if the prompt is too long or the request failed
+            answers.append(None)
+            continue
         response = response[0]
         try:
             answer = parse_response(response)
@@ -71,6 +140,69 @@ def question_answering(llm, texts, questions):
     return answers
 
 
+def joint_schema(questions):
+    keys = [str(question["cluster_id"]) for question in questions]
+    return {
+        "type": "object",
+        "properties": {key: {"type": "string"} for key in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
+
+
+def question_answering_joint(llm, documents, questions):
+    """
+    Answers all questions of a document in one schema-constrained call.
+
+    Returns one answer per (document, question) pair in the same order as
+    `itertools.product(documents, questions)`. Questions which are missing from the
+    response are answered with separate per-question calls.
+    """
+    prompts = build_messages_joint(documents, questions)
+    print("=" * 40, "Example joint QA Prompt", "=" * 40)
+    print(prompts[0][0]["content"])
+
+    responses = llm.generate(
+        prompts,
+        schema=joint_schema(questions),
+        temperature=0.7,
+        max_tokens=JOINT_MAX_TOKENS_PER_QUESTION * len(questions),
+    )
+
+    answers = []
+    missing = []
+    for doc, response in zip(documents, responses):
+        try:
+            parsed = repair_json(response[0], return_objects=True)
+        except (IndexError, RecursionError):
+            parsed = {}
+        if not isinstance(parsed, dict):
+            parsed = {}
+
+        for question in questions:
+            answer = parsed.get(str(question["cluster_id"]))
+            if not isinstance(answer, str) or not answer.strip():
+                missing.append(len(answers))
+                answer = None
+            answers.append(answer)
+
+    if missing:
+        print(
+            f"Joint QA: {len(missing)}/{len(answers)} answers missing. "
+            "Fall back to per-question calls."
+        )
+        pairs = list(itertools.product(documents, questions))
+        fallback = question_answering(
+            llm,
+            texts=[pairs[i][0]["text"] for i in missing],
+            questions=[pairs[i][1]["centroid"] for i in missing],
+        )
+        for i, answer in zip(missing, fallback):
+            answers[i] = answer
+
+    return answers
+
+
 def is_non_answer(answer):
     if not answer:
         return True
@@ -81,6 +213,106 @@ def is_non_answer(answer):
     )
 
 
+def fit_qa_context(llm, texts, questions, qa_mode="per_question"):
+    """
+    Sizes the context window of `llm` for answering `questions` on each of `texts`. In
+    joint mode, this includes the per-question fallback.
+    """
+    if qa_mode == "joint":
+        llm.fit_context(
+            build_messages_joint([{"text": text} for text in texts], questions),
+            max_tokens=JOINT_MAX_TOKENS_PER_QUESTION * len(questions),
+        )
+    # the longest prompt per text is the one with the longest question
+    longest = max((question["centroid"] for question in questions), key=len)
+    llm.fit_context(
+        build_messages(texts, [longest] * len(texts)), max_tokens=MAX_TOKENS
+    )
+
+
+def fit_decompose_context(llm):
+    """Sizes the context window of `llm` for `decompose_answers`."""
+    # no answer sentence is longer than an answer
+    fit_fact_context(llm, [" ".join(["answer"] * MAX_TOKENS)])
+
+
+def answer_questions(llm, documents, questions, qa_mode="per_question", retriever=None):
+    """
+    Answers every question on every document. Non-answers are set to "no answer". With a
+    `retriever` (built on the texts of `documents`), prompts only contain the chunks
+    which are relevant to the question (to all questions in joint mode).
+
+    The context window of `llm` is sized to the QA prompts, unless the engine is
+    already loaded (see `fit_qa_context`).
+    """
+    pairs = list(itertools.product(range(len(documents)), questions))
+    doc_ids = [documents[i]["doc_id"] for i, _ in pairs]
+    qs = [question["centroid"] for _, question in pairs]
+    q_ids = [question["cluster_id"] for _, question in pairs]
+
+    if qa_mode == "joint":
+        if retriever is not None:
+            query = " ".join(question["centroid"] for question in questions)
+            documents = [
+                {**doc, "text": retriever.context(i, query)}
+                for i, doc in enumerate(documents)
+            ]
+        fit_qa_context(llm, [doc["text"] for doc in documents], questions, qa_mode)
+        answers = question_answering_joint(
+            llm=llm, documents=documents, questions=questions
+        )
+    else:
+        if retriever is None:
+            texts = [documents[i]["text"] for i, _ in pairs]
+            fit_qa_context(llm, [doc["text"] for doc in documents], questions, qa_mode)
+        else:
+            texts = [
+                retriever.context(i, question) for (i, _), question in zip(pairs, qs)
+            ]
+            llm.fit_context(build_messages(texts, qs), max_tokens=MAX_TOKENS)
+        answers = question_answering(llm=llm, texts=texts, questions=qs)
+    answers = ["no answer" if is_non_answer(answer) else answer for answer in answers]
+    return pd.DataFrame(
+        {
+            "doc_id": doc_ids,
+            "cluster_id": q_ids,
+            "question": qs,
+            "reference_answer": answers,
+        }
+    )
+
+
+def decompose_answers(llm, df_answers, fact_cache=None, max_retries=1):
+    """
+    Splits each answer into atomic claims, one row per (answer sentence, claim). Also
+    returns a report of claim extraction parse failures.
+    """
+    df_filtered = df_answers[df_answers["reference_answer"] != "no answer"]
+    columns = ["doc_id", "cluster_id", "question", "sent_id", "sent", "fact"]
+    # Tuples of (text_id, sent_id, sent, fact)
+    fact_data, report = extract_facts_from_texts(
+        df_filtered["reference_answer"].values,
+        llm=llm,
+        fact_cache=fact_cache,
+        max_retries=max_retries,
+    )
+    if not fact_data:
+        return pd.DataFrame(columns=columns), report
+
+    text_ids, sent_ids, sents, facts = zip(*fact_data)
+    df_facts = pd.DataFrame(
+        {
+            "doc_id": [df_filtered.iloc[i]["doc_id"] for i in text_ids],
+            "cluster_id": [df_filtered.iloc[i]["cluster_id"] for i in text_ids],
+            "question": [df_filtered.iloc[i]["question"] for i in text_ids],
+            "sent_id": sent_ids,
+            "sent": sents,
+            "fact": facts,
+        }
+    )
+    return df_facts, report
+
+
 @click.command()
 @click.option(
     "--documents_json",
@@ -102,63 +334,168 @@ def is_non_answer(answer):
     help="Path to store answer facts at.",
     required=True,
 )
-def main(documents_json, questions_json, answers_json, answer_facts_json):
+@click.option(
+    "--qa_mode",
+    default="per_question",
+    type=click.Choice(["per_question", "joint"]),
+    help="Answer each (document, question) pair separately, or all questions of a document in one structured call.",
+)
+@click.option(
+    "--retrieval_budget",
+    default=None,
+    type=int,
+    help="Narrow each QA prompt to the most relevant chunks within this many tokens "
+    "(default: full documents).",
+)
+@click.option(
+    "--retrieval_top_k",
+    default=None,
+    type=int,
+    help="Maximum number of chunks per prompt (default: as many as fit the budget).",
+)
+@click.option(
+    "--chunk_by",
+    default="auto",
+    type=click.Choice(CHUNK_MODES),
+    help="Chunk documents at speaker turns or sentences (auto: turns for QMSum).",
+)
+@click.option(
+    "--full_answers_json",
+    default=None,
+    help="Answers of a full-context run, to report changed answer/no-answer decisions.",
+)
+@click.option(
+    "--segmentation_cache_path",
+    default=DEFAULT_SEGMENTATION_CACHE_PATH,
+    help="Path to the sentence segmentation cache. Pass an empty string to disable it.",
+)
+@click.option(
+    "--engine",
+    default="vllm",
+    help="Inference engine to use (vllm|litellm|server|fake|replay|record:<engine>).",
+)
+@click.option(
+    "--server_url",
+    default=DEFAULT_SERVER_URL,
+    help="URL of the generation server (--engine server).",
+)
+@click.option(
+    "--cache_path",
+    default=DEFAULT_CACHE_PATH,
+    help="Path to the generation cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--recording_path",
+    default=None,
+    help="Path to the recording of --engine record:<engine> and --engine replay.",
+)
+@click.option(
+    "--fact_cache_path",
+    default=DEFAULT_FACT_CACHE_PATH,
+    help="Path to the sentence-level fact cache. Pass an empty string to disable it.",
+)
+@click.option(
+    "--max_retries",
+    default=1,
+    type=int,
+    help="Number of batched retry rounds for claims which cannot be parsed.",
+)
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
+def main(
+    documents_json,
+    questions_json,
+    answers_json,
+    answer_facts_json,
+    qa_mode,
+    retrieval_budget,
+    retrieval_top_k,
+    chunk_by,
+    full_answers_json,
+    segmentation_cache_path,
+    engine,
+    server_url,
+    cache_path,
+    recording_path,
+    fact_cache_path,
+    max_retries,
+    output_format,
+):
     with open(documents_json) as fin:
         documents = json.load(fin)
 
     with open(questions_json) as fin:
         questions = json.load(fin)
 
-    llm = VLLMGenerator("meta-llama/Meta-Llama-3.1-8B-Instruct")
+    cache = GenerationCache(cache_path) if cache_path else None
+    llm = load_generator(
+        engine,
+        "meta-llama/Meta-Llama-3.1-8B-Instruct",
+        cache=cache,
+        server_url=server_url,
+        recording_path=recording_path,
+    )
+    telemetry_file = Path(answers_json).with_suffix(".telemetry.jsonl")
+    llm.telemetry.tags.update(stage="qa", dataset=Path(documents_json).parent.name)
+    # The engine is sized by the first generation, answers are split into claims later on
+    fit_decompose_context(llm)
 
     ######################################################
     # Generate answers for discord questions on the source document
     ######################################################
     print("Generate answers for discord questions")
-    data = [
-        (
-            doc["doc_id"],
-            doc["text"],
-            question["centroid"],
-            question["cluster_id"],
+    retriever = None
+    if retrieval_budget is not None:
+        dataset = Path(documents_json).parent.name
+        retriever = Retriever(
+            [doc["text"] for doc in documents],
+            mode=chunk_mode(dataset) if chunk_by == "auto" else chunk_by,
+            token_budget=retrieval_budget,
+            top_k=retrieval_top_k,
+            segmentation_cache=(
+                SegmentationCache(segmentation_cache_path)
+                if segmentation_cache_path
+                else None
+            ),
         )
-        for doc, question in itertools.product(documents, questions)
-    ]
-    doc_ids, texts, qs, q_ids = zip(*data)
-
-    answers = question_answering(llm=llm, texts=texts, questions=qs)
-    answers = ["no answer" if is_non_answer(answer) else answer for answer in answers]
-    df_answers = pd.DataFrame(
-        {
-            "doc_id": doc_ids,
-            "cluster_id": q_ids,
-            "question": qs,
-            "reference_answer": answers,
-        }
+    df_answers = answer_questions(
+        llm, documents, questions, qa_mode=qa_mode, retriever=retriever
     )
-    df_answers.to_json(answers_json, orient="records")
+    write_table(df_answers, answers_json, output_format)
+    if retriever is not None:
+        report = retriever.report()
+        if full_answers_json:
+            report["decisions"] = decision_changes(
+                df_answers, read_table(full_answers_json)
+            )
+        print(f"Retrieval: {json.dumps(report, indent=2)}")
+        with open(Path(answers_json).with_suffix(".retrieval.json"), "w") as fout:
+            json.dump(report, fout)
+    llm.telemetry.flush(telemetry_file)
 
     ######################################################
     # Split answers into a list of atomic claims
     ######################################################
     print("Split each answer sentence into list of atomic claims")
-    df_filtered = df_answers[df_answers["reference_answer"] != "no answer"]
-    # Tuples of (text_id, sent_id, sent, fact)
-    fact_data = extract_facts_from_texts(
-        df_filtered["reference_answer"].values, llm=llm
+    llm.telemetry.tags["stage"] = "qa_claim_extraction"
+    fact_cache = load_fact_cache(fact_cache_path, engine)
+    df_facts, report = decompose_answers(
+        llm, df_answers, fact_cache=fact_cache, max_retries=max_retries
     )
-    text_ids, sent_ids, sents, facts = zip(*fact_data)
-    df_facts = pd.DataFrame(
-        {
-            "doc_id": [df_filtered.iloc[i]["doc_id"] for i in text_ids],
-            "cluster_id": [df_filtered.iloc[i]["cluster_id"] for i in text_ids],
-            "question": [df_filtered.iloc[i]["question"] for i in text_ids],
-            "sent_id": sent_ids,
-            "sent": sents,
-            "fact": facts,
-        }
-    )
-    df_facts.to_json(answer_facts_json, orient="records")
+    write_table(df_facts, answer_facts_json, output_format)
+    with open(Path(answer_facts_json).with_suffix(".meta.json"), "w") as fout:
+        json.dump(report, fout)
+    llm.telemetry.flush(telemetry_file)
+
+    if cache is not None:
+        print(f"Generation cache: {cache.stats()}")
+    if fact_cache is not None:
+        print(f"Fact cache: {fact_cache.stats()}")
+    llm.telemetry.print_summary()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,22 @@
+import base64
 import json
-from typing import List
-from json_repair import repair_json
+import pickle
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+import click
+import numpy as np
 import outlines
+import pandas as pd
+from json_repair import repair_json
+
+from info_salience.cache import DiskCache, content_hash
+
+EMBEDDING_MODEL = "all-mpnet-base-v2"
+DEFAULT_EMBEDDING_CACHE_PATH = ".cache/embeddings.sqlite"
+# cosine similarity above which two questions are near-duplicates
+DEFAULT_DEDUP_THRESHOLD = 0.95
 
 TOPICS = {
     "pubmed": "Randomized controlled trials (RCT) in the clinical domain.",
@@ -141,3 +156,443 @@ def generate_questions(
                 questions.append(qa_pair["question"])
 
     return questions
+
+
+class EmbeddingCache(DiskCache):
+    """Normalized float32 embeddings (base64-encoded) per (model, text)."""
+
+    def __init__(self, path=DEFAULT_EMBEDDING_CACHE_PATH):
+        super().__init__(path)
+
+    def key(self, model, text):
+        return content_hash(model, text)
+
+
+def encode_embedding(embedding):
+    return base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode()
+
+
+def decode_embedding(value):
+    return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+
+
+class QuestionEmbedder:
+    """
+    Embeds questions with a SentenceTransformer, which is loaded on first use. Only
+    questions which are missing from the cache are encoded.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL, cache=None):
+        self.model_name = model_name
+        self.cache = cache
+        self._model = None
+
+    def encode(self, questions):
+        keys = [content_hash(self.model_name, question) for question in questions]
+        found = self.cache.get_many(keys) if self.cache is not None else {}
+        missing = {
+            key: question for key, question in zip(keys, questions) if key not in found
+        }
+        if missing:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self._model = SentenceTransformer(self.model_name)
+            embeddings = self._model.encode(
+                list(missing.values()), normalize_embeddings=True
+            )
+            encoded = {
+                key: encode_embedding(embedding)
+                for key, embedding in zip(missing, embeddings)
+            }
+            if self.cache is not None:
+                self.cache.put_many(encoded)
+            found.update(encoded)
+        return np.stack([decode_embedding(found[key]) for key in keys])
+
+    def __getstate__(self):
+        # the model and the cache connection are not pickled
+        return {"model_name": self.model_name, "cache": None, "_model": None}
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+def exact_duplicates(questions):
+    """
+    Index of the first occurrence of each distinct question (ignoring case and
+    whitespace), and the position of each question among them.
+    """
+    first = {}
+    inverse = np.array(
+        [first.setdefault(normalize_question(q), len(first)) for q in questions],
+        dtype=int,
+    )
+    unique_ids = np.zeros(len(first), dtype=int)
+    # the first occurrence is written last
+    unique_ids[inverse[::-1]] = np.arange(len(questions))[::-1]
+    return unique_ids, inverse
+
+
+def near_duplicates(embeddings, threshold=DEFAULT_DEDUP_THRESHOLD, n_neighbors=10):
+    """
+    Groups normalized embeddings whose cosine similarity is at least `threshold`, using
+    an approximate nearest neighbour graph. Each group is a star around its first member
+    (the representative): later embeddings join the group of the first representative
+    they are similar to, so groups do not chain transitively. Returns the group of each
+    embedding, where groups are numbered in order of their representative.
+    """
+    from scipy.sparse import coo_matrix
+
+    n = len(embeddings)
+    if n <= n_neighbors + 1:
+        similarities = embeddings @ embeddings.T
+        rows, cols = np.nonzero(similarities >= threshold)
+    else:
+        from pynndescent import NNDescent
+
+        index = NNDescent(
+            embeddings, metric="cosine", n_neighbors=n_neighbors, random_state=42
+        )
+        neighbors, distances = index.neighbor_graph
+        rows, cols = np.nonzero(1 - distances >= threshold)
+        cols = neighbors[rows, cols]
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    graph = (graph + graph.T).tocsr()
+
+    groups = np.full(n, -1, dtype=int)
+    n_groups = 0
+    for i in range(n):
+        if groups[i] >= 0:
+            continue
+        # i is the representative of a new group, and earlier embeddings are grouped
+        neighbors = graph.indices[graph.indptr[i] : graph.indptr[i + 1]]
+        neighbors = neighbors[groups[neighbors] < 0]
+        groups[neighbors] = n_groups
+        groups[i] = n_groups
+        n_groups += 1
+    return groups
+
+
+def deduplicate_questions(questions, embedder, threshold=DEFAULT_DEDUP_THRESHOLD):
+    """
+    Collapses verbatim and near-verbatim duplicates. Returns the index of the first
+    question of each group, the group of each question, and the embeddings of all
+    questions. Only distinct questions are encoded.
+    """
+    if len(questions) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros((0, 0), dtype=np.float32)
+    exact_ids, exact_inverse = exact_duplicates(questions)
+    exact_embeddings = embedder.encode([questions[i] for i in exact_ids])
+    groups = near_duplicates(exact_embeddings, threshold)[exact_inverse]
+
+    unique_ids = np.zeros(groups.max() + 1 if len(groups) else 0, dtype=int)
+    unique_ids[groups[::-1]] = np.arange(len(questions))[::-1]
+    print(
+        f"Deduplicated {len(questions)} questions: {len(exact_ids)} distinct, "
+        f"{len(unique_ids)} after merging near-duplicates."
+    )
+    return unique_ids, groups, exact_embeddings[exact_inverse]
+
+
+class QuestionClusters:
+    """
+    UMAP + HDBSCAN clustering of questions. `fit` clusters all questions from scratch,
+    and `add` assigns new questions to the existing clusters by approximate prediction,
+    without refitting. The fitted state can be saved and loaded again.
+
+    If `dedup_threshold` is given, duplicates are collapsed before fitting, and only one
+    question per group is clustered. All questions of a group get its cluster, such that
+    cluster sizes include duplicates. This changes the clusters: HDBSCAN does not see
+    the multiplicity of a question, and `min_cluster_size` counts distinct questions.
+    """
+
+    def __init__(
+        self,
+        min_cluster_size=5,
+        min_samples=None,
+        embedder=None,
+        dedup_threshold=None,
+    ):
+        self.min_cluster_size = min_cluster_size
+        self.min_samples = min_samples
+        self.embedder = embedder or QuestionEmbedder()
+        self.dedup_threshold = dedup_threshold
+        self.questions = []
+        self.embeddings = None
+        self.assignments = None
+        self.umap_model = None
+        self.clusterer = None
+
+    def fit(self, questions):
+        import hdbscan
+        import umap
+
+        if self.dedup_threshold is None:
+            embeddings = self.embedder.encode(questions)
+            unique_ids = np.arange(len(questions))
+            groups = unique_ids
+        else:
+            unique_ids, groups, embeddings = deduplicate_questions(
+                questions, self.embedder, self.dedup_threshold
+            )
+
+        self.umap_model = umap.UMAP(
+            n_neighbors=15,
+            n_components=5,
+            min_dist=0.0,
+            metric="cosine",
+            n_jobs=1,
+            random_state=42,
+        )
+        embeddings_ = self.umap_model.fit_transform(embeddings[unique_ids])
+
+        self.clusterer = hdbscan.HDBSCAN(
+            min_cluster_size=self.min_cluster_size,
+            min_samples=self.min_samples,
+            cluster_selection_method="leaf",
+            prediction_data=True,
+        )
+        self.clusterer.fit(embeddings_)
+        self.questions = list(questions)
+        self.embeddings = embeddings
+        self.assignments = self.clusterer.labels_[groups]
+        return self.assignments
+
+    def add(self, questions):
+        """
+        Adds questions to the clustering and returns their cluster ids. Questions which
+        were already clustered keep their cluster.
+        """
+        import hdbscan
+
+        if self.clusterer is None:
+            raise ValueError("The clustering has to be fitted before adding questions.")
+        if not questions:
+            return np.array([], dtype=int)
+
+        embeddings = self.embedder.encode(questions)
+        known = dict(zip(self.questions, self.assignments))
+        new = [i for i, question in enumerate(questions) if question not in known]
+        assignments = np.array([known.get(question, -1) for question in questions])
+        if new:
+            labels, _ = hdbscan.approximate_predict(
+                self.clusterer, self.umap_model.transform(embeddings[new])
+            )
+            assignments[new] = labels
+
+        self.questions += list(questions)
+        self.embeddings = np.vstack([self.embeddings, embeddings])
+        self.assignments = np.concatenate([self.assignments, assignments])
+        return assignments
+
+    def save(self, path):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "wb") as fout:
+            pickle.dump(self, fout)
+
+    @classmethod
+    def load(cls, path, embedder=None):
+        with open(path, "rb") as fin:
+            clusters = pickle.load(fin)
+        if embedder is not None:
+            clusters.embedder = embedder
+        return clusters
+
+
+def cluster_questions(
+    questions,
+    min_cluster_size=5,
+    min_samples=None,
+    cache=None,
+    dedup_threshold=None,
+):
+    """
+    Embeddings and cluster ids of `questions`. Deduplication is off by default, as it
+    changes the clusters (see `QuestionClusters`).
+    """
+    clusters = QuestionClusters(
+        min_cluster_size,
+        min_samples,
+        embedder=QuestionEmbedder(cache=cache),
+        dedup_threshold=dedup_threshold,
+    )
+    clusters.fit(questions)
+    return clusters.embeddings, clusters.assignments
+
+
+def calculate_centroids(questions, embeddings, assignments) -> Dict[int, str]:
+    """
+    The question of each cluster which is most similar to the mean embedding of the
+    cluster, computed for all clusters at once.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    cluster_ids, inverse = np.unique(np.asarray(assignments), return_inverse=True)
+    sums = np.zeros((len(cluster_ids), embeddings.shape[1]))
+    np.add.at(sums, inverse, embeddings)
+    means = sums / np.bincount(inverse)[:, None]
+
+    # cosine similarity of each question with the mean of its cluster
+    cluster_means = means[inverse]
+    norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(cluster_means, axis=1)
+    scores = np.einsum("ij,ij->i", embeddings, cluster_means) / np.maximum(norms, 1e-12)
+
+    # per cluster, the highest score (the first question on ties)
+    order = np.lexsort((np.arange(len(scores)), -scores, inverse))
+    best = order[np.r_[0, np.flatnonzero(np.diff(inverse[order])) + 1]]
+    return {
+        cluster_id: questions[i] for cluster_id, i in zip(cluster_ids.tolist(), best)
+    }
+
+
+def aggregate_data(questions, assignments, centroids):
+    df_questions = pd.DataFrame({"question": questions, "cluster_id": assignments})
+    df_centroids = pd.DataFrame(
+        {"cluster_id": centroids.keys(), "centroid": centroids.values()}
+    )
+
+    df_agg = pd.merge(
+        df_questions.groupby("cluster_id")["question"].apply(list),
+        df_centroids,
+        on="cluster_id",
+    )
+    df_agg["cluster_size"] = df_agg["question"].apply(len)
+    df_agg = df_agg.set_index("cluster_id")
+    return df_agg
+
+
+def generate_report(df_agg):
+    n_questions = df_agg["cluster_size"].sum()
+    n_clusters = len(df_agg)
+
+    print("=" * 80)
+    print(f"Total generated questions: {n_questions}")
+    print(f"Number of clusters: {n_clusters}")
+    if -1 in df_agg.index:
+        n_clusters = n_clusters - 1
+        n_noise = df_agg.loc[-1]["cluster_size"]
+        print(f"Classified as noise: {n_noise} ({n_noise/n_questions*100:.2f}%)")
+    print("=" * 80)
+
+    print(
+        df_agg.loc[0:]
+        .sort_values("cluster_size", ascending=False)[["centroid", "cluster_size"]]
+        .to_markdown()
+    )
+
+    print()
+
+    for index, row in df_agg.sort_values("cluster_size", ascending=False).iterrows():
+        print("=" * 80)
+        if index == -1:
+            print("NOISE CLUSTER")
+        print(row["centroid"])
+        print(f'N = {len(row["question"])}')
+        print("=" * 80)
+        for question in row["question"][:10]:
+            print(question)
+        print(f'... {len(row["question"][10:])} others ...')
+        print()
+
+
+def new_questions(questions, known):
+    """Questions which are not in `known`, counting duplicates."""
+    counts = Counter(known)
+    new = []
+    for question in questions:
+        if counts[question] > 0:
+            counts[question] -= 1
+        else:
+            new.append(question)
+    return new
+
+
+@click.command()
+@click.option(
+    "--questions_json",
+    multiple=True,
+    required=True,
+    help="Generated questions ({'questions': [...]}), repeatable.",
+)
+@click.option(
+    "--clusters_path",
+    required=True,
+    help="Path of the fitted clustering. If it exists, only new questions are added.",
+)
+@click.option(
+    "--refit",
+    is_flag=True,
+    default=False,
+    help="Cluster all questions from scratch, instead of adding new questions.",
+)
+@click.option("--min_cluster_size", default=15, type=int)
+@click.option("--min_samples", default=None, type=int)
+@click.option(
+    "--dedup",
+    is_flag=True,
+    default=False,
+    help="Collapse duplicates before clustering. Changes the clusters, as "
+    "--min_cluster_size then counts distinct questions.",
+)
+@click.option(
+    "--dedup_threshold",
+    default=DEFAULT_DEDUP_THRESHOLD,
+    type=float,
+    help="Cosine similarity above which questions are collapsed (with --dedup).",
+)
+@click.option(
+    "--embedding_cache_path",
+    default=DEFAULT_EMBEDDING_CACHE_PATH,
+    help="Path to the embedding cache. Pass an empty string to disable it.",
+)
+@click.option("--output_json", default=None, help="Path to store the clusters at.")
+def main(
+    questions_json,
+    clusters_path,
+    refit,
+    min_cluster_size,
+    min_samples,
+    dedup,
+    dedup_threshold,
+    embedding_cache_path,
+    output_json,
+):
+    questions = []
+    for path in questions_json:
+        with open(path) as fin:
+            questions += json.load(fin)["questions"]
+
+    cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+    embedder = QuestionEmbedder(cache=cache)
+    if Path(clusters_path).exists() and not refit:
+        clusters = QuestionClusters.load(clusters_path, embedder=embedder)
+        new = new_questions(questions, clusters.questions)
+        print(f"Add {len(new)} new questions to {clusters_path}.")
+        clusters.add(new)
+    else:
+        print(f"Cluster {len(questions)} questions.")
+        clusters = QuestionClusters(
+            min_cluster_size,
+            min_samples,
+            embedder=embedder,
+            dedup_threshold=dedup_threshold if dedup else None,
+        )
+        clusters.fit(questions)
+    clusters.save(clusters_path)
+    if cache is not None:
+        print(f"Embedding cache: {cache.stats()}")
+
+    centroids = calculate_centroids(
+        clusters.questions, clusters.embeddings, clusters.assignments
+    )
+    df_agg = aggregate_data(clusters.questions, clusters.assignments, centroids)
+    generate_report(df_agg)
+    if output_json:
+        Path(output_json).parent.mkdir(exist_ok=True, parents=True)
+        df_agg.reset_index().to_json(output_json, orient="records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Retrieval of the document chunks which are relevant to a question, such that QA prompts
+on long documents (e.g., QMSum transcripts) do not contain the full text.
+
+Each document is chunked once, at speaker turns for meeting transcripts and at sentences
+otherwise, and indexed with BM25. The context of a question consists of the top-ranked
+chunks which fit into a token budget, in document order, with omitted parts marked by
+"[...]". Documents which fit into the budget are used in full.
+"""
+
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+from info_salience.segmentation import split_sentences
+
+CHUNK_MODES = ["auto", "turns", "sentences"]
+GAP_MARKER = "[...]"
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Number of tokens in `text`, with the tokenizer used to filter the datasets."""
+    global _encoding
+    if _encoding is None:
+        import tiktoken
+
+        _encoding = tiktoken.get_encoding("o200k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def split_turns(text):
+    """Speaker turns of a transcript (see `preprocessing.qmsum.format_meeting`)."""
+    return [turn.strip() for turn in re.split(r"\n\s*\n", text) if turn.strip()]
+
+
+def chunk_mode(dataset):
+    return "turns" if dataset.startswith("qmsum") else "sentences"
+
+
+class BM25:
+    """Okapi BM25 over the chunks of one document."""
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.tfs = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = np.array([sum(tf.values()) for tf in self.tfs])
+        self.avg_length = max(self.lengths.mean(), 1) if len(chunks) else 1
+        df = Counter(term for tf in self.tfs for term in tf)
+        n = len(chunks)
+        self.idf = {
+            term: math.log(1 + (n - freq + 0.5) / (freq + 0.5))
+            for term, freq in df.items()
+        }
+
+    def scores(self, query):
+        scores = np.zeros(len(self.tfs))
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / self.avg_length)
+        for term in set(tokenize(query)):
+            if term not in self.idf:
+                continue
+            tf = np.array([chunk_tf[term] for chunk_tf in self.tfs])
+            scores += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+
+class Retriever:
+    """
+    Narrows documents to the chunks relevant to a question. Keeps the number of tokens
+    of the full documents and of the narrowed contexts for the report.
+    """
+
+    def __init__(
+        self,
+        texts,
+        mode="sentences",
+        token_budget=2048,
+        top_k=None,
+        segmentation_cache=None,
+        n_jobs=1,
+    ):
+        if mode == "turns":
+            self.chunks = [split_turns(text) for text in texts]
+            self.separator = "\n\n"
+        elif mode == "sentences":
+            self.chunks = split_sentences(
+                texts, cache=segmentation_cache, n_jobs=n_jobs
+            )
+            self.separator = " "
+        else:
+            raise ValueError(f"Invalid chunk mode {mode}.")
+        self.texts = list(texts)
+        self.token_budget = token_budget
+        self.top_k = top_k
+        self.text_tokens = [count_tokens(text) for text in self.texts]
+        self.chunk_tokens = [
+            [count_tokens(chunk) for chunk in chunks] for chunks in self.chunks
+        ]
+        self.indexes = [BM25(chunks) for chunks in self.chunks]
+        self.full_tokens = 0
+        self.context_tokens = 0
+        self.n_narrowed = 0
+        self.n_contexts = 0
+
+    def context(self, i, query):
+        """Context of document `i` for `query`."""
+        self.n_contexts += 1
+        self.full_tokens += self.text_tokens[i]
+        if self.text_tokens[i] <= self.token_budget:
+            self.context_tokens += self.text_tokens[i]
+            return self.texts[i]
+
+        scores = self.indexes[i].scores(query)
+        # stable sort, such that ties are broken by document order
+        ranking = np.argsort(-scores, kind="stable")
+        selected = []
+        used = 0
+        for j in ranking:
+            if self.top_k is not None and len(selected) >= self.top_k:
+                break
+            if used + self.chunk_tokens[i][j] > self.token_budget:
+                continue
+            selected.append(j)
+            used += self.chunk_tokens[i][j]
+
+        parts = []
+        previous = -1
+        for j in sorted(selected):
+            if j != previous + 1:
+                parts.append(GAP_MARKER)
+            parts.append(self.chunks[i][j])
+            previous = j
+        if previous != len(self.chunks[i]) - 1:
+            parts.append(GAP_MARKER)
+        context = self.separator.join(parts)
+
+        self.n_narrowed += 1
+        self.context_tokens += count_tokens(context)
+        return context
+
+    def report(self):
+        return {
+            "contexts": self.n_contexts,
+            "narrowed": self.n_narrowed,
+            "token_budget": self.token_budget,
+            "top_k": self.top_k,
+            "full_tokens": self.full_tokens,
+            "context_tokens": self.context_tokens,
+            "token_reduction": (
+                1 - self.context_tokens / self.full_tokens if self.full_tokens else None
+            ),
+        }
+
+
+def decision_changes(df_answers, df_full):
+    """
+    Compares the answer/no-answer decisions of (doc_id, cluster_id) pairs with those of
+    a full-context run.
+    """
+    df = df_answers.merge(
+        df_full, on=["doc_id", "cluster_id"], suffixes=("", "_full"), validate="1:1"
+    )
+    answered = df["reference_answer"] != "no answer"
+    answered_full = df["reference_answer_full"] != "no answer"
+    return {
+        "pairs": len(df),
+        "changed": int((answered != answered_full).sum()),
+        "changed_rate": float((answered != answered_full).mean()) if len(df) else None,
+        "answer_to_no_answer": int((~answered & answered_full).sum()),
+        "no_answer_to_answer": int((answered & ~answered_full).sum()),
+    }
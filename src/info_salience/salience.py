@@ -0,0 +1,69 @@
+"""
+Content salience scores: the rate at which the answer claims of each question are entailed
+by the summaries, per target length (see notebooks/30-salience.ipynb).
+"""
+
+import click
+import pandas as pd
+
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    read_table,
+    write_table,
+)
+
+SALIENCE_COLS = [
+    "summary_10w_nli_pred",
+    "summary_20w_nli_pred",
+    "summary_50w_nli_pred",
+    "summary_100w_nli_pred",
+    "summary_200w_nli_pred",
+]
+
+
+def average_entailment_by_question(json_files, cols=SALIENCE_COLS):
+    """
+    Averages the entailment of answer claims per document and question, then per question.
+    When given multiple files (e.g., summary samples), the result is averaged over all.
+    """
+    dfs = []
+    for json_file in json_files:
+        df = read_table(json_file, columns=["doc_id", "cluster_id", *cols])
+        df = df.groupby(["doc_id", "cluster_id"])[cols].mean()
+        dfs.append(df)
+    return pd.concat(dfs).groupby(level=1).mean()
+
+
+@click.command()
+@click.option(
+    "--nli_json",
+    multiple=True,
+    required=True,
+    help="Answer claim entailments (discord-qa-nli). Can be given multiple times.",
+)
+@click.option("--questions_json", required=True, help="Path to discord questions.")
+@click.option("--output_json", required=True, help="Path to store salience scores at.")
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
+def main(nli_json, questions_json, output_json, output_format):
+    df_questions = pd.read_json(questions_json)
+    df_questions = df_questions.rename({"centroid": "question"}, axis=1)
+    df = average_entailment_by_question(nli_json)
+    df = pd.merge(
+        df_questions[["cluster_id", "question"]],
+        df,
+        on="cluster_id",
+        how="left",
+        validate="one_to_one",
+    )
+    write_table(df, output_json, output_format)
+    print(df)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Length-aware request scheduling for local inference.
+
+All functions operate on token counts only, so they can be used (and tested) without a GPU.
+"""
+
+import dataclasses
+import math
+from typing import List
+
+import numpy as np
+
+
+@dataclasses.dataclass
+class BatchPlan:
+    # indices of prompts per batch, in dispatch order
+    batches: List[List[int]]
+    # indices of prompts which do not fit into the context window
+    overlong: List[int]
+
+
+def round_up(value, multiple):
+    return int(math.ceil(value / multiple) * multiple)
+
+
+def kv_cache_bytes_per_token(num_layers, num_kv_heads, head_dim, dtype_bytes=2):
+    # keys and values for every layer
+    return 2 * num_layers * num_kv_heads * head_dim * dtype_bytes
+
+
+def estimate_kv_cache_tokens(
+    gpu_memory_bytes,
+    weight_bytes,
+    bytes_per_token,
+    gpu_memory_utilization=0.9,
+    activation_fraction=0.1,
+):
+    """
+    Estimates how many tokens fit into the KV cache.
+
+    `gpu_memory_bytes` is the total memory of all GPUs the model is sharded over. A
+    fraction of the usable memory is reserved for activations, similar to vLLM's profiling
+    run.
+    """
+    usable = gpu_memory_bytes * gpu_memory_utilization
+    available = usable - weight_bytes - activation_fraction * usable
+    return max(0, int(available // bytes_per_token))
+
+
+def choose_max_model_len(
+    prompt_lengths, max_tokens, model_max_len, kv_cache_tokens=None, multiple=256
+):
+    """
+    Picks the smallest context window which fits the longest prompt plus `max_tokens`,
+    bounded by the model's maximum length and the KV cache capacity.
+    """
+    required = max(prompt_lengths, default=0) + max_tokens
+    limit = model_max_len
+    if kv_cache_tokens is not None:
+        limit = min(limit, kv_cache_tokens)
+    return min(round_up(required, multiple), limit)
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    mismatch = np.asarray(a[:n]) != np.asarray(b[:n])
+    if not mismatch.any():
+        return n
+    return int(np.argmax(mismatch))
+
+
+def plan_prefix_order(token_ids, block_size=16):
+    """
+    Orders prompts such that prompts with a shared prefix are adjacent.
+
+    Sorting the token sequences lexicographically maximizes the prefix shared by
+    neighbouring prompts. With automatic prefix caching, the KV blocks of that shared
+    prefix are computed once. Returns the dispatch order and the estimated number of
+    prefill tokens saved, counting only full blocks as the cache works at block level.
+    """
+    order = sorted(range(len(token_ids)), key=lambda i: token_ids[i])
+    saved = 0
+    for prev, i in zip(order, order[1:]):
+        shared = common_prefix_length(token_ids[prev], token_ids[i])
+        # the last prompt token is always recomputed
+        shared = min(shared, len(token_ids[i]) - 1)
+        saved += (shared // block_size) * block_size
+    return order, saved
+
+
+def plan_batches(
+    prompt_lengths, max_tokens, max_model_len, token_budget=None, n=1, order=None
+):
+    """
+    Groups prompts into batches whose worst-case KV cache footprint fits `token_budget`.
+
+    By default, prompts are sorted from longest to shortest, so that sequences of similar
+    length are scheduled together and the longest requests do not end up in the tail. A
+    custom dispatch `order` can be given instead (see `plan_prefix_order`). Prompts which
+    leave no room for generation within `max_model_len` are reported as overlong and not
+    scheduled.
+    """
+    overlong = [i for i, length in enumerate(prompt_lengths) if length >= max_model_len]
+    skip = set(overlong)
+    if order is None:
+        order = sorted(
+            range(len(prompt_lengths)), key=lambda i: prompt_lengths[i], reverse=True
+        )
+    order = [i for i in order if i not in skip]
+
+    if token_budget is None:
+        return BatchPlan(batches=[order] if order else [], overlong=overlong)
+
+    batches = []
+    batch = []
+    used = 0
+    for i in order:
+        # the prompt is shared by all n samples, each sample generates up to max_tokens
+        footprint = prompt_lengths[i] + n * max_tokens
+        footprint = min(
+            footprint, prompt_lengths[i] + n * (max_model_len - prompt_lengths[i])
+        )
+        if batch and used + footprint > token_budget:
+            batches.append(batch)
+            batch = []
+            used = 0
+        batch.append(i)
+        used += footprint
+    if batch:
+        batches.append(batch)
+    return BatchPlan(batches=batches, overlong=overlong)
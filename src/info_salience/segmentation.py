@@ -0,0 +1,128 @@
+"""
+Sentence segmentation with pysbd, parallelized over a process pool and cached per document.
+
+The cache stores the character offsets of the sentences of each text, keyed by a hash of
+the text, so that any consumer can slice sentences with `text[start:end]` without running
+the segmenter again.
+
+python -m info_salience.segmentation --input_json data/processed/qmsum-generic/documents.json
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+import click
+import pysbd
+
+from info_salience.cache import DiskCache, content_hash
+
+DEFAULT_SEGMENTATION_CACHE_PATH = ".cache/segmentation.sqlite"
+# Changes to the segmenter or its settings invalidate the cache.
+SEGMENTER_VERSION = f"pysbd-{pysbd.__version__}-en-noclean"
+
+_segmenter = None
+
+
+class SegmentationCache(DiskCache):
+    """Sentence offsets `[[start, end], ...]` per text, keyed by a hash of the text."""
+
+    def __init__(self, path=DEFAULT_SEGMENTATION_CACHE_PATH):
+        super().__init__(path)
+
+    def key(self, text):
+        return content_hash(SEGMENTER_VERSION, text)
+
+
+def sentence_offsets(text: str):
+    """Character offsets of the sentences in `text`, as returned by pysbd."""
+    global _segmenter
+    if _segmenter is None:
+        _segmenter = pysbd.Segmenter(language="en", clean=False)
+
+    offsets = []
+    pos = 0
+    for sent in _segmenter.segment(text):
+        start = text.find(sent, pos)
+        if start < 0:
+            raise ValueError(f"Could not locate sentence in text: {sent[:100]!r}")
+        pos = start + len(sent)
+        offsets.append([start, pos])
+    return offsets
+
+
+def segment_texts(texts: List[str], cache=None, n_jobs=1, chunksize=4):
+    """
+    Returns the sentence offsets of each text. Texts which are not cached are segmented
+    once each, in `n_jobs` processes (all CPUs if None).
+    """
+    keys = [content_hash(SEGMENTER_VERSION, text) for text in texts]
+    found = cache.get_many(keys) if cache is not None else {}
+    missing = {key: text for key, text in zip(keys, texts) if key not in found}
+
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(missing))) as executor:
+            offsets = list(
+                executor.map(sentence_offsets, missing.values(), chunksize=chunksize)
+            )
+    else:
+        offsets = [sentence_offsets(text) for text in missing.values()]
+
+    segmented = dict(zip(missing, offsets))
+    if cache is not None and segmented:
+        cache.put_many(segmented)
+    found.update(segmented)
+    return [found[key] for key in keys]
+
+
+def split_sentences(texts: List[str], cache=None, n_jobs=1, chunksize=4):
+    """Splits each text into a list of sentences."""
+    offsets = segment_texts(texts, cache=cache, n_jobs=n_jobs, chunksize=chunksize)
+    return [
+        [text[start:end] for start, end in text_offsets]
+        for text, text_offsets in zip(texts, offsets)
+    ]
+
+
+@click.command()
+@click.option("--input_json", required=True, help="Path to the input documents.")
+@click.option(
+    "--output_json",
+    default=None,
+    help="Optional path to store the sentence offsets of each document at.",
+)
+@click.option(
+    "--cache_path",
+    default=DEFAULT_SEGMENTATION_CACHE_PATH,
+    help="Path to the segmentation cache.",
+)
+@click.option(
+    "--n_jobs", default=None, type=int, help="Number of processes (default: all CPUs)."
+)
+def main(input_json, output_json, cache_path, n_jobs):
+    with open(input_json) as fin:
+        docs = json.load(fin)
+
+    cache = SegmentationCache(cache_path)
+    offsets = segment_texts([doc["text"] for doc in docs], cache=cache, n_jobs=n_jobs)
+    print(f"Segmentation cache: {cache.stats()}")
+
+    if output_json:
+        records = [
+            {
+                "doc_id": doc["doc_id"],
+                "text_hash": cache.key(doc["text"]),
+                "offsets": doc_offsets,
+            }
+            for doc, doc_offsets in zip(docs, offsets)
+        ]
+        Path(output_json).parent.mkdir(exist_ok=True, parents=True)
+        with open(output_json, "w") as fout:
+            json.dump(records, fout)
+
+
+if __name__ == "__main__":
+    main()
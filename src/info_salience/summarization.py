@@ -1,4 +1,5 @@
 import json
+import os
 import warnings
 from collections import defaultdict
 from functools import partial
@@ -13,13 +14,33 @@ from dotenv import find_dotenv, load_dotenv
 from json_repair import repair_json
 from pydantic import BaseModel
 
-from info_salience.llm import LitellmGenerator, VLLMGenerator
+from info_salience.cache import content_hash
+from info_salience.llm import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_SERVER_URL,
+    GenerationCache,
+    load_generator,
+)
+from info_salience.tables import (
+    DEFAULT_OUTPUT_FORMAT,
+    OUTPUT_FORMATS,
+    table_exists,
+    write_table,
+)
 
 
 class SummarizationOutput(BaseModel):
     summary: str
 
 
+class JointSummarizationOutput(BaseModel):
+    summary_10w: str
+    summary_20w: str
+    summary_50w: str
+    summary_100w: str
+    summary_200w: str
+
+
 @outlines.prompt
 def prompt_generic(text, length_target):
     """
@@ -50,6 +71,40 @@ def prompt_qmsum_generic(text, length_target):
     """
 
 
+@outlines.prompt
+def prompt_generic_joint(text, length_targets):
+    """
+    ## Document
+    {{ text }}
+
+    ## Instruction
+    Please summarize the above document {{ length_targets | length }} times, with different lengths. The summaries should be self-contained and use up to {{ length_targets | join(", ") }} words, respectively. Respond exactly in following JSON format:
+
+    {
+    {% for length_target in length_targets %}
+        "summary_{{ length_target }}w": "(the {{ length_target }} words summary)"{% if not loop.last %},{% endif %}
+    {% endfor %}
+    }
+    """
+
+
+@outlines.prompt
+def prompt_qmsum_generic_joint(text, length_targets):
+    """
+    ## Meeting Transcript
+    {{ text }}
+
+    ## Instruction
+    Please summarize the above meeting transcript {{ length_targets | length }} times, with different lengths. The summaries should be self-contained and use up to {{ length_targets | join(", ") }} words, respectively. Respond exactly in following JSON format:
+
+    {
+    {% for length_target in length_targets %}
+        "summary_{{ length_target }}w": "(the {{ length_target }} words summary)"{% if not loop.last %},{% endif %}
+    {% endfor %}
+    }
+    """
+
+
 def build_messages(df, prompt_name, length_target):
     if prompt_name == "generic":
         prompt = prompt_generic
@@ -67,6 +122,34 @@ def build_messages(df, prompt_name, length_target):
     return messages
 
 
+def build_messages_joint(df, prompt_name, length_targets):
+    """Builds one prompt per document which asks for summaries of all target lengths."""
+    if prompt_name == "generic":
+        prompt = prompt_generic_joint
+    elif prompt_name == "qmsum-generic":
+        prompt = prompt_qmsum_generic_joint
+    else:
+        raise ValueError(f"Invalid prompt name {prompt_name}.")
+
+    messages = []
+    for _, row in df.iterrows():
+        content = prompt(row["text"], length_targets)
+        message = [{"role": "user", "content": content}]
+        messages.append(message)
+
+    return messages
+
+
+def prompt_hash(prompt_name, prompt_mode, lengths):
+    """Hash of the prompt templates, rendered with a placeholder document."""
+    df = pd.DataFrame({"text": ["{{ text }}"]})
+    if prompt_mode == "joint":
+        messages = build_messages_joint(df, prompt_name, lengths)
+    else:
+        messages = [build_messages(df, prompt_name, length) for length in lengths]
+    return content_hash(messages)
+
+
 def parse_response(response, key):
     try:
         response_fixed = repair_json(response)
@@ -83,6 +166,86 @@ def parse_response(response, key):
     return summary
 
 
+def summarize(
+    llm_generate,
+    df,
+    prompt_name,
+    lengths,
+    prompt_mode="per_length",
+    temperature=0.3,
+    max_tokens=1024,
+    n_samples=1,
+):
+    """
+    Summarizes all documents in `df` for each target length.
+
+    Returns a dict which maps each length to one list of `n_samples` summaries per
+    document. Summaries which could not be generated or parsed are None.
+    """
+    if prompt_mode == "joint":
+        requests = [(lengths, build_messages_joint(df, prompt_name, lengths))]
+    else:
+        requests = [
+            ([length], build_messages(df, prompt_name, length)) for length in lengths
+        ]
+
+    summaries_by_length = {}
+    for request_lengths, messages in requests:
+        responses = llm_generate(
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n=n_samples,
+        )
+        for length_target in request_lengths:
+            key = f"summary_{length_target}w" if prompt_mode == "joint" else "summary"
+            summaries = []
+            for response in responses:
+                doc_summaries = []
+                for i in range(n_samples):
+                    try:
+                        summary = parse_response(response[i], key=key)
+                    except IndexError:
+                        # Occurs when the prompt is too long for the context window of the LLM. The generator reports these prompts and returns no outputs for them. We set all summaries to None for this generation.
+                        summary = None
+                    doc_summaries.append(summary)
+                summaries.append(doc_summaries)
+            summaries_by_length[length_target] = summaries
+    return summaries_by_length
+
+
+def load_checkpoint(path, meta):
+    """
+    Loads completed units of work from a JSONL checkpoint.
+
+    Returns a dict mapping (length, chunk) to the record of that unit. Records which
+    were produced with different settings (model, prompt templates or generation
+    parameters) are ignored. Later records replace earlier records of the same unit.
+    """
+    checkpoint = {}
+    if not Path(path).exists():
+        return checkpoint
+
+    with open(path) as fin:
+        for line in fin:
+            try:
+                record = json.loads(line)
+            except JSONDecodeError:
+                # A partially written last line (e.g., job was killed during write).
+                continue
+            if any(record.get(k) != v for k, v in meta.items()):
+                continue
+            checkpoint[(record["length"], record["chunk"])] = record
+    return checkpoint
+
+
+def append_checkpoint(path, record):
+    with open(path, "a") as fout:
+        fout.write(json.dumps(record) + "\n")
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
 def stats(data):
     stats = []
     for target_length, summaries in data.items():
@@ -120,11 +283,49 @@ def stats(data):
     help="Model name to be used.",
 )
 @click.option(
-    "--engine", default="vllm", help="Inference engine to use (vllm|litellm)."
+    "--engine",
+    default="vllm",
+    help="Inference engine to use (vllm|litellm|server|fake|replay|record:<engine>).",
+)
+@click.option(
+    "--server_url",
+    default=DEFAULT_SERVER_URL,
+    help="URL of the generation server (--engine server).",
 )
 @click.option("--temperature", default=0.3, type=float, help="Sampling temperature.")
 @click.option("--n_samples", default=5, type=int, help="Number of output samples.")
 @click.option("--prompt_name", default="generic", help="Name of the prompt to use.")
+@click.option(
+    "--prompt_mode",
+    default="per_length",
+    type=click.Choice(["per_length", "joint"]),
+    help=(
+        "One call per target length, or all target lengths in one structured call. "
+        "Joint outputs are stored in the joint/ subdirectory of --output_path."
+    ),
+)
+@click.option(
+    "--cache_path",
+    default=DEFAULT_CACHE_PATH,
+    help="Path to the generation cache. Pass an empty string to disable caching.",
+)
+@click.option(
+    "--recording_path",
+    default=None,
+    help="Path to the recording of --engine record:<engine> and --engine replay.",
+)
+@click.option(
+    "--chunk_size",
+    default=100,
+    type=int,
+    help="Number of documents per checkpointed unit of work.",
+)
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
 @click.option(
     "--debug",
     is_flag=True,
@@ -133,7 +334,20 @@ def stats(data):
     help="Debug mode. Only process 5 documents.",
 )
 def main(
-    input_json, output_path, model, engine, temperature, n_samples, prompt_name, debug
+    input_json,
+    output_path,
+    model,
+    engine,
+    server_url,
+    temperature,
+    n_samples,
+    prompt_name,
+    prompt_mode,
+    cache_path,
+    recording_path,
+    chunk_size,
+    output_format,
+    debug,
 ):
     pprint(locals())
 
@@ -144,62 +358,124 @@ def main(
         )
 
     output_path = Path(output_path)
+    if prompt_mode == "joint":
+        # outputs, checkpoint and telemetry of joint runs do not mix with per-length ones
+        output_path = output_path / "joint"
     output_path.mkdir(exist_ok=True, parents=True)
     out_files = [
         output_path / f"temperature{temperature}-{i}.json" for i in range(n_samples)
     ]
-    if all(f.exists() for f in out_files):
+    checkpoint_file = output_path / f"temperature{temperature}.checkpoint.jsonl"
+    if not checkpoint_file.exists() and all(table_exists(f) for f in out_files):
         print(f"All generations already exist. Skip.\n{out_files}")
         return
 
-    dataset = Path(input_json).parent.name
-    if engine == "vllm":
-        import torch
-
-        if (dataset == "astro-ph") and (
-            model == "meta-llama/Meta-Llama-3.1-70B-Instruct"
-        ):
-            # To fix the following Llama 3.1 70B (128k context window). ValueError: The model's max seq len (131072) is larger than the maximum number of tokens that can be stored in KV cache (24480). Try increasing `gpu_memory_utilization` or decreasing `max_model_len` when initializing the engine.
-            max_model_len = 32768
-        else:
-            max_model_len = None
-
-        llm = VLLMGenerator(
-            model,
-            tensor_parallel_size=torch.cuda.device_count(),
-            max_model_len=max_model_len,
-        )
-        llm_generate = partial(llm.generate, schema=SummarizationOutput)
-    else:
-        llm = LitellmGenerator(
-            model,
-            caching=True,
-            report_costs=True,
-            disk_cache_dir=f".litellm_cache/summarization-{dataset}-{model}",
-        )
-        llm_generate = llm.generate
-
     df = pd.read_json(input_json)
     if debug:
         df = df.head(5)
     lengths = [10, 20, 50, 100, 200]
-
-    all_summaries = [defaultdict(list) for _ in range(n_samples)]
+    if prompt_mode == "joint":
+        schema = JointSummarizationOutput
+        max_tokens = 2048
+    else:
+        schema = SummarizationOutput
+        max_tokens = 1024
+
+    # Each (length, chunk) is a unit of work which is appended to the checkpoint once done.
+    meta = {
+        "model": model,
+        "prompt_name": prompt_name,
+        "prompt_hash": prompt_hash(prompt_name, prompt_mode, lengths),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "n_samples": n_samples,
+    }
+    checkpoint = load_checkpoint(checkpoint_file, meta)
+    chunks = [df.iloc[i : i + chunk_size] for i in range(0, len(df), chunk_size)]
+    pending = []
     for length_target in lengths:
-        print(f"Generate summaries for length: {length_target}", flush=True)
-        messages = build_messages(df, prompt_name, length_target)
-        responses = llm_generate(
-            messages=messages, temperature=temperature, max_tokens=1024, n=n_samples
+        for chunk in chunks:
+            record = checkpoint.get((length_target, int(chunk.index[0])))
+            if record is None or record["doc_ids"] != chunk["doc_id"].tolist():
+                pending.append((length_target, chunk))
+    print(f"Pending chunks: {len(pending)}/{len(lengths) * len(chunks)}")
+
+    # In joint mode, one call per chunk generates the summaries of all lengths.
+    if prompt_mode == "joint":
+        pending_chunks = {int(chunk.index[0]) for _, chunk in pending}
+        jobs = [(lengths, c) for c in chunks if int(c.index[0]) in pending_chunks]
+    else:
+        jobs = [([length_target], chunk) for length_target, chunk in pending]
+
+    cache = None
+    llm = None
+    telemetry_file = output_path / f"temperature{temperature}.telemetry.jsonl"
+    if pending:
+        cache = GenerationCache(cache_path) if cache_path else None
+        llm = load_generator(
+            engine,
+            model,
+            cache=cache,
+            server_url=server_url,
+            recording_path=recording_path,
         )
+        llm.telemetry.tags.update(
+            stage="summarization",
+            dataset=Path(input_json).parent.name,
+            prompt_mode=prompt_mode,
+        )
+        if prompt_mode == "joint":
+            llm.fit_context(
+                build_messages_joint(df, prompt_name, lengths), max_tokens=max_tokens
+            )
+        else:
+            # the longest target length has the longest prompts
+            llm.fit_context(
+                build_messages(df, prompt_name, max(lengths)), max_tokens=max_tokens
+            )
+        if llm.engine == "litellm":
+            llm_generate = llm.generate
+        else:
+            llm_generate = partial(llm.generate, schema=schema)
 
-        for response in responses:
-            for i in range(n_samples):
-                try:
-                    summary = parse_response(response[i], key="summary")
-                except IndexError:
-                    # Occurs when the prompt is too long for context window of LLM, in which case there is only an empty list with one empty string ['']. We set all summaries to None for this generation.
-                    summary = None
-                all_summaries[i][f"summary_{length_target}w"].append(summary)
+    for job_lengths, chunk in jobs:
+        print(
+            f"Generate summaries for length: {', '.join(map(str, job_lengths))} "
+            f"(documents {chunk.index[0]}-{chunk.index[-1]})",
+            flush=True,
+        )
+        summaries_by_length = summarize(
+            llm_generate,
+            chunk,
+            prompt_name,
+            job_lengths,
+            prompt_mode=prompt_mode,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n_samples=n_samples,
+        )
+        for length_target, summaries in summaries_by_length.items():
+            record = {
+                **meta,
+                "length": length_target,
+                "chunk": int(chunk.index[0]),
+                "doc_ids": chunk["doc_id"].tolist(),
+                "summaries": summaries,
+            }
+            append_checkpoint(checkpoint_file, record)
+            checkpoint[(length_target, record["chunk"])] = record
+        llm.telemetry.flush(telemetry_file)
+
+    # Materialize the final output files from the checkpoint.
+    all_summaries = [defaultdict(list) for _ in range(n_samples)]
+    for length_target in lengths:
+        for chunk in chunks:
+            record = checkpoint[(length_target, int(chunk.index[0]))]
+            for doc_summaries in record["summaries"]:
+                for i in range(n_samples):
+                    all_summaries[i][f"summary_{length_target}w"].append(
+                        doc_summaries[i]
+                    )
 
     for i, summaries in enumerate(all_summaries):
         print(f"Sample: {i}")
@@ -208,7 +484,13 @@ def main(
         df_out = df.copy()
         for length_target, summaries_for_length in summaries.items():
             df_out[length_target] = summaries_for_length
-        df_out.to_json(out_files[i], orient="records")
+        write_table(df_out, out_files[i], output_format)
+
+    if cache is not None:
+        print(f"Generation cache: {cache.stats()}")
+    if llm is not None:
+        # prefill tokens (prompt_tokens) and wall time of this run
+        llm.telemetry.print_summary(by=("stage", "dataset", "prompt_mode"))
 
 
 if __name__ == "__main__":
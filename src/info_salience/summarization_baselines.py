@@ -11,6 +11,7 @@ from summa.summarizer import summarize as textrank
 from tqdm import tqdm
 
 from info_salience.summarization import stats
+from info_salience.tables import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, write_table
 
 
 @dataclasses.dataclass
@@ -116,7 +117,13 @@ def summarize_textrank(text, budget):
     help="Path to store outputs in (separate directories will be created here).",
     required=True,
 )
-def main(documents_json, output_path):
+@click.option(
+    "--output_format",
+    default=DEFAULT_OUTPUT_FORMAT,
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Store outputs as Parquet, JSON records, or both.",
+)
+def main(documents_json, output_path, output_format):
     with open(documents_json) as fin:
         docs = json.load(fin)
 
@@ -137,9 +144,8 @@ def main(documents_json, output_path):
         print("=" * 80)
         stats(summaries)
 
-        out_file.parent.mkdir(exist_ok=True, parents=True)
         df = pd.DataFrame({"doc_id": ids, "text": texts, **summaries})
-        df.to_json(out_file, orient="records")
+        write_table(df, out_file, output_format)
 
     summarize_all(
         texts,
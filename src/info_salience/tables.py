@@ -0,0 +1,136 @@
+"""
+Reading and writing of stage outputs.
+
+Stage outputs are addressed by their JSON path (e.g., `nli/temperature0.3-0.json`)
+and can be stored as Parquet next to it (`temperature0.3-0.parquet`), as JSON records, or
+both. Readers prefer the Parquet file, which supports loading a subset of columns and rows
+without parsing the whole file:
+
+>>> from info_salience.tables import read_tables
+>>> df = read_tables(
+...     "output/qmsum-generic/*/discord-qa-nli/temperature0.3-*.json",
+...     columns=["doc_id", "cluster_id", "summary_10w_nli_pred"],
+...     filters=[("cluster_id", "in", [0, 1, 2])],
+... )
+"""
+
+import glob
+import operator
+from pathlib import Path
+
+import pandas as pd
+
+OUTPUT_FORMATS = ["json", "parquet", "both"]
+DEFAULT_OUTPUT_FORMAT = "both"
+
+OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda col, values: col.isin(values),
+    "not in": lambda col, values: ~col.isin(values),
+}
+
+
+def table_paths(path, output_format=DEFAULT_OUTPUT_FORMAT):
+    path = Path(path)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format {output_format}.")
+    paths = []
+    if output_format in ["parquet", "both"]:
+        paths.append(path.with_suffix(".parquet"))
+    if output_format in ["json", "both"]:
+        paths.append(path.with_suffix(".json"))
+    return paths
+
+
+def write_table(df, path, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Writes `df` to `path` as Parquet and/or JSON records."""
+    Path(path).parent.mkdir(exist_ok=True, parents=True)
+    paths = table_paths(path, output_format)
+    # a stale copy in the other format would shadow the new output
+    for table_path in table_paths(path, "both"):
+        if table_path not in paths:
+            table_path.unlink(missing_ok=True)
+    # JSON first, so that a column which Parquet cannot represent does not lose the output
+    for table_path in reversed(paths):
+        if table_path.suffix == ".json":
+            df.to_json(table_path, orient="records")
+            continue
+        try:
+            df.to_parquet(table_path, index=False)
+        except (TypeError, ValueError) as e:
+            if output_format != "both":
+                raise
+            table_path.unlink(missing_ok=True)
+            print(f"Could not store {table_path} as Parquet, only JSON is kept: {e}")
+
+
+def resolve_table(path):
+    """Path of the stored table (Parquet if present, else JSON), or None if missing."""
+    for table_path in table_paths(path, "both"):
+        if table_path.exists():
+            return table_path
+    return None
+
+
+def table_exists(path):
+    return resolve_table(path) is not None
+
+
+def apply_filters(df, filters):
+    """Applies (column, op, value) filters, which must all match, to a data frame."""
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= OPERATORS[op](df[col], value)
+    return df[mask].reset_index(drop=True)
+
+
+def read_table(path, columns=None, filters=None):
+    """
+    Reads a stage output. `columns` selects a subset of columns, and `filters` is a list
+    of (column, op, value) tuples which must all match, with op in =, ==, !=, <, <=, >,
+    >=, in, not in. Both are pushed down to the Parquet reader.
+    """
+    table_path = resolve_table(path)
+    if table_path is None:
+        raise FileNotFoundError(f"No table found for {path}.")
+
+    if table_path.suffix == ".parquet":
+        filters = [tuple(f) for f in filters] if filters else None
+        return pd.read_parquet(table_path, columns=columns, filters=filters)
+
+    df = pd.read_json(table_path)
+    if filters:
+        df = apply_filters(df, filters)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def read_tables(paths, columns=None, filters=None, path_col=None):
+    """
+    Reads and concatenates several stage outputs, given as list or glob pattern. A table
+    stored in both formats is read once. With `path_col`, the path of each row's file is
+    added as column.
+    """
+    if isinstance(paths, (str, Path)):
+        pattern = str(paths)
+        paths = sorted(
+            set(glob.glob(pattern))
+            | set(glob.glob(str(Path(pattern).with_suffix(".parquet"))))
+        )
+    # map both formats to their JSON path, such that each table is read once
+    paths = list(dict.fromkeys(str(Path(p).with_suffix(".json")) for p in paths))
+
+    dfs = []
+    for path in paths:
+        df = read_table(path, columns=columns, filters=filters)
+        if path_col is not None:
+            df[path_col] = path
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
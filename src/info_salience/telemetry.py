@@ -0,0 +1,121 @@
+import glob
+import json
+import time
+from pathlib import Path
+
+import click
+import pandas as pd
+
+
+class Telemetry:
+    """
+    Collects generation records.
+
+    There is one `request` record per prompt with prompt and completion tokens, queue and
+    generation latency, throughput, finish reasons and cost, and one `batch` record per
+    backend call with its wall time. `tags` (e.g., stage and dataset) are added to every
+    record.
+    """
+
+    def __init__(self, **tags):
+        self.tags = tags
+        self.pending = []
+        self.flushed = []
+
+    def record(self, kind="request", **fields):
+        fields["kind"] = kind
+        generation_s = fields.get("generation_s")
+        completion_tokens = fields.get("completion_tokens")
+        if generation_s and completion_tokens is not None:
+            fields["tokens_per_s"] = completion_tokens / generation_s
+        record = {"time": time.time(), **self.tags, **fields}
+        self.pending.append(record)
+        return record
+
+    def flush(self, path, keep=True):
+        """
+        Appends all records collected since the last flush to a JSONL file (if `path` is
+        given). Long-lived processes pass `keep=False` to drop flushed records from memory.
+        """
+        if path:
+            path = Path(path)
+            path.parent.mkdir(exist_ok=True, parents=True)
+            with open(path, "a") as fout:
+                for record in self.pending:
+                    fout.write(json.dumps(record) + "\n")
+        if keep:
+            self.flushed += self.pending
+        self.pending = []
+
+    @property
+    def records(self):
+        return self.flushed + self.pending
+
+    def summary(self, by=("stage", "dataset")):
+        return summarize(pd.DataFrame(self.records), by=by)
+
+    def print_summary(self, **kwargs):
+        if not self.records:
+            return
+        with pd.option_context("display.max_columns", None, "display.width", 200):
+            print(self.summary(**kwargs))
+
+
+def summarize(df, by=("stage", "dataset")):
+    """Aggregates telemetry records, e.g. loaded from all `*.telemetry.jsonl` files."""
+    for col in [
+        "kind",
+        "wall_s",
+        "cached",
+        "prompt_tokens",
+        "completion_tokens",
+        "queue_s",
+        "generation_s",
+        "cost",
+        "finish_reasons",
+    ]:
+        if col not in df.columns:
+            df[col] = None
+    by = [col for col in by if col in df.columns]
+    if not by:
+        df["all"] = "all"
+        by = ["all"]
+
+    batches = df[df["kind"] == "batch"]
+    df = df[df["kind"] == "request"].copy()
+    df["cached"] = df["cached"].fillna(False).astype(bool)
+    df["truncated"] = df["finish_reasons"].apply(
+        lambda reasons: isinstance(reasons, list) and "length" in reasons
+    )
+    summary = df.groupby(by, dropna=False).agg(
+        calls=("cached", "size"),
+        cached=("cached", "sum"),
+        prompt_tokens=("prompt_tokens", "sum"),
+        completion_tokens=("completion_tokens", "sum"),
+        queue_s=("queue_s", "sum"),
+        generation_s=("generation_s", "sum"),
+        truncated=("truncated", "sum"),
+        cost=("cost", "sum"),
+    )
+    summary["wall_s"] = batches.groupby(by, dropna=False)["wall_s"].sum()
+    summary["tokens_per_s"] = summary["completion_tokens"] / summary["wall_s"]
+    return summary.round(2)
+
+
+@click.command()
+@click.argument("patterns", nargs=-1)
+@click.option(
+    "--by", default="stage,dataset,model", help="Comma-separated columns to group by."
+)
+def main(patterns, by):
+    """Summarizes telemetry files, e.g. 'output/**/*telemetry.jsonl'."""
+    patterns = patterns or ["output/**/*telemetry.jsonl"]
+    files = sorted({f for p in patterns for f in glob.glob(p, recursive=True)})
+    df = pd.concat([pd.read_json(f, lines=True) for f in files], ignore_index=True)
+    print(f"Loaded {len(df)} records from {len(files)} files.")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(summarize(df, by=by.split(",")))
+
+
+if __name__ == "__main__":
+    main()
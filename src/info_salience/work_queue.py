@@ -0,0 +1,407 @@
+"""
+Work queue for running pipeline stages on any number of workers.
+
+Shards (one stage invocation each) are stored in a SQLite database on a shared
+filesystem. Workers on any node claim a shard, renew its lease with heartbeats while the
+stage runs as a subprocess, and mark it as done or failed. Leases of crashed workers
+expire, and their shards are claimed again.
+
+Enqueue shards, then start workers (e.g., as a SLURM job array):
+
+    python -m info_salience.work_queue add-entailment --dataset qmsum-generic \
+        --facts_path output/qmsum-generic/discord_facts.json
+    python -m info_salience.work_queue add summarization \
+        --grid temperature=0,0.25,0.5,0.75,1 -- --input_json ... --output_path ...
+    python -m info_salience.work_queue worker --stages claim_entailment
+    python -m info_salience.work_queue status
+"""
+
+import dataclasses
+import glob
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import click
+
+from info_salience.cache import content_hash
+from info_salience.tables import table_exists
+
+DEFAULT_QUEUE_PATH = ".cache/work_queue.sqlite"
+
+STAGES = {
+    "summarization": "info_salience.summarization",
+    "summarization_baselines": "info_salience.summarization_baselines",
+    "claim_extraction": "info_salience.claim_extraction",
+    "qa": "info_salience.qa",
+    "claim_entailment": "info_salience.claim_entailment",
+    "introspection": "info_salience.introspection",
+    "adaptive": "info_salience.adaptive",
+}
+
+
+@dataclasses.dataclass
+class Shard:
+    id: str
+    stage: str
+    args: List[str]
+    attempts: int
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of shards with leases.
+
+    Claims run in an immediate transaction, so that concurrent workers never claim the
+    same shard. A shard whose lease expired (worker crashed or lost its node) is claimed
+    again, up to `max_attempts` times. The rollback journal is used instead of WAL, as
+    WAL does not work on network filesystems.
+    """
+
+    def __init__(
+        self, path=DEFAULT_QUEUE_PATH, lease_s=600, max_attempts=3, timeout=60
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.path),
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shards (
+                id TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                args TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS shards_status ON shards (status, created)"
+        )
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def add(self, stage, args):
+        """
+        Enqueues a shard. Shards are identified by stage and arguments, so adding the
+        same shard twice is a no-op.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage}.")
+        shard_id = content_hash(stage, args)[:16]
+        now = time.time()
+        self._transaction(
+            lambda conn: conn.execute(
+                "INSERT OR IGNORE INTO shards (id, stage, args, status, created, updated) "
+                "VALUES (?, ?, ?, 'pending', ?, ?)",
+                (shard_id, stage, json.dumps(args), now, now),
+            )
+        )
+        return shard_id
+
+    def claim(self, worker, stages=None):
+        """Claims the oldest pending (or stale) shard of `stages`, or returns None."""
+
+        def claim(conn):
+            now = time.time()
+            # stale shards which ran out of attempts
+            conn.execute(
+                "UPDATE shards SET status = 'failed', error = 'lease expired', "
+                "updated = ? WHERE status = 'running' AND lease_until < ? "
+                "AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            query = (
+                "SELECT id, stage, args, attempts FROM shards "
+                "WHERE (status = 'pending' OR (status = 'running' AND lease_until < ?)) "
+                "AND attempts < ?"
+            )
+            params = [now, self.max_attempts]
+            if stages:
+                query += f" AND stage IN ({','.join('?' * len(stages))})"
+                params += list(stages)
+            row = conn.execute(query + " ORDER BY created LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            shard_id, stage, args, attempts = row
+            conn.execute(
+                "UPDATE shards SET status = 'running', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker, now + self.lease_s, now, shard_id),
+            )
+            return Shard(shard_id, stage, json.loads(args), attempts + 1)
+
+        return self._transaction(claim)
+
+    def heartbeat(self, shard_id, worker):
+        """Renews the lease. Returns False if the worker no longer holds the shard."""
+        now = time.time()
+        cursor = self._transaction(
+            lambda conn: conn.execute(
+                "UPDATE shards SET lease_until = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + self.lease_s, now, shard_id, worker),
+            )
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, shard_id, worker):
+        return self._finish(shard_id, worker, "done", None)
+
+    def fail(self, shard_id, worker, error):
+        """Marks a shard as failed. It is retried unless it ran out of attempts."""
+        return self._finish(shard_id, worker, "failed", error)
+
+    def _finish(self, shard_id, worker, status, error):
+        def finish(conn):
+            if status == "failed":
+                # retry later, unless out of attempts
+                new_status = "CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END"
+                params = [self.max_attempts]
+            else:
+                new_status = "?"
+                params = [status]
+            return conn.execute(
+                f"UPDATE shards SET status = {new_status}, error = ?, lease_until = NULL, "
+                "updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                params + [error, time.time(), shard_id, worker],
+            )
+
+        return self._transaction(finish).rowcount == 1
+
+    def reset(self, status="failed"):
+        """Puts all shards with `status` back into the queue with fresh attempts."""
+        cursor = self._transaction(
+            lambda conn: conn.execute(
+                "UPDATE shards SET status = 'pending', attempts = 0, worker = NULL, "
+                "lease_until = NULL, updated = ? WHERE status = ?",
+                (time.time(), status),
+            )
+        )
+        return cursor.rowcount
+
+    def stats(self):
+        """Number of shards per stage and status. Expired leases are reported as stale."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, CASE WHEN status = 'running' AND lease_until < ? "
+                "THEN 'stale' ELSE status END, COUNT(*) FROM shards GROUP BY 1, 2",
+                (time.time(),),
+            ).fetchall()
+        stats = {}
+        for stage, status, count in rows:
+            stats.setdefault(stage, {})[status] = count
+        return stats
+
+    def failures(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, stage, args, attempts, error FROM shards "
+                "WHERE error IS NOT NULL AND status != 'done' ORDER BY updated"
+            ).fetchall()
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def run_shard(queue, shard, worker, heartbeat_s):
+    """Runs the stage of a shard as subprocess and renews the lease while it runs."""
+    command = [sys.executable, "-m", STAGES[shard.stage], *shard.args]
+    print(
+        f"[{worker}] Claimed {shard.id} (attempt {shard.attempts}): "
+        f"{' '.join(command)}",
+        flush=True,
+    )
+    process = subprocess.Popen(command)
+    while True:
+        try:
+            returncode = process.wait(timeout=heartbeat_s)
+            break
+        except subprocess.TimeoutExpired:
+            if not queue.heartbeat(shard.id, worker):
+                print(f"[{worker}] Lost lease of {shard.id}. Stop.", flush=True)
+                process.terminate()
+                process.wait()
+                return False
+
+    if returncode == 0:
+        queue.complete(shard.id, worker)
+        print(f"[{worker}] Done {shard.id}", flush=True)
+        return True
+    queue.fail(shard.id, worker, f"exit code {returncode}")
+    print(f"[{worker}] Failed {shard.id} with exit code {returncode}", flush=True)
+    return False
+
+
+@click.group()
+@click.option(
+    "--queue_path", default=DEFAULT_QUEUE_PATH, help="Path to the queue database."
+)
+@click.option("--lease_s", default=600, type=float, help="Lease duration in seconds.")
+@click.option("--max_attempts", default=3, type=int, help="Attempts per shard.")
+@click.pass_context
+def main(ctx, queue_path, lease_s, max_attempts):
+    ctx.obj = WorkQueue(queue_path, lease_s=lease_s, max_attempts=max_attempts)
+
+
+@main.command(context_settings={"ignore_unknown_options": True})
+@click.argument("stage", type=click.Choice(list(STAGES)))
+@click.option(
+    "--grid",
+    multiple=True,
+    help="Adds one shard per value, e.g. temperature=0,0.5,1 (repeatable).",
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.pass_obj
+def add(queue, stage, grid, args):
+    """Enqueues STAGE with the given arguments (after --)."""
+    names = []
+    values = []
+    for spec in grid:
+        name, options = spec.split("=", 1)
+        names.append(name)
+        values.append(options.split(","))
+    n = 0
+    for combination in itertools.product(*values):
+        shard_args = list(args)
+        for name, value in zip(names, combination):
+            shard_args += [f"--{name}", value]
+        queue.add(stage, shard_args)
+        n += 1
+    print(f"Added {n} shard(s) of {stage}.")
+
+
+@main.command("add-entailment")
+@click.option("--dataset", required=True)
+@click.option(
+    "--facts_path", required=True, help="Path to facts.json or discord_facts.json."
+)
+@click.option(
+    "--files_per_shard",
+    default=1,
+    type=int,
+    help="Summary files per shard, which are scored in one batch with one model load.",
+)
+@click.option(
+    "--baselines_only",
+    is_flag=True,
+    default=False,
+    help="Only enqueue summaries of the baselines (e.g., to score them on CPU).",
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.pass_obj
+def add_entailment(queue, dataset, facts_path, files_per_shard, baselines_only, args):
+    """
+    Enqueues claim entailment for all summary files without output. Further arguments
+    (after --) are passed to claim_entailment, e.g. `-- --nli_model roberta-large
+    --device cpu`.
+    """
+    out_dir = {"facts.json": "nli", "discord_facts.json": "discord-qa-nli"}.get(
+        Path(facts_path).with_suffix(".json").name
+    )
+    if out_dir is None:
+        raise click.BadParameter("Unknown facts type.", param_hint="--facts_path")
+
+    files = []
+    for suffix in ["json", "parquet"]:
+        if not baselines_only:
+            files += glob.glob(f"output/{dataset}/*/summaries/temperature*-*.{suffix}")
+        files += glob.glob(f"output/{dataset}/*/summaries/output*.{suffix}")
+    # outputs stored in both formats are enqueued once, by their JSON path
+    files = sorted({str(Path(file).with_suffix(".json")) for file in files})
+    pending = [
+        file
+        for file in files
+        if not table_exists(Path(file).parent.parent / out_dir / Path(file).name)
+    ]
+    for i in range(0, len(pending), files_per_shard):
+        shard_files = pending[i : i + files_per_shard]
+        queue.add(
+            "claim_entailment",
+            ["--facts_path", facts_path, "--summaries_path", *shard_files, *args],
+        )
+    print(f"Added {len(pending)}/{len(files)} summary files of {dataset}.")
+
+
+@main.command()
+@click.option(
+    "--stages", default=None, help="Comma-separated stages to work on (default: all)."
+)
+@click.option(
+    "--max_shards", default=None, type=int, help="Stop after this many shards."
+)
+@click.option(
+    "--wait",
+    default=0,
+    type=float,
+    help="Seconds to wait for new shards when the queue is empty, before exiting.",
+)
+@click.pass_obj
+def worker(queue, stages, max_shards, wait):
+    """Claims and runs shards until the queue is empty."""
+    stages = stages.split(",") if stages else None
+    name = worker_name()
+    heartbeat_s = max(1.0, queue.lease_s / 3)
+    processed = 0
+    idle_since = time.time()
+    while max_shards is None or processed < max_shards:
+        shard = queue.claim(name, stages=stages)
+        if shard is None:
+            if time.time() - idle_since >= wait:
+                break
+            time.sleep(min(5.0, max(wait, 0.1)))
+            continue
+        run_shard(queue, shard, name, heartbeat_s)
+        processed += 1
+        idle_since = time.time()
+    print(f"[{name}] Processed {processed} shard(s).", flush=True)
+
+
+@main.command()
+@click.option(
+    "--reset_failed", is_flag=True, default=False, help="Retry failed shards."
+)
+@click.pass_obj
+def status(queue, reset_failed):
+    """Prints the number of shards per stage and status."""
+    if reset_failed:
+        print(f"Reset {queue.reset('failed')} failed shard(s).")
+    for stage, counts in sorted(queue.stats().items()):
+        print(f"{stage}: {counts}")
+    for shard_id, stage, args, attempts, error in queue.failures():
+        print(f"  {shard_id} {stage} (attempts: {attempts}): {error}\n    {args}")
+
+
+if __name__ == "__main__":
+    main()